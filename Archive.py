@@ -0,0 +1,135 @@
+"""Archive.py
+
+Description:
+    An Archive is the compressed, read-only form of a sealed log segment. The messages in it are kept in blocks of
+    ARCHIVE_BLOCK lines, each compressed on its own with zlib, so that a single message can be read by decompressing
+    just its block rather than the whole segment. The file starts with the numbers of the messages that it holds,
+    in order, and where each block ends, and is memory-mapped when it is opened, so an Archive takes up next to no
+    memory until its messages are actually read. Only the last few blocks that were read are kept decompressed.
+
+    Messages that have expired are left out when a segment is archived, so an Archive only holds some of the numbers
+    of its segment.
+
+"""
+
+import os
+import mmap
+import zlib
+import bisect
+import struct
+from array import array
+
+from Column import Column
+
+
+ARCHIVE_HEADER = struct.Struct('=8sQQQ')
+ARCHIVE_MAGIC = b'CHATARCV'
+ARCHIVE_CHECK = 0x0102030405060708
+ARCHIVE_BLOCK = 256
+ARCHIVE_CACHE = 4
+
+
+class Archive(object):
+    '''A compressed segment, which messages can be read from one at a time.
+
+    Args:
+        path (str): The location of the archive file.
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.blocks = {}
+        with open(path, 'rb') as archive_file:
+            self.mapped = mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, check, count, block_count = ARCHIVE_HEADER.unpack_from(self.mapped)
+        if magic != ARCHIVE_MAGIC or check != ARCHIVE_CHECK:
+            raise ValueError('{} is not an archive'.format(path))
+        view = memoryview(self.mapped)
+        position = ARCHIVE_HEADER.size
+        self.numbers = Column('Q', view[position:position + 8 * count].cast('Q'))
+        position += 8 * count
+        self.block_ends = view[position:position + 8 * block_count].cast('Q')
+        self.data_start = position + 8 * block_count
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def _block(self, block):
+        '''Used to get the lines of a block, decompressing it if it is not one of the last few that were read.'''
+        lines = self.blocks.pop(block, None)
+        if lines is None:
+            start = self.data_start + (self.block_ends[block - 1] if block else 0)
+            end = self.data_start + self.block_ends[block]
+            lines = zlib.decompress(self.mapped[start:end]).split(b'\n')
+            if len(self.blocks) >= ARCHIVE_CACHE:
+                del self.blocks[next(iter(self.blocks))]
+        self.blocks[block] = lines
+        return lines
+
+    def read(self, number):
+        '''Used to read a single message, as the line that it was stored as in the log.
+
+        args:
+            number (int): The number of the message.
+
+        returns:
+            line (bytes): The message, or None if the archive does not hold it (because it had expired).
+
+        '''
+        position = bisect.bisect_left(self.numbers, number)
+        if position == len(self.numbers) or self.numbers[position] != number:
+            return None
+        return self._block(position // ARCHIVE_BLOCK)[position % ARCHIVE_BLOCK]
+
+    def close(self):
+        self.numbers = Column('Q')
+        self.block_ends = memoryview(b'').cast('Q')
+        self.blocks = {}
+        self.mapped.close()
+
+
+def write_archive(path, entries):
+    '''Used to write messages out to a new archive.
+
+    The archive is written to a temporary file first, and then moved into place, so a crash while it is being
+    written leaves whatever was there before as it was.
+
+    args:
+        path (str): Where to write the archive.
+        entries (iterable): Each message to archive, oldest first, as (number, line), where line is the message as it
+                            was stored in the log, without its newline.
+
+    returns:
+        size (int): The size of the archive, in bytes.
+
+    '''
+    numbers = array('Q')
+    block_ends = array('Q')
+    blocks = []
+    lines = []
+    size = 0
+    for number, line in entries:
+        numbers.append(number)
+        lines.append(line)
+        if len(lines) == ARCHIVE_BLOCK:
+            blocks.append(zlib.compress(b'\n'.join(lines)))
+            size += len(blocks[-1])
+            block_ends.append(size)
+            lines = []
+    if lines:
+        blocks.append(zlib.compress(b'\n'.join(lines)))
+        size += len(blocks[-1])
+        block_ends.append(size)
+
+    with open(path + '.tmp', 'wb') as archive_file:
+        archive_file.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_CHECK, len(numbers), len(blocks)))
+        archive_file.write(numbers)
+        archive_file.write(block_ends)
+        for block in blocks:
+            archive_file.write(block)
+        archive_file.flush()
+        os.fsync(archive_file.fileno())
+    os.replace(path + '.tmp', path)
+    return ARCHIVE_HEADER.size + 8 * (len(numbers) + len(blocks)) + size
@@ -1,363 +1,413 @@
-"""AsyncClient.py
-
-usage: Async Client [-h] [-p port] [-c cafile] [-t time_on] [-u user_on]
-                    [-s space_on]
-                    host
-
-Example:
-    > python AsyncClient.py localhost -p 1060 -t n
-
-Author:              Steven Baumann
-Class:               CSI-235
-Assignment:          Final Project
-Date Assigned:       4/6/2018
-Due Date:            4/26/2018 11:59 PM
-
-Description:
-    This client allows for asynchronous communication between the server it connects to.
-    The client connects to this server over a TLS SSL connection, then can send messages freely to other users.
-
-"""
-
-import json
-import argparse
-import asyncio
-import time
-import datetime
-import struct
-import ssl
-import webbrowser
-
-
-class AsyncClient(asyncio.Protocol):
-    '''This is the main Client class, used to connect to the server.
-
-    This class is used later in the " if __name__ == '__main__' " condition,
-    where it is passed to a create_connection function.
-
-    Args:
-        time_on (str): This is a parsed command, which specifies
-                 whether or not the user would like to see the time before each individual message. The default is yes.
-
-        user_on (str): Similar to time_on, except allows the user to filter out usernames before each message.
-                       The default is yes.
-
-        space_on (str): Similar to the other two arguments, except that this allows the user
-                        to put an extra space in between each message. The default is no.
-
-    '''
-
-    def __init__(self, time_on, user_on, space_on):
-        self.buffer = b''
-        self.user = input("Please enter your username: ")
-        self.time_on = time_on
-        self.user_on = user_on
-        self.space_on = space_on
-        self.connected = 0
-        self.total_len = 0
-
-    def connection_made(self, transport):
-        '''Used by asyncio after a connection has been established.
-
-        The connection_made function is called after the client
-        successfully connects to the server though the asyncio protocol.
-
-        args:
-            transport (obj): The transport is the representation between the client and the server,
-                             allowing communications between them.
-
-        '''
-        self.transport = transport
-        self.address = transport.get_extra_info('peername')
-
-        message_data = {"USERNAME": self.user}
-        json_data = json.dumps(message_data).encode('ascii')
-        message_len = struct.pack('!I', len(json_data))
-        self.transport.write(message_len + json_data)
-
-    def data_received(self, data):
-        '''Called after the client receives an amount of data from the server.
-
-        The data_received function is called after the client receives a piece of data from the server.
-        since data_received is called every time a piece of data is sent, it is important to have member variables
-        that can differentiate between the different states that the client is in. For instance, I am using
-            self.connected
-        here, to differentiate between the times that I am connected to the server and receiving data, or when
-        I am not connected and receiving data.
-
-        In general, the data that we receive with this function must be parsed through json.loads(), then allocated
-        to the correct variable, or printed out to the screen when necessary. We receive data by calling their key
-        values, e.g. response.get("MESSAGES") or response.get("USERS_JOINED"). The great thing about this method
-        is that we can pick and choose which pieces of datat we would like to utilize from the dataset that we are given.
-
-        args:
-            data (bytes): The data that the server has send to the client to be evaluated.
-
-        '''
-        if self.buffer == b'':
-            self.buffer = data
-            self.total_len = struct.unpack('!I', self.buffer[:4])[0]
-
-            if len(self.buffer)+len(data) >= self.total_len and self.connected == 0:
-                response = json.loads(self.buffer[4:])
-
-                status = response.get("USERNAME_ACCEPTED")
-                info = response.get("INFO", "No info provided.")
-
-                if not status:
-                    print(info + " please type quit to try again.")
-                else:
-                    self.connected = 1
-                    print("\n We have connected to {} successfully with username {}!".format(address[0], self.user))
-                    print("The server says, {}".format(info))
-                    if response.get("USER_LIST") == [self.user]:
-                        print("You are the only user online! \n")
-                    else:
-                        print("Users online: {} \n".format(response.get("USER_LIST")))
-
-                    messages = response.get("MESSAGES")
-                    if messages:
-                        for i in messages:
-                            if self.time_on == 'n' and self.user_on == 'y':
-                                print(i[0] + " said: " + i[3])
-                            elif self.time_on == 'y' and self.user_on == 'n':
-                                print(str(datetime.datetime.fromtimestamp(i[2])) + ": " + i[3])
-                            elif self.time_on == 'n' and self.user_on == 'n':
-                                print(i[3])
-                            else:
-                                print("At " + str(datetime.datetime.fromtimestamp(i[2])) + ", " + i[0] + " said: " + i[3])
-                            if self.space_on == 'y':
-                                print('')
-
-                    self.buffer = b''
-
-            elif len(self.buffer)+len(data) >= self.total_len and self.connected == 1:
-                response = json.loads(self.buffer[4:])
-
-                messages = response.get("MESSAGES")
-                users_joined = response.get("USERS_JOINED")
-                users_left = response.get("USERS_LEFT")
-                other_info = response.get("INFO")
-                error_info = response.get("ERROR")
-                browser_info = response.get("BROWSER")
-
-                if messages:
-                    for i in messages:
-                        if self.time_on == 'n' and self.user_on == 'y':
-                            print(i[0] + " said: " + i[3])
-                        elif self.time_on == 'y' and self.user_on == 'n':
-                            print(str(datetime.datetime.fromtimestamp(i[2])) + ": " + i[3])
-                        elif self.time_on == 'n' and self.user_on == 'n':
-                            print(i[3])
-                        else:
-                            print("At " + str(datetime.datetime.fromtimestamp(i[2])) + ", " + i[0] + " said: " + i[3])
-                        if self.space_on == 'y':
-                            print('')
-
-                if users_joined:
-                    for i in users_joined:
-                        print(i + " has joined the server!")
-
-                if users_left:
-                    for i in users_left:
-                        print(i + " has left the server. Bye!")
-
-                if other_info:
-                    print("The server says: " + other_info)
-
-                if error_info:
-                    print("The server responded with this error: " + error_info)
-
-                if browser_info:
-                    webbrowser.open(browser_info)
-
-                self.buffer = b''
-        elif len(self.buffer)+len(data) < self.total_len:
-            self.buffer += data
-
-        elif len(self.buffer)+len(data) >= self.total_len and self.connected == 0:
-            self.buffer += data
-            response = json.loads(self.buffer[4:])
-
-            status = response.get("USERNAME_ACCEPTED")
-            info = response.get("INFO", "No info provided.")
-
-            if not status:
-                print(info + " please type quit to try again.")
-            else:
-                self.connected = 1
-                print("\n We have connected to {} successfully with username {}!".format(address, self.user))
-                print("The server says, {}".format(info))
-                if response.get("USER_LIST") == [self.user]:
-                    print("You are the only user online! \n")
-                else:
-                    print("Users online: {} \n".format(response.get("USER_LIST")))
-
-                messages = response.get("MESSAGES")
-                if messages:
-                    for i in messages:
-                        if self.time_on == 'n' and self.user_on == 'y':
-                            print(i[0] + " said: " + i[3])
-                        elif self.time_on == 'y' and self.user_on == 'n':
-                            print(str(datetime.datetime.fromtimestamp(i[2])) + ": " + i[3])
-                        elif self.time_on == 'n' and self.user_on == 'n':
-                            print(i[3])
-                        else:
-                            print("At " + str(datetime.datetime.fromtimestamp(i[2])) + ", " + i[0] + " said: " + i[3])
-                        if self.space_on == 'y':
-                            print('')
-
-            self.buffer = b''
-
-        elif len(self.buffer)+len(data) >= self.total_len and self.connected == 1:
-            self.buffer += data
-            response = json.loads(self.buffer[4:])
-
-            messages = response.get("MESSAGES")
-            users_joined = response.get("USERS_JOINED")
-            users_left = response.get("USERS_LEFT")
-            other_info = response.get("INFO")
-            error_info = response.get("ERROR")
-            browser_info = response.get("BROWSER")
-
-            if messages:
-                for i in messages:
-                    if self.time_on == 'n' and self.user_on == 'y':
-                        print(i[0] + " said: " + i[3])
-                    elif self.time_on == 'y' and self.user_on == 'n':
-                        print(str(datetime.datetime.fromtimestamp(i[2])) + ": " + i[3])
-                    elif self.time_on == 'n' and self.user_on == 'n':
-                        print(i[3])
-                    else:
-                        print("At " + str(datetime.datetime.fromtimestamp(i[2])) + ", " + i[0] + " said: " + i[3])
-                    if self.space_on == 'y':
-                        print('')
-
-            if users_joined:
-                for i in users_joined:
-                    print(i + " has joined the server!")
-
-            if users_left:
-                for i in users_left:
-                    print(i + " has left the server. Bye!")
-
-            if other_info:
-                print("The server says: " + other_info)
-
-            if error_info:
-                print("The server responded with this error: " + error_info)
-
-            if browser_info:
-                webbrowser.open(browser_info)
-
-            self.buffer = b''
-
-    def connection_lost(self, exc):
-        '''Called when connection is lost with the server.
-
-        args:
-            exc: The exception that was raised which led to the loss of connection.
-
-        '''
-        print('Client {} closed socket'.format(self.address))
-
-    @asyncio.coroutine
-    def messaging(self, loop):  #in message / receiving mode
-        '''Messaging is called in an asynchronous manner, to send messages to the server.
-
-        While we call the AsyncClient class to evaluate what the server is sending to us, we call the messaging
-        coroutine to send messages to the server (that the user would like to send).
-
-        There are two types of JSON messages that we send here; the MESSAGES messages, and the BROWSER message.
-        the MESSAGES message is a standard message, with a 4 byte unsigned integer prefixed as it's length, which
-        is then send to the server (and the messages recipient). BROWSER is a web browser message, which sends
-        a message to the server telling it we would like to search for something on the internet
-        (we can optionally choose to share our search with others as well, by prefixing with !y instead of !).
-        The server then responds, as the client automatically opens the search in their web browser.
-
-        An optional @ sign can be used at the beginning of a message to specify a private recipient for the message;
-        if none are chosen, the default is ALL, or all users.
-
-        args:
-            loop (obj): loop is the event loop which causes messaging to constantly run,
-                        and await for further user input.
-
-        '''
-        while True:
-            message = yield from loop.run_in_executor(None, input, "")
-            if message == 'quit':
-                loop.stop()
-                return
-            if self.connected == 1:
-                if message.startswith('@'):
-                    space_location = message.find(' ')
-                    user_to_send = message[1:space_location]
-
-                    message_data = {"MESSAGES": [(self.user, user_to_send, int(time.time()), message)]}
-                    json_data = json.dumps(message_data).encode('ascii')
-                    message_len = struct.pack('!I', len(json_data))
-                    self.transport.write(message_len + json_data)
-                elif message.startswith('!'):
-                    if message[1] == 'y':
-                        message_data = {"BROWSER": (message[2:], self.user, 1)}
-                        json_data = json.dumps(message_data).encode('ascii')
-                        message_len = struct.pack('!I', len(json_data))
-                        self.transport.write(message_len + json_data)
-                    else:
-                        message_data = {"BROWSER": (message[1:], self.user, 0)}
-                        json_data = json.dumps(message_data).encode('ascii')
-                        message_len = struct.pack('!I', len(json_data))
-                        self.transport.write(message_len + json_data)
-                else:
-                    message_data = {"MESSAGES": [(self.user, 'ALL', int(time.time()), message)]}
-                    json_data = json.dumps(message_data).encode('ascii')
-                    message_len = struct.pack('!I', len(json_data))
-                    self.transport.write(message_len + json_data)
-
-def parse_command_line(message):
-    '''Called when we need to get args from the command line.
-
-    When the program is invoked with AsyncClient.py (args), those args are parsed through here. There are 6 args
-    in total, most of which give message formatting options.
-
-    args:
-        message (str): The default help text that the argument parser shows the user at the command line.
-
-    returns:
-        list_args (list): list_args returns the user supplied arguments to the program.
-                          host and port are grouped together here, so that they may be sent to AsyncClient
-                          at the same time with *list_args[0]
-
-    '''
-    parser = argparse.ArgumentParser(message)
-    parser.add_argument('host', help='Hostname')
-    parser.add_argument('-p', metavar='port', type=int, default=1060, help='Port #')
-    parser.add_argument('-c', metavar='cafile', type=str, default='ca.crt', help='Cafile location')
-    parser.add_argument('-t', metavar='time_on', type=str, default='y', help='Time on? y/n')
-    parser.add_argument('-u', metavar='user_on', type=str, default='y', help='User on? y/n')
-    parser.add_argument('-s', metavar='space_on', type=str, default='n', help='Extra space on? y/n')
-    args = parser.parse_args()
-    list_args = ([args.host, args.p], args.c, args.t, args.u, args.s)
-    return list_args
-
-if __name__ == '__main__':
-    '''
-    Here implement the parge_command_line function, create a secure SSL connection with the server,
-    and initialize the messsaging() function.
-    '''
-
-    address = parse_command_line('Async Client')
-    loop = asyncio.get_event_loop()
-    client = AsyncClient(address[2], address[3], address[4])
-
-    purpose = ssl.Purpose.SERVER_AUTH
-    context = ssl.create_default_context(purpose, cafile=address[1])
-
-    coro = loop.create_connection(lambda: client, *address[0], ssl=context)
-    try:
-        loop.run_until_complete(coro)
-        asyncio.async(client.messaging(loop))
-        loop.run_forever()
-    finally:
-        loop.close()
-
+"""AsyncClient.py
+
+usage: Async Client [-h] [-p port] [-c cafile] [-t time_on] [-u user_on]
+                    [-s space_on] [-e codecs] [-b batch_ms]
+                    [-l last]
+                    host
+
+Example:
+    > python AsyncClient.py localhost -p 1060 -t n
+
+Author:              Steven Baumann
+Class:               CSI-235
+Assignment:          Final Project
+Date Assigned:       4/6/2018
+Due Date:            4/26/2018 11:59 PM
+
+Description:
+    This client allows for asynchronous communication between the server it connects to.
+    The client connects to this server over a TLS SSL connection, then can send messages freely to other users.
+    If the connection is lost, the client keeps trying to reconnect (waiting longer after each failed attempt), and
+    is then sent just the messages that it missed while it was away. Direct messages that were sent to us while we
+    were logged out are shown when we log in, and we are told when a direct message that we sent is received.
+
+    Everything to do with the server itself is done by a ChatClient (see ChatClient.py); this is the terminal
+    that sits on top of it, reading what the user types and printing whatever the server sends.
+
+"""
+
+import argparse
+import asyncio
+import ssl
+import webbrowser
+
+from ChatClient import ChatClient, LoginRefused
+from Renderer import Renderer
+
+
+LAST = 20
+
+
+class AsyncClient(object):
+    '''This is the main Client class, the terminal for a ChatClient.
+
+    This class is used later in the " if __name__ == '__main__' " condition, once the ChatClient has logged in.
+
+    Args:
+        client (obj): The ChatClient, already logged in, that this terminal is for.
+
+        time_on (str): This is a parsed command, which specifies
+                 whether or not the user would like to see the time before each individual message. The default is yes.
+
+        user_on (str): Similar to time_on, except allows the user to filter out usernames before each message.
+                       The default is yes.
+
+        space_on (str): Similar to the other two arguments, except that this allows the user
+                        to put an extra space in between each message. The default is no.
+
+        last (int): Only the newest last messages of a page of history are shown straight away; the rest are kept
+                    back, and shown by /more without asking the server. 0 shows every message.
+
+    '''
+
+    def __init__(self, client, time_on, user_on, space_on, last=LAST):
+        self.client = client
+        self.renderer = Renderer(time_on, user_on, space_on)
+        self.last = last
+        self.hidden = {}
+
+    def show_welcome(self, response):
+        '''Used to print the server's welcome, once we have logged in.
+
+        args:
+            response (dict): The USERNAME_ACCEPTED response from the server.
+
+        '''
+        print("\n We have connected to {} successfully with username {}!".format(self.client.address[0],
+                                                                               self.client.username))
+        print("The server says, {}".format(response.get("INFO", "No info provided.")))
+        if response.get("USER_LIST") == [self.client.username]:
+            print("You are the only user online! \n")
+        else:
+            print("Users online: {} \n".format(response.get("USER_LIST")))
+        if response.get("MESSAGES"):
+            self.show_latest(response.get("MESSAGES"))
+        self.show_offline(response)
+
+    def show_offline(self, response):
+        '''Used to print the direct messages that were sent to us while we were logged out, if there are any.'''
+        if response.get("OFFLINE"):
+            print("--- {} messages were sent to you while you were away ---".format(len(response["OFFLINE"])))
+            self.show_messages(response["OFFLINE"])
+
+    async def receiving(self):
+        '''Used to print everything that the server sends us, for as long as we are logged in.'''
+        async for response in self.client.messages():
+            self.show(response)
+
+    def show(self, response):
+        '''Called with every message that the server sends us once we are logged in (and with the ChatClient's own
+        messages about reconnecting), to print it.
+
+        We pick out the data that we are interested in by their key values, e.g. response.get("MESSAGES") or
+        response.get("USERS_JOINED"); a single response can hold several of them.
+
+        args:
+            response (dict): The message from the server.
+
+        '''
+        if "USERNAME_ACCEPTED" in response:
+            if response.get("RESUMED") == "true":
+                messages = response.get("MESSAGES")
+                print("\n We have reconnected to {}, and missed {} messages.".format(self.client.address[0],
+                                                                                     len(messages)))
+                self.show_latest(messages)
+                self.show_offline(response)
+            else:
+                self.show_welcome(response)
+            return
+
+        if "DISCONNECTED" in response:
+            print("Lost the connection to {}: {}".format(self.client.address, response["DISCONNECTED"]))
+        if "RECONNECTING" in response:
+            print("Reconnecting in {:.1f} seconds...".format(response["RECONNECTING"]))
+        if "RECONNECT_FAILED" in response:
+            print("Could not reconnect: {}".format(response["RECONNECT_FAILED"]))
+
+        if response.get("MESSAGES"):
+            self.show_messages(response["MESSAGES"])
+
+        for i in response.get("USERS_JOINED", ()):
+            if i != self.client.username:
+                print(i + " has joined the server!")
+        for i in response.get("USERS_LEFT", ()):
+            print(i + " has left the server. Bye!")
+
+        if response.get("INFO"):
+            print("The server says: " + response["INFO"])
+
+        if response.get("ERROR"):
+            print("The server responded with this error: " + response["ERROR"])
+
+        if response.get("QUEUED"):
+            print("{} is not online; your message will be delivered when they next log in.".format(response["TO"]))
+
+        if response.get("DELIVERED"):
+            print("{} has received your message{}.".format(response["TO"],
+                                                           "s" if len(response["DELIVERED"]) > 1 else ""))
+
+        if response.get("BROWSER"):
+            webbrowser.open(response["BROWSER"])
+
+        if response.get("JOINED"):
+            print("You have joined {}. Type {} before a message to send it to everyone in the room.".format(
+                response["JOINED"], response["JOINED"]))
+
+        if response.get("LEFT"):
+            print("You have left {}.".format(response["LEFT"]))
+
+        if "HISTORY" in response:
+            self.show_history(response)
+
+        if "SEARCH_RESULTS" in response:
+            self.show_search(response)
+
+    def show_messages(self, messages):
+        '''Used to print chat messages, formatted according to the time_on, user_on and space_on options.
+
+        args:
+            messages (list): The messages to print, each as (sender, recipient, timestamp, text).
+
+        '''
+        self.renderer.write(messages)
+
+    def show_latest(self, messages, room=None):
+        '''Used to print a page of history, keeping back all but the newest last messages for /more.
+
+        args:
+            messages (list): The messages to print, oldest first.
+            room (str): The room that the messages are from, or None for the messages sent to us and to ALL.
+
+        '''
+        self.show_messages(self.keep_back(messages, room))
+        if self.hidden.get(room):
+            print("--- {} older messages not shown; type {} to see them ---".format(len(self.hidden[room]),
+                                                                                  more_command(room)))
+
+    def keep_back(self, messages, room):
+        '''Used to keep back all but the newest last messages of a page, for show_hidden.
+
+        returns:
+            messages (list): The messages to show now.
+
+        '''
+        if self.last and len(messages) > self.last:
+            self.hidden.setdefault(room, []).extend(messages[:-self.last])
+            return messages[-self.last:]
+        return messages
+
+    def show_hidden(self, room=None):
+        '''Used by /more to print the messages that show_latest kept back, newest page first.
+
+        args:
+            room (str): The room to show the older messages of, or None for the messages sent to us and to ALL.
+
+        returns:
+            shown (bool): False if nothing was kept back, so the server must be asked for older messages instead.
+
+        '''
+        hidden = self.hidden.get(room)
+        if not hidden:
+            return False
+        page = hidden[-self.last:]
+        del hidden[-self.last:]
+        self.show_page(page, room, self.client.history_cursor if room is None else self.client.room_cursors.get(room))
+        return True
+
+    def show_history(self, response):
+        '''Called when the server answers a request for older messages.
+
+        The ChatClient has already moved the history cursor back (or the room's cursor, for a page of a room's
+        history, which has a ROOM), so the next /more carries on from where this page stopped.
+
+        A page that is RESUMED holds the messages that we missed in a room while we were reconnecting.
+
+        args:
+            response (dict): The HISTORY response from the server.
+
+        '''
+        room = response.get("ROOM")
+        if response.get("RESUMED") == "true":
+            print("--- Missed messages in {} ---".format(room))
+            self.show_latest(response.get("HISTORY"), room)
+            return
+        self.show_page(self.keep_back(response.get("HISTORY"), room), room, response.get("HISTORY_CURSOR"))
+
+    def show_page(self, messages, room, cursor):
+        '''Used to print a page of older messages, between a header and a footer that says how to see more.
+
+        args:
+            messages (list): The messages to print, oldest first.
+            room (str): The room that the messages are from, or None.
+            cursor (int): The server's cursor for the page before this one, or None if there are no older messages.
+
+        '''
+        if room is None:
+            print("--- Older messages ---")
+        else:
+            print("--- Older messages in {} ---".format(room))
+        self.show_messages(messages)
+        if cursor is None and not self.hidden.get(room):
+            print("--- There are no older messages ---")
+        else:
+            print("--- Type {} to see older messages ---".format(more_command(room)))
+
+    def show_search(self, response):
+        '''Called when the server answers a search, with a page of matching messages, newest first.
+
+        args:
+            response (dict): The SEARCH_RESULTS response from the server.
+
+        '''
+        room = response.get("ROOM")
+        if room is None:
+            print("--- Messages matching '{}' ---".format(response.get("QUERY")))
+        else:
+            print("--- Messages in {} matching '{}' ---".format(room, response.get("QUERY")))
+        self.show_messages(response.get("SEARCH_RESULTS"))
+        if response.get("SEARCH_CURSOR") is None:
+            print("--- There are no more matches ---")
+        else:
+            print("--- Type /search to see older matches ---")
+
+    async def messaging(self, loop):  #in message / receiving mode
+        '''Messaging is called in an asynchronous manner, to send messages to the server.
+
+        While the ChatClient hands us whatever the server sends, we call the messaging coroutine to send messages
+        to the server (that the user would like to send).
+
+        A plain message is sent to ALL, or all users. An optional @ sign can be used at the beginning of a message
+        to specify a private recipient for the message, and a message starting with #room is sent to everyone who
+        has joined that room. A message starting with ! asks the server for a web search link instead (we can
+        optionally choose to share our search with others as well, by prefixing with !y instead of !).
+
+        Typing /more shows the messages that were kept back from the last page of history, or once there are none,
+        asks the server for the page of messages that came before the oldest one we have seen so far;
+        /more #room does the same for a room. /join #room and /leave #room join and leave a room.
+
+        Typing /search followed by some words asks the server for the newest messages that hold all of them;
+        /search #room words searches a room instead, and /search on its own asks for older matches of the last
+        search.
+
+        args:
+            loop (obj): loop is the event loop which causes messaging to constantly run,
+                        and await for further user input.
+
+        '''
+        client = self.client
+        while True:
+            message = await loop.run_in_executor(None, input, "")
+            if message == 'quit':
+                await client.close()
+                loop.stop()
+                return
+            if not client.connected:
+                print("Not connected to the server; please try again once we have reconnected.")
+            elif message == '/more':
+                if not self.show_hidden() and not await client.more():
+                    print("There are no older messages.")
+            elif message.startswith('/more '):
+                room = room_name(message[6:])
+                if not self.show_hidden(room) and not await client.more(room):
+                    print("There are no older messages in {}.".format(room))
+            elif message == '/search':
+                if not await client.search_more():
+                    print("There are no more matches.")
+            elif message.startswith('/search '):
+                query = message[8:].strip()
+                if query.startswith('#'):
+                    room, query = (query.split(' ', 1) + [''])[:2]
+                    await client.search(query, room)
+                else:
+                    await client.search(query)
+            elif message.startswith('/join '):
+                await client.join(room_name(message[6:]))
+            elif message.startswith('/leave '):
+                await client.leave(room_name(message[7:]))
+            elif message.startswith('!'):
+                if message[1:2] == 'y':
+                    await client.browser(message[2:], share=True)
+                else:
+                    await client.browser(message[1:])
+            elif message.startswith('#'):
+                await client.send(message.split(' ', 1)[0], message)
+            elif message.startswith('@'):
+                await client.send(message[1:message.find(' ')], message)
+            else:
+                await client.send('ALL', message)
+
+
+def more_command(room):
+    '''Used to get what the user types to see the older messages of a room, or of everything else if room is None.'''
+    return '/more' if room is None else '/more {}'.format(room)
+
+
+def room_name(text):
+    '''Used to turn what the user typed after /join, /leave or /more into a room name, adding the # if needed.'''
+    text = text.strip()
+    if not text.startswith('#'):
+        text = '#' + text
+    return text
+
+
+def parse_command_line(message):
+    '''Called when we need to get args from the command line.
+
+    When the program is invoked with AsyncClient.py (args), those args are parsed through here. There are 8 args
+    in total, most of which give message formatting options.
+
+    args:
+        message (str): The default help text that the argument parser shows the user at the command line.
+
+    returns:
+        list_args (list): list_args returns the user supplied arguments to the program.
+                          host and port are grouped together here, so that they may be sent to AsyncClient
+                          at the same time with *list_args[0]
+
+    '''
+    parser = argparse.ArgumentParser(message)
+    parser.add_argument('host', help='Hostname')
+    parser.add_argument('-p', metavar='port', type=int, default=1060, help='Port #')
+    parser.add_argument('-c', metavar='cafile', type=str, default='ca.crt', help='Cafile location')
+    parser.add_argument('-t', metavar='time_on', type=str, default='y', help='Time on? y/n')
+    parser.add_argument('-u', metavar='user_on', type=str, default='y', help='User on? y/n')
+    parser.add_argument('-s', metavar='space_on', type=str, default='n', help='Extra space on? y/n')
+    parser.add_argument('-e', metavar='codecs', type=str, default='binary+zlib,json',
+                        help='Codecs to offer the server, most preferred first, e.g. binary+zlib,json')
+    parser.add_argument('-b', metavar='batch_ms', type=int, default=10,
+                        help='Milliseconds to wait for more messages to send along with each one')
+    parser.add_argument('-l', metavar='last', type=int, default=LAST,
+                        help='Show only the newest last messages of history, and the rest with /more (0 shows all)')
+    args = parser.parse_args()
+    list_args = ([args.host, args.p], args.c, args.t, args.u, args.s, args.e.split(','), args.b / 1000.0, args.l)
+    return list_args
+
+if __name__ == '__main__':
+    '''
+    Here implement the parge_command_line function, create a secure SSL connection with the server,
+    log in (asking for another username until the server accepts one), and start the terminal.
+    '''
+
+    address = parse_command_line('Async Client')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    purpose = ssl.Purpose.SERVER_AUTH
+    context = ssl.create_default_context(purpose, cafile=address[1])
+
+    try:
+        while True:
+            client = ChatClient(input("Please enter your username: "), address[5], address[6])
+            try:
+                welcome = loop.run_until_complete(client.connect(address[0][0], address[0][1], context))
+                break
+            except LoginRefused as error:
+                print("{} Please pick another username.".format(error))
+
+        terminal = AsyncClient(client, address[2], address[3], address[4], address[7])
+        terminal.show_welcome(welcome)
+        asyncio.ensure_future(terminal.receiving())
+        asyncio.ensure_future(terminal.messaging(loop))
+        loop.run_forever()
+    finally:
+        loop.close()
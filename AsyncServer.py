@@ -1,284 +1,1640 @@
-"""AsyncServer.py
-
-usage: Async Server [-h] [-p port] host
-
-Example:
-    > python AsyncServer.py localhost -p 1060
-
-Author:              Steven Baumann
-Class:               CSI-235
-Assignment:          Final Project
-Date Assigned:       4/6/2018
-Due Date:            4/26/2018 11:59 PM
-
-Description:
-This server allows for asynchronous communication between it's clients. The client connects to this server over
-a TLS SSL connection, then can send messages freely to other users.
-
-"""
-
-import json
-import asyncio
-import socket
-import argparse
-import time
-import struct
-import ssl
-
-
-list_users = {}
-message_list = []
-backup_loaded = 0
-
-@asyncio.coroutine
-def handle_conversation(reader, writer):
-    '''Called when we receive a new connection from a client.
-
-    After a connection is made with the client through asyncio, this function is called to handle the conversation
-    between client and server.
-
-    The overall purpose of handle_conversation is to greet new clients by
-    supplying them with a greeting, a list of currently online users,
-    give all of the past messages to them (including their direct messages),
-    and allow them to add their messages to the pool of messages.
-
-    args:
-        reader (obj): The reader object is used to read messages from the client.
-        writer (obj): The writer object is used to write messages to the client.
-
-    raises:
-        ConnectionResetError: In the event that a client should close unexpectedly,
-                              we can gracefully tell other users that they have left,
-                              and remove their name and IP from list_users.
-
-    '''
-    global backup_loaded
-    global list_users
-    global message_list
-    address = writer.get_extra_info('peername')
-    print('Accepted connection from {}'.format(address))
-    accepted_user = 0
-    has_connection = 1
-
-    while has_connection == 1:
-        try:
-            data = yield from reader.read(4)
-            if data == b'':
-                if address in list_users:
-                    print('Connection with {} closed.'.format(list_users[address][0]))
-                    del list_users[address]
-                    for j in list_users.values():
-                        send_message({"INFO": "{} has left the server!".format(user)}, j[1])
-                else:
-                    print('Connection with {} closed.'.format(address))
-                    has_connection = 0
-                return
-            else:
-                if accepted_user == 0:
-                    more_data = yield from reader.read(struct.unpack('!I', data)[0])
-                    user = json.loads(more_data).get('USERNAME')
-
-                    if user in list_users.values():
-                        print("{} tried to connect with a duplicate username.".format(user))
-                        send_message({"USERNAME_ACCEPTED": "false","INFO": "Username already in use."}, writer)
-                    else:
-                        if backup_loaded == 0:
-                            try:
-                                backup_messages = open('backup.txt','r')
-                                if len(backup_messages.read()) > 1:
-                                    restore_backup()
-                                    backup_loaded = 1
-                                backup_messages.close()
-                            except IOError:
-                                backup_messages = open('backup.txt','w')
-                                backup_loaded = 1
-                                backup_messages.close()
-
-                        accepted_user = 1
-                        print("Welcome {} !".format(user))
-
-                        for j in list_users.values():
-                            send_message({"INFO": "{} has joined the server!".format(user)}, j[1])
-
-                        list_users[address] = (user, writer)
-
-                        users_online = []
-
-                        for i in list_users.values():
-                            users_online += [i[0]]
-
-                        sendable_messages = []
-
-                        for i in message_list:
-                            if i[1] == 'ALL' or i[1] == user:
-                                sendable_messages += [i]
-
-                        send_message({"USERNAME_ACCEPTED": "true", "INFO": "Welcome to the server!", "USER_LIST": users_online, "MESSAGES": sendable_messages}, writer)
-                else:
-                    message_raw = yield from reader.read(struct.unpack('!I', data)[0])
-
-                    browser_data = json.loads(message_raw).get("BROWSER")
-                    if browser_data:
-                        total_url = "https://www.google.com/search?q=" + browser_data[0]
-                        send_message({"BROWSER": total_url}, writer)
-                        if browser_data[2] == 1:
-                            print("{} has just searched the following: ".format(browser_data[1]) + browser_data[0])
-                            for j in list_users.values():
-                                send_message({"INFO": "{} has just searched the following: ".format(browser_data[1]) + browser_data[0]}, j[1])
-
-                    message_data = json.loads(message_raw).get("MESSAGES")
-                    send_mass_messages(message_data, writer, address)
-
-        except ConnectionResetError:
-            print('Connection with {} closed.'.format(list_users[address][0]))
-            has_connection = 0
-            if address in list_users:
-                    del list_users[address]
-                    for j in list_users.values():
-                        send_message({"INFO": "{} has left the server!".format(user)}, j[1])
-
-
-def send_mass_messages(message_data, writer, address):
-    '''send_mass_messages is used to notify all online clients of an event.
-
-    send_mass_messages is utilized by the AsyncServer function, allowing it to parse clients messages,
-    add them to the backup (past messages) file, and send them to the correct users.
-
-    args:
-        message_data (list): message_data is the message and it's data that the client has supplied us with.
-                             We can parse message_data to send the message to the right users.
-        writer (obj): The writer gives us the current clients writer object (the one who we have received the message from)
-        address (list): The host and ip of the current client, so that we can send them user not found errors.
-
-    '''
-    global message_list
-    global list_users
-    if message_data:
-        if list_users[address][0] != message_data[0][0]:
-            send_message({"ERROR": "Source username is not correct."}, writer)
-        else:
-            if type(message_data[0][0]) != str or type(message_data[0][1]) != str or type(message_data[0][2]) != int or type(message_data[0][3]) != str:
-                send_message({"ERROR": "Message has incorrect type."}, writer)
-            else:
-                message_list += message_data
-                for i in message_data:
-                    if i[1] == "ALL":
-                        backup_messages = open('backup.txt','a')
-                        backup_messages.write(json.dumps(message_data))
-                        backup_messages.write('\n')
-                        backup_messages.close()
-                        print(i[0] + " says: " + i[3])
-                        for j in list_users.values():
-                            send_message({"MESSAGES": message_data}, j[1])
-                    else:
-                        in_users = 0
-                        sending_writer = writer
-                        for k in list_users.values():
-                            if k[0] == i[1]:
-                                in_users = 1
-                                sending_writer = k[1]
-                        if in_users == 1:
-                            backup_messages = open('backup.txt','a')
-                            backup_messages.write(json.dumps(message_data))
-                            backup_messages.write('\n')
-                            backup_messages.close()
-                            send_message({"MESSAGES": message_data}, sending_writer)
-                        else:
-                            send_message({"ERROR": "The user you specified could not be found."}, writer)
-
-
-def restore_backup():
-    '''used by the server to restore messages.
-
-    contrary to its name, restore_backup does not restore backed up messages for all users, or even load them into
-    message_list. Instead, it allows the server to print past messages onto it's command prompt.
-
-    '''
-    global message_list
-    global list_users
-
-    backup_messages = open('backup.txt','r')
-
-    current_location = backup_messages.readlines()
-
-    for data in current_location:
-        message_data = json.loads(data)
-        for i in message_data:
-            if i[1] == "ALL":
-                print(i[0] + " Said: " + i[3])
-
-    backup_messages.close()
-
-
-def send_message(message, writer):
-    '''Used to send messages to the client.
-
-    The basic, yet the most powerful function, allows us to send a message to a client.
-    Used in any other function that needs to communicate with the clients. It encrypts the supplied message,
-    attaches a 4 byte unsigned int that displays the length as a prefix, and sends the message.
-
-    args:
-        message (list): the raw message to be sent to the client, before being encoded.
-        writer (obj): the users writer that we are sending the message to.
-
-    '''
-    json_data = json.dumps(message).encode('ascii')
-    message_len = struct.pack('!I', len(json_data))
-    writer.write(message_len + json_data)
-
-
-def parse_command_line(message):
-    '''Called when we need to get args from the command line.
-
-    This function is used by the " if __name__ == '__main__' " condition, and gives it a list of user supplied arguments.
-
-    args:
-        message (str): The help message that is displayed when the user asks for help.
-
-    returns:
-        address (list): address is a list containing the host and port that we would like to setup the AsyncServer on.
-
-    '''
-    parser = argparse.ArgumentParser(message)
-    parser.add_argument('host', help='Hostname')
-    parser.add_argument('-p', metavar='port', type=int, default=1060, help='Port #')
-    args = parser.parse_args()
-    address = (args.host, args.p)
-    return address
-
-
-if __name__ == '__main__':
-    '''
-    Here we initialize the appropriate SSL contexts, as well as loading from the backup file, 
-    and starting the server loop.
-    '''
-
-    address = parse_command_line('Async Server')
-    loop = asyncio.get_event_loop()
-
-    purpose = ssl.Purpose.CLIENT_AUTH
-    context = ssl.create_default_context(purpose, cafile="ca.crt")
-    context.load_cert_chain('localhost.pem')
-
-    coro = asyncio.start_server(handle_conversation, *address, ssl=context)
-    server = loop.run_until_complete(coro)
-    print('Listening at {}'.format(address))
-
-    try:
-        backup_messages = open('backup.txt','r')
-        if len(backup_messages.read()) > 1:
-            backup_messages.seek(0)
-            print("Waiting for client to connect to resume session...")
-            total_messages = backup_messages.readlines()
-            for i in total_messages:
-                message_list += json.loads(i)
-        backup_messages.close()
-    except IOError:
-        backup_messages = open('backup.txt','w')
-        backup_messages.close()
-
-    try:
-        loop.run_forever()
-    finally:
-        server.close()
-        loop.close()
+"""AsyncServer.py
+
+usage: Async Server [-h] [-p port] [-d history] [-n history_page] [-c cache_size] [-q outbox_limit]
+                    [-l slow_policy] [-f fsync] [-x encoders] [-w workers]
+                    [-m metrics_port] [-v log_level] [--log-rate log_rate]
+                    [--max-frame max_frame] [--max-connections max_connections]
+                    [--rate rate] [--ip-rate ip_rate] [--shed-lag shed_lag]
+                    [--commit-ms commit_ms] [--commit-size commit_size]
+                    [--max-age max_age] [--max-count max_count]
+                    [--max-bytes max_bytes] [--archive-age archive_age]
+                    host
+
+Example:
+    > python AsyncServer.py localhost -p 1060
+
+Author:              Steven Baumann
+Class:               CSI-235
+Assignment:          Final Project
+Date Assigned:       4/6/2018
+Due Date:            4/26/2018 11:59 PM
+
+Description:
+This server allows for asynchronous communication between it's clients. The client connects to this server over
+a TLS SSL connection, then can send messages freely to other users.
+
+Every stored message has a sequence number, which is sent along with it (as SEQ). A client that reconnects
+after losing its connection can say which message it saw last, and is sent only the messages that it missed.
+
+Clients acknowledge what they receive by sending ACK with the newest SEQ that they have seen. A direct message
+to someone who is not logged in is stored all the same, and its sender is told that it is QUEUED; it is sent to
+its recipient, along with any other direct messages that they have not acknowledged, as OFFLINE when they next log
+in. Once the recipient acknowledges a direct message, its sender is told that it was DELIVERED. A direct message
+to someone who has never logged in is not stored at all, and its sender is sent an ERROR instead.
+
+Users can also join rooms, named with a leading # (e.g. #team), and send messages to everyone in a room. Every
+room has its own history, kept in its own folder under rooms/ in the history folder, which is opened while anyone
+is in the room. Each user can be in up to MAX_ROOMS rooms at once.
+
+Users can search the text of their history (and of their rooms' history) with SEARCH, which is answered from an
+inverted index of every word that has been sent, newest matches first, a page at a time.
+
+Every connection, and every IP address, is rate limited with a token bucket, and frames larger than --max-frame
+bytes are refused before they are read (compressed frames are also refused if they would decompress to more). Once --max-connections clients are connected, or while the event loop is
+running more than --shed-lag seconds behind, new connections are turned away, as are requests that are expensive
+to answer (HISTORY, SEARCH, BROWSER and PRESENCE), so that chat messages keep flowing with bounded latency.
+
+Messages are written to disk on a background thread, in groups: a group is written (and, with -f always,
+fsync'd) once it holds --commit-size messages or its oldest message has waited --commit-ms milliseconds, so a
+slow disk delays when messages reach the disk, but never their delivery.
+
+Old messages can be set to expire with --max-age (in days), --max-count (per recipient, or per room) and
+--max-bytes (per store). Every COMPACT_INTERVAL seconds, the sealed segments of each open store that are mostly
+expired, or older than --archive-age days, are compacted into compressed archives on a background thread. Archived
+messages are still paged through and searched as usual, but are only read from disk when they are asked for.
+
+With -m, the server's metrics (in the Prometheus text format) and a sampling profiler switch are served over HTTP
+on 127.0.0.1, at /metrics, /profile/start and /profile/stop. When running with workers, the message bus uses the
+given port, and each worker uses the ports after it.
+
+"""
+
+import os
+import re
+import ssl
+import time
+import signal
+import socket
+import asyncio
+import argparse
+import itertools
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from MessageStore import MessageStore, RoomStores
+from SessionRegistry import Session, SessionRegistry
+from Outbox import Outbox
+from FrameDecoder import FrameDecoder, FrameTooLarge, encode_frame
+from Codec import JSON, negotiate
+from MessageBus import MessageBus, BusClient
+from Metrics import Registry, MetricsServer, SIZE_BUCKETS
+from Profiler import SamplingProfiler
+from Logger import Logger
+from Presence import Presence
+from RateLimiter import TokenBucket, RateLimiter
+from StoreWriter import StoreWriter, COMMIT_INTERVAL, COMMIT_SIZE
+from OfflineQueues import OfflineQueues
+
+
+FLUSH_INTERVAL = 0.5
+HISTORY_PAGE = 50
+OUTBOX_LIMIT = 1000
+OUTBOX_POLICY = 'drop_oldest'
+LAG_INTERVAL = 10
+OFFLOAD_MESSAGES = 20
+LOOP_LAG_INTERVAL = 0.25
+PRESENCE_INTERVAL = 0.2
+REPLAY_LIMIT = 1000
+SEARCH_PAGE = 20
+MAX_QUERY = 200
+MAX_ROOMS = 32
+MAX_FRAME = 1024 * 1024
+MAX_TIMESTAMP = 2 ** 37
+MAX_CONNECTIONS = 10000
+RATE = 20
+IP_RATE = 100
+SHED_LAG = 0.1
+COMMIT_LAG_WARNING = 1.0
+COMPACT_INTERVAL = 60
+ARCHIVE_AGE = 7
+DAY = 24 * 60 * 60
+ACK_COST = 0.1
+SHED_REQUESTS = ("HISTORY", "SEARCH", "BROWSER", "PRESENCE")
+ROOM_NAME = re.compile(r'^#[A-Za-z0-9_-]{1,32}$')
+
+sessions = SessionRegistry()
+pending = {}
+presence = Presence()
+tls_stats = {'handshakes': 0, 'resumed': 0}
+load = {'connections': 0, 'lag': 0.0}
+ip_limits = RateLimiter(IP_RATE, 2 * IP_RATE)
+message_store = None
+room_stores = None
+offline_queues = None
+writer = None
+bus = None
+encoder = None
+backup_loaded = 0
+
+log = Logger()
+profiler = SamplingProfiler()
+metrics = Registry()
+metrics.gauge('chat_sessions', 'Clients that are logged in to this process.', lambda: len(sessions))
+metrics.gauge('chat_rooms', 'Rooms that clients of this process are in.', lambda: len(sessions.rooms))
+metrics.gauge('chat_outbox_depth', 'Frames waiting in each client\'s outbox.',
+              lambda: {j.username: len(j.outbox) for j in sessions if j.outbox is not None}, label='user')
+metrics.counter('chat_outbox_dropped_total', 'Frames dropped for each slow client.',
+                lambda: {j.username: j.outbox.dropped for j in sessions if j.outbox is not None}, label='user')
+metrics.counter('chat_tls_handshakes_total', 'TLS handshakes with clients.', lambda: tls_stats['handshakes'])
+metrics.counter('chat_tls_resumed_total', 'TLS handshakes that resumed an earlier session.',
+                lambda: tls_stats['resumed'])
+messages_in = metrics.counter('chat_messages_received_total', 'Chat messages received from clients.')
+messages_out = metrics.counter('chat_messages_delivered_total', 'Chat messages sent on to clients.')
+frames_in = metrics.histogram('chat_frame_received_bytes', 'Size of the frames received from clients.', SIZE_BUCKETS)
+frames_out = metrics.histogram('chat_frame_sent_bytes', 'Size of the frames encoded for clients.', SIZE_BUCKETS)
+encode_time = metrics.histogram('chat_encode_seconds', 'Time taken to encode a frame.')
+write_time = metrics.histogram('chat_store_write_seconds', 'Time taken to write a batch of messages to disk.')
+commit_lag = metrics.histogram('chat_store_commit_lag_seconds',
+                               'How long messages wait, after being stored, to be written to disk.')
+compactions = metrics.counter('chat_store_compactions_total', 'Log segments compacted into archives.')
+metrics.gauge('chat_store_queue_depth', 'Messages waiting to be written to disk.',
+              lambda: len(writer) if writer is not None else 0)
+loop_lag = metrics.histogram('chat_event_loop_lag_seconds', 'How late the event loop runs a scheduled callback.')
+search_time = metrics.histogram('chat_search_seconds', 'Time taken to answer a SEARCH.')
+delivery_time = metrics.histogram('chat_delivery_seconds',
+                                  'Time from sending messages to a client to the client acknowledging them.')
+metrics.gauge('chat_connections', 'Connections open to this process, whether logged in or not.',
+              lambda: load['connections'])
+metrics.gauge('chat_event_loop_lag_average_seconds', 'Moving average of the event loop lag, used to shed load.',
+              lambda: load['lag'])
+throttled = metrics.counter('chat_requests_throttled_total', 'Requests dropped for going over a rate limit.')
+shed = metrics.counter('chat_requests_shed_total', 'Requests turned away because the server was overloaded.')
+refused = metrics.counter('chat_connections_refused_total',
+                          'Connections turned away because the server was full or overloaded.')
+
+
+class AsyncServer(asyncio.Protocol):
+    '''Called when we receive a new connection from a client.
+
+    asyncio creates one AsyncServer for every client that connects, and this object handles the conversation
+    between client and server.
+
+    The overall purpose of AsyncServer is to greet new clients by
+    supplying them with a greeting, a list of currently online users,
+    give the most recent past messages to them (including their direct messages),
+    and allow them to add their messages to the pool of messages. Older messages are sent
+    a page at a time, whenever the client asks for them with a HISTORY message, and can be searched with a
+    SEARCH message.
+
+    Every frame that the client sends is decoded once (with JSON until the client has logged in, and then with
+    whichever codec was agreed on), and then each of its keys is handed to the method that
+    handles that type of message, using the handlers table. Frames are handled as soon as they are complete,
+    so a client can send several requests without waiting for the answer to each one.
+
+    Before a request is handled, it is checked against the connection's own rate limit and the limit of the IP
+    address that it came from (see admit()).
+
+    '''
+
+    def connection_made(self, transport):
+        '''Used by asyncio after a client has connected.
+
+        args:
+            transport (obj): The transport is the representation between the client and the server,
+                             allowing communications between them.
+
+        '''
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        self.decoder = FrameDecoder(MAX_FRAME)
+        self.codec = JSON
+        self.request = None
+        self.session = None
+        self.claiming = False
+        self.limit = TokenBucket(RATE, 2 * RATE)
+        self.throttled = False
+        load['connections'] += 1
+        log.debug('Accepted connection from {}', self.address)
+
+        ssl_object = transport.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            tls_stats['handshakes'] += 1
+            if ssl_object.session_reused:
+                tls_stats['resumed'] += 1
+
+        if MAX_CONNECTIONS and load['connections'] > MAX_CONNECTIONS:
+            self.refuse("The server is full, please try again later.")
+        elif overloaded():
+            self.refuse("The server is busy, please try again later.")
+
+    def refuse(self, info):
+        '''Used to turn a new connection away, answering as if its login had been refused, so that it tries again.'''
+        refused.inc()
+        send_message({"USERNAME_ACCEPTED": "false", "INFO": info}, self.transport)
+        self.transport.close()
+
+    def data_received(self, data):
+        '''Called after the server receives an amount of data from the client.
+
+        args:
+            data (bytes): The data that the client has sent, which may hold any number of frames.
+
+        '''
+        try:
+            frames = self.decoder.feed(data)
+        except FrameTooLarge:
+            self.transport.write(encode_message({"ERROR": "Frames may hold up to {} bytes.".format(MAX_FRAME)},
+                                                self.codec))
+            self.transport.close()
+            return
+
+        for frame in frames:
+            frames_in.observe(len(frame))
+            try:
+                request = self.codec.decode(frame, MAX_FRAME)
+            except ValueError:
+                send_message({"ERROR": "Message could not be decoded."}, self.session or self.transport)
+                continue
+
+            if type(request) != dict:
+                send_message({"ERROR": "Message has incorrect type."}, self.session or self.transport)
+                continue
+
+            if not self.admit(request):
+                continue
+
+            self.request = request
+            for key, value in request.items():
+                handler = self.handlers.get(key)
+                if handler is None:
+                    continue
+                if self.session is None and key != "USERNAME":
+                    send_message({"ERROR": "Please log in first."}, self.transport)
+                    break
+                handler(self, value)
+
+    def admit(self, request):
+        '''Used to decide whether a request may be handled.
+
+        A MESSAGES request costs one token for every message in it, an ACK on its own costs ACK_COST tokens (clients
+        send one after every burst of messages that they receive), and anything else costs one token. If either
+        the connection's bucket or its IP address's bucket is empty, the request is dropped, and the connection is
+        throttled. While the server is overloaded, requests that are expensive to answer are turned away too.
+
+        args:
+            request (dict): The decoded request.
+
+        returns:
+            admitted (bool): True if the request should be handled.
+
+        '''
+        messages = request.get("MESSAGES")
+        if type(messages) == list and messages:
+            cost = len(messages)
+        elif len(request) == 1 and "ACK" in request:
+            cost = ACK_COST
+        else:
+            cost = 1
+        host = self.address[0] if self.address else None
+        if not self.limit.take(cost) or not ip_limits.take(host, cost):
+            throttled.inc()
+            self.throttle(max(self.limit.wait(), ip_limits.wait(host)))
+            return False
+
+        if overloaded() and any(key in request for key in SHED_REQUESTS):
+            shed.inc()
+            send_message({"ERROR": "The server is busy, please try again later."}, self.session or self.transport)
+            return False
+        return True
+
+    def throttle(self, wait):
+        '''Used when a client goes over a rate limit, to stop reading from it until it may send again.
+
+        Nothing more is read from the connection in the meantime, so a client that keeps on sending only fills up
+        its own socket buffers, rather than the server's memory or event loop. The client is told once each time.
+
+        args:
+            wait (float): The number of seconds until the client may send again.
+
+        '''
+        if self.throttled:
+            return
+        self.throttled = True
+        send_message({"ERROR": "You are sending too quickly, so some of your messages were dropped."},
+                     self.session or self.transport)
+        self.transport.pause_reading()
+        asyncio.get_event_loop().call_later(wait, self.unthrottle)
+
+    def unthrottle(self):
+        self.throttled = False
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        '''Called when the connection with the client is closed, whether cleanly or not.
+
+        We can gracefully tell other users that they have left, and remove their session from the session registry.
+
+        args:
+            exc: The exception that was raised which led to the loss of connection, or None if it was closed cleanly.
+
+        '''
+        load['connections'] -= 1
+        if self.session is None or not end_session(self.address):
+            log.debug('Connection with {} closed.', self.address)
+
+    def pause_writing(self):
+        '''Called by asyncio when the transport's write buffer goes over its high water mark.'''
+        if self.session is not None:
+            self.session.outbox.pause()
+
+    def resume_writing(self):
+        '''Called by asyncio when the transport's write buffer drains below its low water mark.'''
+        if self.session is not None:
+            self.session.outbox.resume()
+
+    def login(self, user):
+        '''Handles a USERNAME message, which logs the client in.
+
+        The USERNAME message may also hold CODECS, the codecs that the client understands. The answer is always
+        sent as JSON, and says which codec was picked; everything after it is sent with that codec.
+
+        A client that is reconnecting also sends SEQ, the sequence number of the last message that it saw, and is
+        sent the messages that it missed instead of the newest page of history (see MessageStore.catch_up). Any
+        direct messages that the client has not acknowledged, and that are not among those, are sent as OFFLINE.
+
+        When running as one of several workers, the username also has to be claimed from the message bus,
+        so the rest of the login carries on in claim() once the bus has answered. Until then, the username is held
+        in pending rather than in sessions, so that nothing is sent to the client ahead of its welcome, and any
+        other USERNAME from the same client is turned away.
+
+        args:
+            user (str): The username that the client would like to use.
+
+        '''
+        global backup_loaded
+        if self.session is not None:
+            send_message({"ERROR": "You are already logged in."}, self.session)
+            return
+        if self.claiming:
+            send_message({"ERROR": "You are already logging in."}, self.transport)
+            return
+
+        session = Session(user, self.transport, self.address)
+
+        if type(user) == str and user.startswith('#'):
+            send_message({"USERNAME_ACCEPTED": "false","INFO": "Usernames can not start with #."}, self.transport)
+        elif user == '':
+            send_message({"USERNAME_ACCEPTED": "false","INFO": "Usernames can not be empty."}, self.transport)
+        elif type(user) != str or user in sessions or user in pending:
+            log.info("{} tried to connect with a duplicate username.", user)
+            send_message({"USERNAME_ACCEPTED": "false","INFO": "Username already in use."}, self.transport)
+        elif bus is not None:
+            pending[user] = []
+            self.claiming = True
+            asyncio.ensure_future(self.claim(session, self.request.get("CODECS"), sequence(self.request)))
+        else:
+            if backup_loaded == 0:
+                restore_backup()
+                backup_loaded = 1
+
+            numbers, cursor, latest, resumed = message_store.catch_up(
+                ('ALL', user), sequence(self.request), HISTORY_PAGE, REPLAY_LIMIT)
+            offline = offline_queues.queued(user, REPLAY_LIMIT, skip=numbers)
+            if self.welcome(session, self.request.get("CODECS"), list(message_store.read_many(numbers)), cursor,
+                            latest, resumed, list(message_store.read_many(offline))):
+                presence.join(user)
+
+    async def claim(self, session, codecs, after):
+        '''Used when running as a worker, to claim a username from the message bus before logging the client in.
+
+        Messages that the bus hands over after it has answered, but before the client is welcomed, are kept in
+        pending (see deliver_from_bus), and sent on to the client once it has been welcomed.
+
+        args:
+            session (obj): The session that the client will have if the username is free.
+            codecs (list): The codecs that the client offered.
+            after (int): The sequence number of the last message that the client saw, or None.
+
+        '''
+        try:
+            claimed, messages, cursor, latest, resumed, offline = await bus.claim(session.username, HISTORY_PAGE,
+                                                                                  after)
+        finally:
+            buffered = pending.pop(session.username, [])
+            self.claiming = False
+        if claimed and self.transport.is_closing():
+            bus.release(session.username)
+        if not claimed or self.transport.is_closing():
+            log.info("{} tried to connect with a duplicate username.", session.username)
+            send_message({"USERNAME_ACCEPTED": "false","INFO": "Username already in use."}, self.transport)
+        elif self.welcome(session, codecs, messages, cursor, latest, resumed, offline):
+            deliver([entry for entry in buffered if entry[0] > latest], session)
+        else:
+            bus.release(session.username)
+
+    def welcome(self, session, codecs, messages, cursor, latest, resumed, offline):
+        '''Used to finish logging a client in, once their username is known to be free.
+
+        The client is sent a snapshot of who is online, and the version of presence that it is up to date with.
+        Everyone else finds out that the client has joined with the next change to presence.
+
+        args:
+            session (obj): The client's new session.
+            codecs (list): The codecs that the client offered.
+            messages (list): The messages that the client missed, or the newest messages for the client.
+            cursor (int): The HISTORY_CURSOR for the client's next page of history.
+            latest (int): The sequence number of the newest stored message.
+            resumed (bool): True if the messages are the ones that the client missed while it was away.
+            offline (list): The direct messages that the client has not acknowledged, other than those in messages.
+
+        returns:
+            welcomed (bool): True if the client was logged in, or False if the username (or the client's address)
+                             turned out to be in use after all, in which case the client is told so.
+
+        '''
+        if not sessions.add(session):
+            log.info("{} tried to connect with a duplicate username.", session.username)
+            send_message({"USERNAME_ACCEPTED": "false","INFO": "Username already in use."}, self.transport)
+            return False
+        self.session = session
+        session.outbox = Outbox(self.transport, limit=OUTBOX_LIMIT, policy=OUTBOX_POLICY, on_error=encode_error)
+        log.info("Welcome {} !", session.username)
+
+        codec = negotiate(codecs)
+
+        snapshot = presence.snapshot()
+        if session.username not in presence.users:
+            snapshot["USER_LIST"].append(session.username)
+
+        welcome = dict({"USERNAME_ACCEPTED": "true", "INFO": "Welcome to the server!", "MESSAGES": messages, "HISTORY_CURSOR": cursor, "SEQ": latest, "CODEC": codec.name}, **snapshot)
+        if resumed:
+            welcome["RESUMED"] = "true"
+        if offline:
+            welcome["OFFLINE"] = offline
+        session.dm_seq = latest
+        send_large_message(welcome, session)
+
+        session.codec = codec
+        self.codec = codec
+        return True
+
+    def history(self, cursor):
+        '''Handles a HISTORY message, which asks for the page of messages before a cursor.
+
+        The HISTORY message may also hold a ROOM, in which case the page comes from that room's history rather
+        than from the client's own messages.
+
+        args:
+            cursor (int): The HISTORY_CURSOR that the client was last given.
+
+        '''
+        room = self.request.get("ROOM")
+        if type(cursor) != int:
+            send_message({"ERROR": "History cursor is not correct."}, self.session)
+        elif room is not None and (type(room) != str or room not in self.session.rooms):
+            send_message({"ERROR": "You are not in that room."}, self.session)
+        else:
+            send_history(cursor, self.session, room)
+
+    def search(self, query):
+        '''Handles a SEARCH message, which asks for the newest messages that hold every word of a search.
+
+        The SEARCH message may also hold a ROOM, in which case that room's history is searched rather than the
+        client's own messages, and a SEARCH_CURSOR, to carry on from where the last page of matches stopped.
+
+        args:
+            query (str): The words to search for.
+
+        '''
+        room = self.request.get("ROOM")
+        cursor = self.request.get("SEARCH_CURSOR")
+        if type(query) != str or not 0 < len(query) <= MAX_QUERY:
+            send_message({"ERROR": "Searches hold up to {} characters.".format(MAX_QUERY)}, self.session)
+        elif cursor is not None and type(cursor) != int:
+            send_message({"ERROR": "Search cursor is not correct."}, self.session)
+        elif room is not None and (type(room) != str or room not in self.session.rooms):
+            send_message({"ERROR": "You are not in that room."}, self.session)
+        else:
+            send_search(query, cursor, self.session, room)
+
+    def join(self, room):
+        '''Handles a JOIN message, which adds the client to a room's subscribers.
+
+        The client is told that it has joined, and is then sent the newest page of the room's history. A client
+        that is rejoining after reconnecting also sends SEQ, and is sent the room's messages that it missed instead.
+        A client can be in up to MAX_ROOMS rooms at once.
+
+        args:
+            room (str): The name of the room, starting with #.
+
+        '''
+        if type(room) != str or not ROOM_NAME.match(room):
+            send_message({"ERROR": "Room names start with # and hold up to 32 letters, digits, - or _."}, self.session)
+        elif room not in self.session.rooms and len(self.session.rooms) >= MAX_ROOMS:
+            send_message({"ERROR": "You can be in up to {} rooms at once.".format(MAX_ROOMS)}, self.session)
+        elif not sessions.join(self.session, room):
+            send_message({"ERROR": "You are already in that room."}, self.session)
+        else:
+            if bus is not None and len(sessions.members(room)) == 1:
+                bus.subscribe(room)
+            send_message({"JOINED": room}, self.session)
+            send_history(None, self.session, room, sequence(self.request))
+
+    def leave(self, room):
+        '''Handles a LEAVE message, which removes the client from a room's subscribers.
+
+        args:
+            room (str): The name of the room, starting with #.
+
+        '''
+        if type(room) != str or not sessions.leave(self.session, room):
+            send_message({"ERROR": "You are not in that room."}, self.session)
+        else:
+            if not sessions.members(room):
+                room_emptied(room)
+            send_message({"LEFT": room}, self.session)
+
+    def resync(self, version):
+        '''Handles a PRESENCE message, which a client sends when it has missed a change to who is online.
+
+        args:
+            version (int): The last PRESENCE_VERSION that the client saw.
+
+        '''
+        send_large_message(presence.snapshot(), self.session)
+
+    def browser(self, browser_data):
+        '''Handles a BROWSER message, which asks the server for a search link (and optionally shares the search).
+
+        The username that the client sends is not trusted; a shared search is always announced under the name that
+        the client logged in with.
+
+        args:
+            browser_data (list): The search terms, the username of the searcher, and 1 if the search is shared.
+
+        '''
+        if type(browser_data) != list or len(browser_data) != 3 or browser_data[2] not in (0, 1):
+            send_message({"ERROR": "Message has incorrect type."}, self.session)
+        elif type(browser_data[0]) != str or not 0 < len(browser_data[0]) <= MAX_QUERY:
+            send_message({"ERROR": "Searches hold up to {} characters.".format(MAX_QUERY)}, self.session)
+        else:
+            username, query = self.session.username, browser_data[0]
+            send_message({"BROWSER": "https://www.google.com/search?q=" + urllib.parse.quote_plus(query)},
+                         self.session)
+            if browser_data[2] == 1:
+                log.info("{} has just searched the following: {}", username, query)
+                announce("{} has just searched the following: {}".format(username, query), sessions)
+
+    def messages(self, message_data):
+        '''Handles a MESSAGES message, which holds chat messages for other users.
+
+        args:
+            message_data (list): The messages, each as (sender, recipient, timestamp, text).
+
+        '''
+        send_mass_messages(message_data, self.session)
+
+    def ack(self, seq):
+        '''Handles an ACK message, which says that the client has received every message up to a sequence number.
+
+        Only direct messages need to be acknowledged to the offline queues, so the acknowledgement is only passed on
+        if a direct message has been sent to the client since its last one. If the client's outbox has ever had to
+        drop a frame, what it acknowledges may not include everything that it was sent, so its direct messages are
+        left queued, to be sent again when it next logs in.
+
+        args:
+            seq (int): The SEQ of the newest message that the client has received.
+
+        '''
+        session = self.session
+        if type(seq) != int:
+            send_message({"ERROR": "Sequence number is not correct."}, session)
+            return
+
+        now = time.monotonic()
+        while session.unacked and session.unacked[0][0] <= seq:
+            delivery_time.observe(now - session.unacked.popleft()[1])
+        if seq > session.acked:
+            if session.dm_seq > session.acked and not session.outbox.dropped:
+                acknowledge(session.username, min(seq, session.dm_seq))
+            session.acked = seq
+
+    handlers = {
+        "USERNAME": login,
+        "HISTORY": history,
+        "BROWSER": browser,
+        "MESSAGES": messages,
+        "JOIN": join,
+        "LEAVE": leave,
+        "PRESENCE": resync,
+        "SEARCH": search,
+        "ACK": ack,
+    }
+
+
+def end_session(address):
+    '''Used when a client disconnects, to log them out and tell everyone else that they have left.
+
+    args:
+        address (list): The host and port of the client that disconnected.
+
+    returns:
+        ended (bool): True if the client was logged in, or False if they had not picked a username yet.
+
+    '''
+    global sessions
+    session = sessions.remove(address)
+    if session is None:
+        return False
+
+    for room in session.rooms:
+        if not sessions.members(room):
+            room_emptied(room)
+
+    log.info('Connection with {} closed.', session.username)
+    if session.outbox is not None:
+        session.outbox.close()
+    if bus is not None:
+        bus.release(session.username)
+    else:
+        presence.leave(session.username)
+    return True
+
+
+def room_emptied(room):
+    '''Used once the last of our users has left a room, to close its store, or to unsubscribe from it on the bus
+    (which closes the store once no worker is subscribed to the room any more).'''
+    if bus is not None:
+        bus.unsubscribe(room)
+    else:
+        room_stores.release(room)
+
+
+def announce(info, recipients):
+    '''Used to send an INFO notice, such as a shared search, to everyone.
+
+    When running as one of several workers, the notice is also passed to the other workers through the
+    message bus, so that their users see it too.
+
+    args:
+        info (str): The notice to send.
+        recipients (iterable): The sessions on this server that should see the notice.
+
+    '''
+    broadcast({"INFO": info}, recipients, notice=True)
+    if bus is not None:
+        bus.notice(info)
+
+
+def send_mass_messages(message_data, session):
+    '''send_mass_messages is used to notify all online clients of an event.
+
+    send_mass_messages is utilized by the AsyncServer function, allowing it to parse clients messages,
+    add them to the message store (past messages), and send them to the correct users.
+
+    Clients may send any number of messages in one MESSAGES request. Every one of them is checked on its own,
+    so a bad message is answered with an error without losing the rest of the batch, and every good one is
+    stored and routed exactly once. Direct messages to someone who is not logged in are stored too, and wait in
+    their offline queue; the sender is told which of their messages were QUEUED. Direct messages to someone who has
+    never logged in are turned away.
+
+    args:
+        message_data (list): message_data is the message and it's data that the client has supplied us with.
+                             We can parse message_data to send the message to the right users.
+        session (obj): The session of the current client (the one who we have received the message from),
+                       so that we can send them user not found errors.
+
+    '''
+    global message_store
+    global sessions
+    if type(message_data) != list:
+        send_message({"ERROR": "Message has incorrect type."}, session)
+        return
+
+    stored = []
+    queued = {}
+    for i in message_data:
+        if not valid_message(i):
+            send_message({"ERROR": "Message has incorrect type."}, session)
+        elif session.username != i[0]:
+            send_message({"ERROR": "Source username is not correct."}, session)
+        elif i[1].startswith('#') and i[1] not in session.rooms:
+            send_message({"ERROR": "You are not in that room."}, session)
+        else:
+            session.last_active = time.time()
+            session.messages_sent += 1
+            messages_in.inc()
+            if bus is not None:
+                bus.publish(i)
+            elif i[1] == "ALL" or i[1].startswith('#') or i[1] in sessions:
+                stored.append((store_message(i), i))
+                print_message(i)
+            elif offline_queues.known(i[1]):
+                queued.setdefault(i[1], []).append(store_message(i))
+            else:
+                unknown_recipient(session.username, i[1])
+    deliver(stored)
+    for recipient, numbers in queued.items():
+        queued_messages(session.username, recipient, numbers)
+
+
+def valid_message(message):
+    '''Used to check that a message from a client is a (sender, recipient, timestamp, text) record.
+
+    The timestamp, in seconds since 1970, has to be below MAX_TIMESTAMP (some time in the year 6325), so that every
+    store can index it and every client can show it.
+
+    '''
+    return type(message) == list and len(message) == 4 and type(message[0]) == str and \
+        type(message[1]) == str and type(message[2]) == int and 0 <= message[2] < MAX_TIMESTAMP and \
+        type(message[3]) == str
+
+
+def sequence(request):
+    '''Used to get the SEQ of a request, the sequence number of the last message that a client saw, if it is valid.'''
+    seq = request.get("SEQ")
+    if type(seq) == int and seq >= -1:
+        return seq
+    return None
+
+
+def store_message(message):
+    '''Used to add a message to the message store, or to its room's store if it was sent to a room.
+
+    returns:
+        number (int): The message's sequence number, in whichever store it went to.
+
+    '''
+    if message[1].startswith('#'):
+        return room_stores.get(message[1]).append(message)
+    return message_store.append(message)
+
+
+def deliver(stored, only=None):
+    '''Used to send stored messages to whichever of our users they are for.
+
+    Each run of messages that are for the same recipient is sent as a single MESSAGES frame, so a batch of
+    messages to ALL is encoded once and written to each client once, rather than once per message. The frame
+    also holds the sequence number of the last message in it (as SEQ), and the ROOM if it is for a room. Each
+    frame that is sent from the main store is remembered by its SEQ until the client acknowledges it.
+
+    args:
+        stored (list): The sequence number and message of each message, with each message as
+                       (sender, recipient, timestamp, text), in the order they were stored.
+        only (obj): If given, the messages are only sent to this session (e.g. the ones that the bus handed over
+                    while it was being welcomed), rather than to everyone that they are for.
+
+    '''
+    everyone = sessions if only is None else [only]
+    for recipient, run in itertools.groupby(stored, key=lambda entry: entry[1][1]):
+        run = list(run)
+        frame = {"MESSAGES": [entry[1] for entry in run], "SEQ": run[-1][0]}
+        sent = (run[-1][0], time.monotonic())
+        if recipient == "ALL":
+            for j in everyone:
+                j.messages_received += len(run)
+                j.unacked.append(sent)
+            messages_out.inc(len(run) * len(everyone))
+            broadcast(frame, everyone)
+        elif recipient.startswith('#'):
+            frame["ROOM"] = recipient
+            members = sessions.members(recipient)
+            if only is not None:
+                members = [only] if only in members else []
+            for j in members:
+                j.messages_received += len(run)
+            messages_out.inc(len(run) * len(members))
+            broadcast(frame, members)
+        else:
+            session = sessions.find(recipient)
+            if session is not None and (only is None or session is only):
+                session.messages_received += len(run)
+                session.unacked.append(sent)
+                session.dm_seq = run[-1][0]
+                messages_out.inc(len(run))
+                send_message(frame, session)
+
+
+def deliver_from_bus(entry):
+    '''Used when running as a worker, with every message that the bus hands over, to deliver it.
+
+    The message is also kept for anyone whose username is being claimed, if it is for them, in case the bus
+    handed it over after answering their claim, but before they were welcomed (see AsyncServer.claim).
+
+    args:
+        entry (list): The message's sequence number, and the message itself.
+
+    '''
+    for username, buffered in pending.items():
+        if entry[1][1] in ("ALL", username):
+            buffered.append(entry)
+    deliver([entry])
+
+
+def acknowledge(username, seq):
+    '''Used when a client acknowledges a direct message, to take it out of their offline queue.
+
+    Whoever sent the direct messages that this acknowledges is told that they were DELIVERED. When running as one
+    of several workers, the offline queues are kept by the message bus, which tells the senders' workers.
+
+    args:
+        username (str): The user who acknowledged the messages.
+        seq (int): The SEQ of the newest message that they have received.
+
+    '''
+    if bus is not None:
+        bus.ack(username, seq)
+        return
+    for sender, numbers in offline_queues.ack(username, seq).items():
+        delivered_messages(sender, username, numbers)
+
+
+def queued_messages(sender, recipient, numbers):
+    '''Used to tell the sender of direct messages that their recipient is not logged in, so they were queued.
+
+    args:
+        sender (str): The user who sent the messages.
+        recipient (str): The user who they were sent to.
+        numbers (list): The sequence numbers of the messages.
+
+    '''
+    session = sessions.find(sender)
+    if session is not None:
+        send_message({"QUEUED": numbers, "TO": recipient}, session)
+
+
+def unknown_recipient(sender, recipient):
+    '''Used to tell the sender of a direct message that it was not sent, since no one has ever logged in as its
+    recipient.'''
+    session = sessions.find(sender)
+    if session is not None:
+        send_message({"ERROR": "No one has ever logged in as that user.", "TO": recipient}, session)
+
+
+def delivered_messages(sender, recipient, numbers):
+    '''Used to tell the sender of direct messages that their recipient has received them, if they are online.'''
+    session = sessions.find(sender)
+    if session is not None:
+        send_message({"DELIVERED": numbers, "TO": recipient}, session)
+
+
+def print_message(message):
+    '''Used to log messages to ALL on the server's command prompt as they are stored.'''
+    if message[1] == "ALL":
+        log.info("{} says: {}", message[0], message[3])
+
+
+def send_history(cursor, session, room=None, after=None):
+    '''Used to send a client the page of messages that comes before their history cursor.
+
+    args:
+        cursor (int): The HISTORY_CURSOR that the client was last given. Only messages older than this are sent.
+                      None sends the newest page, or the messages that the client missed if after is given.
+        session (obj): The session of the client that asked for their history.
+        room (str): The room whose history to send, or None for the client's own messages (to ALL and to them).
+        after (int): The sequence number of the last message that the client saw, or None.
+
+    '''
+    global message_store
+    if bus is not None:
+        asyncio.ensure_future(send_bus_history(cursor, session, room, after))
+        return
+
+    store, recipients = history_of(session, room)
+    if cursor is None:
+        numbers, cursor, latest, resumed = store.catch_up(recipients, after, HISTORY_PAGE, REPLAY_LIMIT)
+    else:
+        numbers, cursor = store.page(recipients, before=cursor, count=HISTORY_PAGE)
+        latest, resumed = None, False
+    send_large_message(history_message(list(store.read_many(numbers)), cursor, room, latest, resumed), session)
+
+
+async def send_bus_history(cursor, session, room=None, after=None):
+    '''Used when running as a worker, to fetch a page of history from the message bus and send it on.
+
+    args:
+        cursor (int): The HISTORY_CURSOR that the client was last given.
+        session (obj): The session of the client that asked for their history.
+        room (str): The room whose history to send, or None for the client's own messages.
+        after (int): The sequence number of the last message that the client saw, or None.
+
+    '''
+    messages, cursor, latest, resumed = await bus.history(session.username, cursor, HISTORY_PAGE, room, after)
+    send_large_message(history_message(messages, cursor, room, latest, resumed), session)
+
+
+def history_of(session, room=None):
+    '''Used to find where a client's history is kept.
+
+    args:
+        session (obj): The session of the client.
+        room (str): The room whose history is wanted, or None for the client's own messages.
+
+    returns:
+        store (obj): The MessageStore that the history is kept in.
+        recipients (tuple): The recipients whose messages in the store the client may see.
+
+    '''
+    if room is None:
+        return message_store, ('ALL', session.username)
+    return room_stores.get(room), (room,)
+
+
+def send_search(query, cursor, session, room=None):
+    '''Used to send a client the newest page of messages that hold every word of a search.
+
+    Only messages that the client could see in their history are searched: messages to ALL and to them, or the
+    messages of a room that they are in.
+
+    args:
+        query (str): The words to search for.
+        cursor (int): The SEARCH_CURSOR that the client was last given for this search, or None for the newest.
+        session (obj): The session of the client that is searching.
+        room (str): The room whose history to search, or None for the client's own messages.
+
+    '''
+    if bus is not None:
+        asyncio.ensure_future(send_bus_search(query, cursor, session, room))
+        return
+
+    start = time.perf_counter()
+    store, recipients = history_of(session, room)
+    numbers, cursor = store.search(recipients, query, before=cursor, count=SEARCH_PAGE)
+    messages = list(store.read_many(numbers))
+    search_time.observe(time.perf_counter() - start)
+    send_large_message(search_message(messages, query, cursor, room), session)
+
+
+async def send_bus_search(query, cursor, session, room=None):
+    '''Used when running as a worker, to ask the message bus for a page of search matches and send it on.
+
+    args:
+        query (str): The words to search for.
+        cursor (int): The SEARCH_CURSOR that the client was last given for this search, or None for the newest.
+        session (obj): The session of the client that is searching.
+        room (str): The room whose history to search, or None for the client's own messages.
+
+    '''
+    start = time.perf_counter()
+    messages, cursor = await bus.search(session.username, query, cursor, SEARCH_PAGE, room)
+    search_time.observe(time.perf_counter() - start)
+    send_large_message(search_message(messages, query, cursor, room), session)
+
+
+def search_message(messages, query, cursor, room):
+    '''Used to build a SEARCH_RESULTS answer, newest match first, which says which room it is for if it is for one.'''
+    message = {"SEARCH_RESULTS": messages, "QUERY": query, "SEARCH_CURSOR": cursor}
+    if room is not None:
+        message["ROOM"] = room
+    return message
+
+
+def history_message(messages, cursor, room, latest=None, resumed=False):
+    '''Used to build a HISTORY answer, which says which room it is for if it is for one.
+
+    The newest page also holds the sequence number of the newest message (as SEQ), and a page of messages that
+    the client missed while it was away is marked as RESUMED.
+
+    '''
+    message = {"HISTORY": messages, "HISTORY_CURSOR": cursor}
+    if room is not None:
+        message["ROOM"] = room
+    if latest is not None:
+        message["SEQ"] = latest
+    if resumed:
+        message["RESUMED"] = "true"
+    return message
+
+
+def restore_backup():
+    '''used by the server to restore messages.
+
+    contrary to its name, restore_backup does not restore backed up messages for all users, or even load them into
+    memory. Instead, it allows the server to print the latest page of past messages onto it's command prompt, so
+    that it does not have to read the whole history back from disk just to show it.
+
+    '''
+    global message_store
+
+    numbers, cursor = message_store.page(('ALL',), count=HISTORY_PAGE)
+    for i in message_store.read_many(numbers):
+        log.info("{} Said: {}", i[0], i[3])
+
+
+def flush_backup(loop):
+    '''Used to regularly write any batched messages out to the message store.
+
+    Without a writer (--commit-size 0), the message store only writes once it has a full batch of messages, so on a
+    quiet server this makes sure that nothing sits in memory for longer than FLUSH_INTERVAL seconds.
+
+    args:
+        loop (obj): The event loop that flush_backup reschedules itself on.
+
+    '''
+    try:
+        message_store.flush()
+        room_stores.flush()
+    except OSError as error:
+        store_error(error)
+    finally:
+        loop.call_later(FLUSH_INTERVAL, flush_backup, loop)
+
+
+def compact_history(loop):
+    '''Used to regularly expire old messages, and compact the segments that are due in every open store.
+
+    args:
+        loop (obj): The event loop that compact_history reschedules itself on, once compact_stores is done.
+
+    '''
+    asyncio.ensure_future(compact_stores(loop))
+
+
+async def compact_stores(loop):
+    '''Used to compact every segment that is due, one at a time, each on a thread from the loop's executor.
+
+    Only the stores of rooms that have been used since the server started are open, so only they are compacted.
+
+    args:
+        loop (obj): The event loop to run the compactions from.
+
+    '''
+    try:
+        for store in [message_store] + list(room_stores):
+            store.expire()
+            for start in store.compactable():
+                compaction = store.compaction(start)
+                size = await loop.run_in_executor(None, compaction.run)
+                compaction.finish()
+                compactions.inc()
+                log.info("Compacted {} into an archive of {} messages and {} bytes", compaction.source,
+                         len(compaction.numbers), size)
+    except OSError as error:
+        log.error("Could not compact the message history: {}", error)
+    finally:
+        loop.call_later(COMPACT_INTERVAL, compact_history, loop)
+
+
+def report_lagging(loop):
+    '''Used to regularly print out which clients are falling behind on the messages that we send them.
+
+    A client is lagging if their outbox is at least half full, or if frames have been dropped for them.
+
+    args:
+        loop (obj): The event loop that report_lagging reschedules itself on.
+
+    '''
+    for j in sessions:
+        if len(j.outbox) >= OUTBOX_LIMIT // 2 or j.outbox.dropped:
+            log.warning("{} is lagging: {} frames queued, {:.1f}s behind, {} frames dropped.",
+                        j.username, len(j.outbox), j.outbox.lag(), j.outbox.dropped)
+    loop.call_later(LAG_INTERVAL, report_lagging, loop)
+
+
+def send_message(message, writer):
+    '''Used to send messages to the client.
+
+    The basic, yet the most powerful function, allows us to send a message to a client.
+    Used in any other function that needs to communicate with the clients. It encrypts the supplied message,
+    attaches a 4 byte unsigned int that displays the length as a prefix, and sends the message.
+
+    args:
+        message (list): the raw message to be sent to the client, before being encoded.
+        writer (obj): the users writer that we are sending the message to. Once a user has logged in,
+                      this is their session, so that the message goes through their outbox.
+
+    '''
+    if isinstance(writer, Session):
+        writer.write(encode_message(message, writer.codec))
+    else:
+        writer.write(encode_message(message))
+
+
+def send_large_message(message, session):
+    '''Used to send a message that holds a page of history, such as the welcome message or a HISTORY answer.
+
+    Encoding (and compressing) a page of history is much slower than encoding a single chat message. When the
+    page holds at least OFFLOAD_MESSAGES messages, it is encoded on the encoder thread pool instead of the
+    event loop, so that live messages keep flowing to everyone else in the meantime. The session's outbox
+    keeps the frame's place in line until it is ready.
+
+    args:
+        message (dict): the raw message to be sent to the client, before being encoded.
+        session (obj): the session of the client that we are sending the message to.
+
+    '''
+    count = len(message.get("MESSAGES") or message.get("HISTORY") or message.get("SEARCH_RESULTS") or ())
+    if encoder is None or count < OFFLOAD_MESSAGES:
+        send_message(message, session)
+    else:
+        session.write(asyncio.ensure_future(encode_offloaded(message, session.codec)))
+
+
+async def encode_offloaded(message, codec):
+    '''Used to encode a message on the encoder thread pool. The metrics are not thread safe, so they are only
+    updated once the frame is back on the event loop.
+
+    args:
+        message (dict): the raw message to be sent, before being encoded.
+        codec (obj): the codec to encode the message with.
+
+    returns:
+        frame (bytes): the encoded message, prefixed with its length as a 4 byte unsigned int.
+
+    '''
+    frame, seconds = await asyncio.get_event_loop().run_in_executor(encoder, encode_timed, message, codec)
+    encode_time.observe(seconds)
+    frames_out.observe(len(frame))
+    return frame
+
+
+def encode_error(error):
+    log.error("Could not encode a message: {}", error)
+
+
+def report_handshakes(loop, last=0):
+    '''Used to regularly print out how many TLS handshakes there have been, and how many of them were resumed.
+
+    A resumed handshake (using a session ticket or the session cache) is much cheaper than a full one, which is
+    what keeps a storm of clients reconnecting at once from holding up everything else.
+
+    args:
+        loop (obj): The event loop that report_handshakes reschedules itself on.
+        last (int): How many handshakes there had been the last time that this was printed.
+
+    '''
+    if tls_stats['handshakes'] != last:
+        log.info("TLS handshakes: {} ({} resumed)", tls_stats['handshakes'], tls_stats['resumed'])
+    loop.call_later(LAG_INTERVAL, report_handshakes, loop, tls_stats['handshakes'])
+
+
+def flush_presence(loop, message_bus=None):
+    '''Used to regularly send everyone who has joined or left since the last time to every user, as one change.
+
+    When running with workers, this runs in the message bus's process, which keeps track of presence for all
+    of them, and hands each change to the workers instead.
+
+    args:
+        loop (obj): The event loop that flush_presence reschedules itself on.
+        message_bus (obj): The MessageBus, when running with workers.
+
+    '''
+    if message_bus is None:
+        delta = presence.flush()
+        if delta is not None:
+            broadcast(delta, sessions, notice=True)
+    else:
+        message_bus.flush_presence()
+    loop.call_later(PRESENCE_INTERVAL, flush_presence, loop, message_bus)
+
+
+def presence_changed(delta):
+    '''Used when running as a worker, to pass a change to presence from the message bus on to every user.
+
+    args:
+        delta (dict): The change, as USERS_JOINED, USERS_LEFT and PRESENCE_VERSION.
+
+    '''
+    presence.apply(delta)
+    broadcast(delta, sessions, notice=True)
+
+
+def measure_loop_lag(loop, expected=None):
+    '''Used to regularly measure how late the event loop is in running callbacks.
+
+    A busy or blocked event loop runs everything late, so the lag is a direct measure of how far behind the
+    server is. A moving average of it decides whether the server is overloaded, and should shed load.
+
+    args:
+        loop (obj): The event loop that measure_loop_lag reschedules itself on.
+        expected (float): The loop time at which this call was meant to run.
+
+    '''
+    if expected is not None:
+        lag = max(0.0, loop.time() - expected)
+        loop_lag.observe(lag)
+        was_overloaded = overloaded()
+        load['lag'] = load['lag'] * 0.75 + lag * 0.25
+        if overloaded() and not was_overloaded:
+            log.warning('The event loop is running {:.3f} seconds behind; shedding load.', load['lag'])
+        elif was_overloaded and not overloaded():
+            log.warning('The event loop has caught up; no longer shedding load.')
+    loop.call_at(loop.time() + LOOP_LAG_INTERVAL, measure_loop_lag, loop, loop.time() + LOOP_LAG_INTERVAL)
+
+
+def overloaded():
+    '''Used to find out whether the server is too far behind to take on more work, by the average event loop lag.'''
+    return SHED_LAG > 0 and load['lag'] > SHED_LAG
+
+
+def start_metrics(loop, port):
+    '''Used to start serving metrics and the profiler switch on 127.0.0.1, if a port was given with -m.
+
+    args:
+        loop (obj): The event loop to serve them on.
+        port (int): The port to serve them on, or None to not serve them at all.
+
+    returns:
+        server (obj): The metrics server, or None.
+
+    '''
+    measure_loop_lag(loop)
+    if port is None:
+        return None
+    server = loop.run_until_complete(loop.create_server(lambda: MetricsServer(metrics, profiler), '127.0.0.1', port))
+    log.info('Serving metrics at http://127.0.0.1:{}/metrics', port)
+    return server
+
+
+def encode_message(message, codec=JSON):
+    '''Used to turn a message into a frame that is ready to be written to a client.
+
+    args:
+        message (list): the raw message to be sent, before being encoded.
+        codec (obj): the codec to encode the message with. Clients that have not logged in yet always use JSON.
+
+    returns:
+        frame (bytes): the encoded message, prefixed with its length as a 4 byte unsigned int.
+
+    '''
+    frame, seconds = encode_timed(message, codec)
+    encode_time.observe(seconds)
+    frames_out.observe(len(frame))
+    return frame
+
+
+def encode_timed(message, codec):
+    '''Used to encode and frame a message, and time how long that takes, without touching the metrics, so that it
+    can be done on any thread.
+
+    returns:
+        frame (bytes): the encoded message, prefixed with its length as a 4 byte unsigned int.
+        seconds (float): how long it took to encode.
+
+    '''
+    start = time.perf_counter()
+    frame = encode_frame(codec.encode(message))
+    return frame, time.perf_counter() - start
+
+
+def broadcast(message, recipients, notice=False):
+    '''Used to send the same message to many clients at once.
+
+    The message is only encoded and framed once for each codec in use, and then the very same bytes object is
+    written to every recipient using that codec, so sending to a thousand users costs a thousand writes rather
+    than a thousand encodes.
+
+    args:
+        message (list): the raw message to be sent to the clients, before being encoded.
+        recipients (iterable): the sessions of the clients that we are sending the message to.
+        notice (bool): True if the message is only a notice, which slow clients may miss out on.
+
+    '''
+    frames = {}
+    for j in recipients:
+        frame = frames.get(j.codec)
+        if frame is None:
+            frame = frames[j.codec] = encode_message(message, j.codec)
+        j.write(frame, notice)
+
+
+def parse_command_line(message):
+    '''Called when we need to get args from the command line.
+
+    This function is used by the " if __name__ == '__main__' " condition, and gives it a list of user supplied arguments.
+
+    args:
+        message (str): The help message that is displayed when the user asks for help.
+
+    returns:
+        address (list): address is a list containing the host and port that we would like to setup the AsyncServer on.
+        args (obj): The rest of the parsed arguments, such as where the message history is kept.
+
+    '''
+    parser = argparse.ArgumentParser(message)
+    parser.add_argument('host', help='Hostname')
+    parser.add_argument('-p', metavar='port', type=int, default=1060, help='Port #')
+    parser.add_argument('-d', metavar='history', type=str, default='history', help='Message history folder')
+    parser.add_argument('-n', metavar='history_page', type=int, default=50,
+                        help='Number of past messages sent on joining, and per page of history')
+    parser.add_argument('-c', metavar='cache_size', type=int, default=10000,
+                        help='Number of the newest messages (per room, for rooms) to keep in memory, or 0 for none')
+    parser.add_argument('-q', metavar='outbox_limit', type=int, default=1000,
+                        help='Number of frames that can be queued for a slow client')
+    parser.add_argument('-l', metavar='slow_policy', type=str, default='drop_oldest',
+                        choices=('drop_oldest', 'coalesce', 'disconnect'),
+                        help='What to do with a slow client whose queue is full: drop_oldest, coalesce or disconnect')
+    parser.add_argument('-f', metavar='fsync', type=str, default='interval', choices=('always', 'interval', 'never'),
+                        help='When to fsync the message history: always (after each group written), interval or never')
+    parser.add_argument('-x', metavar='encoders', type=int, default=2,
+                        help='Number of threads that encode history pages off the event loop (0 to encode inline)')
+    parser.add_argument('-w', '--workers', metavar='workers', type=int, default=1,
+                        help='Number of worker processes to accept clients with (uses SO_REUSEPORT)')
+    parser.add_argument('-m', metavar='metrics_port', type=int, default=None,
+                        help='Port to serve metrics and the profiler on, on 127.0.0.1 (off by default)')
+    parser.add_argument('-v', metavar='log_level', type=str, default='info',
+                        choices=('debug', 'info', 'warning', 'error'),
+                        help='Least important messages to log: debug, info, warning or error')
+    parser.add_argument('--log-rate', metavar='log_rate', type=int, default=100,
+                        help='Most lines to log per second; the rest are counted and dropped')
+    parser.add_argument('--max-frame', metavar='max_frame', type=int, default=MAX_FRAME,
+                        help='Largest frame, in bytes, that a client may send')
+    parser.add_argument('--max-connections', metavar='max_connections', type=int, default=MAX_CONNECTIONS,
+                        help='Most connections to accept at once, per process (0 for no limit)')
+    parser.add_argument('--rate', metavar='rate', type=float, default=RATE,
+                        help='Requests (or chat messages) per second that each connection may send (0 for no limit)')
+    parser.add_argument('--ip-rate', metavar='ip_rate', type=float, default=IP_RATE,
+                        help='Requests per second that each IP address may send, per process (0 for no limit)')
+    parser.add_argument('--shed-lag', metavar='shed_lag', type=float, default=SHED_LAG,
+                        help='Event loop lag, in seconds, past which load is shed (0 to never shed load)')
+    parser.add_argument('--commit-ms', metavar='commit_ms', type=float, default=COMMIT_INTERVAL * 1000,
+                        help='Milliseconds that a message may wait for others to be written to disk along with it')
+    parser.add_argument('--commit-size', metavar='commit_size', type=int, default=COMMIT_SIZE,
+                        help='The most messages written to disk at once (0 to write on the event loop instead)')
+    parser.add_argument('--max-age', metavar='max_age', type=float, default=0,
+                        help='Days after which messages expire (0 to keep them forever)')
+    parser.add_argument('--max-count', metavar='max_count', type=int, default=0,
+                        help='Messages kept for each recipient, and in each room (0 to keep them all)')
+    parser.add_argument('--max-bytes', metavar='max_bytes', type=int, default=0,
+                        help='Bytes of messages kept in the history, and in each room (0 to keep them all)')
+    parser.add_argument('--archive-age', metavar='archive_age', type=float, default=ARCHIVE_AGE,
+                        help='Days after which old log segments are compressed into archives (0 to only compress '
+                             'them once most of their messages have expired)')
+    args = parser.parse_args()
+    address = (args.host, args.p)
+    return address, args
+
+
+def open_store_writer(loop, args):
+    '''Used to start the thread that writes messages to disk, unless --commit-size is 0.
+
+    args:
+        loop (obj): The event loop that the message stores are used from.
+        args (obj): The parsed command line arguments.
+
+    returns:
+        writer (obj): The StoreWriter, or None to write on the event loop instead.
+
+    '''
+    if args.commit_size <= 0:
+        return None
+    return StoreWriter(loop, args.commit_ms / 1000.0, args.commit_size, on_commit=store_committed,
+                       on_error=store_error)
+
+
+def store_committed(count, lag):
+    '''Called by the writer after every group of messages that it writes, to keep track of how far behind it is.'''
+    commit_lag.observe(lag)
+    if lag >= COMMIT_LAG_WARNING:
+        log.warning("Writing messages to disk is {:.2f} seconds behind", lag)
+
+
+def store_error(error):
+    log.error("Could not write messages to disk: {}", error)
+
+
+def store_options(args):
+    '''Used to get the options that every MessageStore is opened with, from the command line arguments.'''
+    return dict(fsync=args.f, on_write=write_time.observe, cache_size=args.c, writer=writer, max_age=args.max_age * DAY,
+                max_count=args.max_count, max_bytes=args.max_bytes, archive_age=args.archive_age * DAY)
+
+
+def open_message_store(args):
+    '''Used to open the message store, importing an old style backup.txt the first time.
+
+    args:
+        args (obj): The parsed command line arguments.
+
+    returns:
+        message_store (obj): The opened MessageStore.
+
+    '''
+    start = time.perf_counter()
+    store = MessageStore(args.d, **store_options(args))
+    log.info("Opened the message store with {} messages in {:.3f} seconds", len(store), time.perf_counter() - start)
+    if len(store) == 0:
+        try:
+            log.info("Imported {} messages from backup.txt", store.import_backup('backup.txt'))
+        except IOError:
+            pass
+    if len(store) > 0:
+        log.info("Waiting for client to connect to resume session...")
+    return store
+
+
+def open_room_stores(args):
+    '''Used to open the stores that hold each room's messages, in the rooms folder of the history folder.
+
+    args:
+        args (obj): The parsed command line arguments.
+
+    returns:
+        room_stores (obj): The RoomStores.
+
+    '''
+    return RoomStores(os.path.join(args.d, 'rooms'), **store_options(args))
+
+
+def create_ssl_context():
+    '''Used to create the SSL context that clients connect to us with.
+
+    Session tickets and the server side session cache are both on by default, so a client that reconnects with
+    the session from its last connection resumes it, skipping the expensive part of the handshake. The ticket
+    keys belong to the context, which is why the workers all share one. asyncio cannot offer a session when it
+    connects, so only clients with blocking sockets (like the benchmark's storm workload) can resume.
+
+    '''
+    purpose = ssl.Purpose.CLIENT_AUTH
+    context = ssl.create_default_context(purpose, cafile="ca.crt")
+    context.load_cert_chain('localhost.pem')
+    return context
+
+
+def run_server(address, args):
+    '''Used to run the whole server in this process, which is what happens unless --workers is given.
+
+    args:
+        address (list): The host and port to listen on.
+        args (obj): The parsed command line arguments.
+
+    '''
+    global message_store
+    global room_stores
+    global offline_queues
+    global writer
+    global encoder
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    writer = open_store_writer(loop, args)
+    message_store = open_message_store(args)
+    room_stores = open_room_stores(args)
+    offline_queues = OfflineQueues(message_store)
+    if args.x > 0:
+        encoder = ThreadPoolExecutor(args.x)
+
+    coro = loop.create_server(AsyncServer, *address, ssl=create_ssl_context())
+    server = loop.run_until_complete(coro)
+    log.info('Listening at {}', address)
+
+    admin = start_metrics(loop, args.m)
+    loop.call_later(FLUSH_INTERVAL, flush_backup, loop)
+    loop.call_later(PRESENCE_INTERVAL, flush_presence, loop)
+    loop.call_later(COMPACT_INTERVAL, compact_history, loop)
+    loop.call_later(LAG_INTERVAL, report_lagging, loop)
+    loop.call_later(LAG_INTERVAL, report_handshakes, loop)
+
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        if admin is not None:
+            admin.close()
+        offline_queues.close()
+        message_store.close()
+        room_stores.close()
+        if writer is not None:
+            writer.close()
+        loop.close()
+        log.close()
+
+
+def run_workers(address, args):
+    '''Used to run the server as several worker processes that share one listening port.
+
+    The parent process forks the workers, and then becomes the message bus. It owns the message store, and
+    every worker connects to it over a Unix socket in the history folder. Each worker listens on the same
+    address with SO_REUSEPORT, so the operating system spreads new clients across them.
+
+    args:
+        address (list): The host and port to listen on.
+        args (obj): The parsed command line arguments.
+
+    '''
+    global message_store
+    global room_stores
+    global offline_queues
+    global writer
+    os.makedirs(args.d, exist_ok=True)
+    bus_path = os.path.join(args.d, 'bus.sock')
+    if os.path.exists(bus_path):
+        os.remove(bus_path)
+
+    bus_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    bus_socket.bind(bus_path)
+    bus_socket.listen(args.workers)
+
+    context = create_ssl_context()
+    workers = []
+    for i in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            bus_socket.close()
+            if args.m is not None:
+                args.m += 1 + i
+            try:
+                run_worker(address, args, bus_path, context)
+            finally:
+                os._exit(0)
+        workers.append(pid)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    writer = open_store_writer(loop, args)
+    message_store = open_message_store(args)
+    room_stores = open_room_stores(args)
+    offline_queues = OfflineQueues(message_store)
+
+    def first_claim(username):
+        global backup_loaded
+        if backup_loaded == 0:
+            restore_backup()
+            backup_loaded = 1
+
+    message_bus = MessageBus(message_store, room_stores, offline_queues, on_claim=first_claim,
+                             on_publish=print_message)
+    server = loop.run_until_complete(loop.create_unix_server(message_bus.connection, sock=bus_socket))
+    log.info('Listening at {} with {} workers', address, args.workers)
+
+    admin = start_metrics(loop, args.m)
+    loop.call_later(FLUSH_INTERVAL, flush_backup, loop)
+    loop.call_later(PRESENCE_INTERVAL, flush_presence, loop, message_bus)
+    loop.call_later(COMPACT_INTERVAL, compact_history, loop)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
+    try:
+        loop.run_forever()
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in workers:
+            os.waitpid(pid, 0)
+        server.close()
+        if admin is not None:
+            admin.close()
+        offline_queues.close()
+        message_store.close()
+        room_stores.close()
+        if writer is not None:
+            writer.close()
+        os.remove(bus_path)
+        loop.close()
+        log.close()
+
+
+def run_worker(address, args, bus_path, context):
+    '''Used in each worker process, to accept clients and pass their messages through the message bus.
+
+    The SSL context is made before the workers are forked, so they all share its session ticket keys, and a
+    client can resume its TLS session whichever worker it reconnects to (the session cache is still per worker).
+
+    args:
+        address (list): The host and port to listen on.
+        args (obj): The parsed command line arguments.
+        bus_path (str): The location of the message bus's Unix socket.
+        context (obj): The SSL context to accept clients with.
+
+    '''
+    global bus
+    global encoder
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if args.x > 0:
+        encoder = ThreadPoolExecutor(args.x)
+
+    bus = BusClient(deliver_from_bus, lambda info: broadcast({"INFO": info}, sessions, notice=True),
+                    lambda value: queued_messages(*value), lambda value: unknown_recipient(*value),
+                    lambda value: delivered_messages(*value), presence_changed)
+    loop.run_until_complete(loop.create_unix_connection(lambda: bus, bus_path))
+
+    coro = loop.create_server(AsyncServer, *address, ssl=context, reuse_port=True)
+    server = loop.run_until_complete(coro)
+    admin = start_metrics(loop, args.m)
+    loop.call_later(LAG_INTERVAL, report_lagging, loop)
+    loop.call_later(LAG_INTERVAL, report_handshakes, loop)
+
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        if admin is not None:
+            admin.close()
+        loop.close()
+        log.close()
+
+
+if __name__ == '__main__':
+    '''
+    Here we read the command line, and either run the server in this process,
+    or fork worker processes and become their message bus.
+    '''
+
+    address, args = parse_command_line('Async Server')
+    HISTORY_PAGE = args.n
+    OUTBOX_LIMIT = args.q
+    OUTBOX_POLICY = args.l
+    MAX_FRAME = args.max_frame
+    MAX_CONNECTIONS = args.max_connections
+    RATE = args.rate
+    SHED_LAG = args.shed_lag
+    ip_limits = RateLimiter(args.ip_rate, 2 * args.ip_rate)
+    log = Logger(args.v, args.log_rate)
+
+    if args.workers > 1:
+        run_workers(address, args)
+    else:
+        run_server(address, args)
@@ -0,0 +1,400 @@
+"""Benchmark.py
+
+usage: Benchmark [-h] [-p port] [-c clients] [-b broadcasts] [-s storm] [-H history_sizes]
+                 [-j joins] [-e codec] [-w workers] [-o output] [-k]
+
+Example:
+    > python Benchmark.py -c 1000 -b 20 -H 0,10000,100000 -o results.json
+
+Description:
+    Starts an AsyncServer on localhost (with an empty message history in a temporary folder), and drives it with
+    many synthetic clients from a single process. The clients speak the same protocol as the AsyncClient, over
+    TLS with the bundled certificates, but never touch the terminal.
+
+    The benchmark runs these workloads, in order:
+        join:       every client connects and logs in; the time to be welcomed is measured for each of them.
+        broadcast:  a handful of clients each send a message to ALL; the time until every other client has it is
+                    measured (the fan-out latency), along with how many deliveries per second the server managed.
+        dm:         every client sends a direct message to the next one; the delivery latency is measured.
+        storm:      a crowd of other clients each connect once, and then all reconnect at the same time, offering
+                    the TLS session from their first connection; how many handshakes were resumed is counted,
+                    and messages to ALL keep being sent throughout, to measure live latency during the storm.
+        leave:      every client disconnects.
+        history:    the history is filled up to each of the given sizes with messages to ALL, which every newcomer
+                    can see, and then a few new clients join, to show how the time to join grows with the size of
+                    the history. This runs once the other clients have left, so that seeding it is not a broadcast
+                    to all of them.
+
+    The server's resident memory is sampled after each workload. Everything is printed as a summary, and saved as
+    JSON so that runs can be compared with each other.
+
+"""
+
+import os
+import sys
+import ssl
+import json
+import time
+import socket
+import shutil
+import asyncio
+import argparse
+import tempfile
+import resource
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from FrameDecoder import FrameDecoder, encode_frame
+from Codec import JSON, CODECS
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SEED_BATCH = 500
+STORM_THREADS = 64
+STORM_TICK = 0.05
+
+
+class BenchClient(object):
+    '''A headless chat client, used by the benchmark to stand in for a real user.
+
+    Args:
+        bench (obj): The Benchmark that the client belongs to; every chat message that it receives is reported
+                     back to it, so that delivery latency can be measured.
+
+        user (str): The username to log in with.
+
+    '''
+
+    def __init__(self, bench, user):
+        self.bench = bench
+        self.user = user
+        self.codec = JSON
+        self.decoder = FrameDecoder()
+        self.welcomed = None
+
+    async def join(self):
+        '''Used to connect and log in.
+
+        returns:
+            join_time (float): The number of seconds from starting to connect until the server welcomed us.
+
+        '''
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(
+            'localhost', self.bench.port, ssl=self.bench.context, server_hostname='localhost')
+        self.welcomed = asyncio.get_event_loop().create_future()
+        self.task = asyncio.ensure_future(self.receive())
+        self.send({"USERNAME": self.user, "CODECS": [self.bench.codec]})
+        await self.welcomed
+        return time.perf_counter() - start
+
+    def send(self, message):
+        self.writer.write(encode_frame(self.codec.encode(message)))
+
+    def say(self, recipient, key):
+        '''Used to send a chat message whose text is a key that the benchmark can look its send time up by.'''
+        self.bench.sent_at[key] = time.perf_counter()
+        self.send({"MESSAGES": [[self.user, recipient, int(time.time()), key]]})
+
+    async def receive(self):
+        '''The task that reads everything that the server sends us.'''
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                for frame in self.decoder.feed(data):
+                    response = self.codec.decode(frame)
+                    if "USERNAME_ACCEPTED" in response:
+                        self.codec = CODECS.get(response.get("CODEC"), JSON)
+                        if not self.welcomed.done():
+                            self.welcomed.set_result(response)
+                    elif "MESSAGES" in response:
+                        for message in response["MESSAGES"]:
+                            self.bench.received(message[3])
+        except (ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            if self.welcomed is not None and not self.welcomed.done():
+                self.welcomed.set_exception(ConnectionError('server closed the connection'))
+
+    async def leave(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
+        self.task.cancel()
+
+
+class Benchmark(object):
+    '''Runs the workloads against a server, and collects the results.
+
+    Args:
+        args (obj): The parsed command line arguments.
+
+    '''
+
+    def __init__(self, args):
+        self.args = args
+        self.port = args.p
+        self.codec = args.e
+        self.sent_at = {}
+        self.latencies = []
+        self.expected = 0
+        self.done = None
+        self.results = {}
+
+        self.context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=os.path.join(HERE, 'ca.crt'))
+        if args.k:
+            self.context.check_hostname = False
+            self.context.verify_mode = ssl.CERT_NONE
+
+    def received(self, key):
+        '''Called by every client for every chat message that it receives.'''
+        sent = self.sent_at.get(key)
+        if sent is not None:
+            self.latencies.append(time.perf_counter() - sent)
+            if self.done is not None and len(self.latencies) >= self.expected and not self.done.done():
+                self.done.set_result(None)
+
+    def expect(self, count):
+        '''Used to start counting received chat messages, before a workload sends count of them.'''
+        self.latencies = []
+        self.expected = count
+        self.done = asyncio.get_event_loop().create_future()
+
+    async def wait(self, timeout):
+        '''Used to wait until every expected chat message has been received, or timeout seconds have passed.'''
+        try:
+            await asyncio.wait_for(asyncio.shield(self.done), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def reconnect(self, user, session=None):
+        '''Used on a thread, by the storm workload, to connect, log in and disconnect again.
+
+        asyncio has no way to offer a TLS session when it connects, so this uses a blocking socket instead.
+
+        args:
+            user (str): The username to log in with.
+            session (obj): The SSLSession from an earlier connection to resume, if any.
+
+        returns:
+            join_time (float): The number of seconds from starting to connect until the server welcomed us.
+            session (obj): The connection's SSLSession, to resume the next time.
+            resumed (bool): True if the handshake resumed the session that was offered.
+
+        '''
+        start = time.perf_counter()
+        with socket.create_connection(('localhost', self.port)) as raw:
+            with self.context.wrap_socket(raw, server_hostname='localhost', session=session) as sock:
+                sock.sendall(encode_frame(JSON.encode({"USERNAME": user})))
+                decoder = FrameDecoder()
+                while True:
+                    data = sock.recv(65536)
+                    if not data:
+                        raise ConnectionError('server closed the connection')
+                    for frame in decoder.feed(data):
+                        if "USERNAME_ACCEPTED" in JSON.decode(frame):
+                            return time.perf_counter() - start, sock.session, sock.session_reused
+
+    def start_server(self):
+        '''Used to start the server in its own process, with an empty history, and wait until it is listening.
+
+        Every client comes from the same address, and the point is to push the server as hard as possible, so its
+        rate limits, connection cap and load shedding are all turned off.
+
+        '''
+        self.history = tempfile.mkdtemp(prefix='chat-bench-')
+        command = [sys.executable, os.path.join(HERE, 'AsyncServer.py'), 'localhost', '-p', str(self.port),
+                   '-d', self.history, '-n', str(self.args.n), '-w', str(self.args.w),
+                   '--rate', '0', '--ip-rate', '0', '--max-connections', '0', '--shed-lag', '0']
+        self.server = subprocess.Popen(command, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('localhost', self.port), timeout=0.5).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError('the server did not start listening on port {}'.format(self.port))
+
+    def stop_server(self):
+        self.server.terminate()
+        self.server.wait()
+        shutil.rmtree(self.history, ignore_errors=True)
+
+    def server_rss(self):
+        '''Used to find the server's resident memory, including any worker processes, in kilobytes.'''
+        total = 0
+        pids = [self.server.pid]
+        while pids:
+            pid = pids.pop()
+            try:
+                with open('/proc/{}/status'.format(pid)) as status:
+                    for line in status:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1])
+                for task in os.listdir('/proc/{}/task'.format(pid)):
+                    with open('/proc/{}/task/{}/children'.format(pid, task)) as children:
+                        pids.extend(int(child) for child in children.read().split())
+            except (IOError, ValueError):
+                pass
+        return total
+
+    def record(self, name, **values):
+        values['server_rss_kb'] = self.server_rss()
+        self.results[name] = values
+        print('{:>10}: {}'.format(name, ', '.join('{}={}'.format(key, value) for key, value in values.items())))
+
+    async def run(self):
+        clients = [BenchClient(self, 'bench{}'.format(i)) for i in range(self.args.c)]
+        limit = asyncio.Semaphore(200)
+
+        async def join(client):
+            async with limit:
+                return await client.join()
+
+        start = time.perf_counter()
+        join_times = await asyncio.gather(*[join(client) for client in clients])
+        self.record('join', clients=len(clients), seconds=round(time.perf_counter() - start, 3),
+                    **percentiles(join_times))
+
+        self.expect(self.args.b * len(clients))
+        start = time.perf_counter()
+        for i in range(self.args.b):
+            clients[i % len(clients)].say('ALL', 'broadcast:{}'.format(i))
+        await self.wait(60)
+        elapsed = time.perf_counter() - start
+        self.record('broadcast', messages=self.args.b, delivered=len(self.latencies), expected=self.expected,
+                    deliveries_per_second=round(len(self.latencies) / elapsed, 1), **percentiles(self.latencies))
+
+        self.expect(len(clients))
+        start = time.perf_counter()
+        for i, client in enumerate(clients):
+            client.say(clients[(i + 1) % len(clients)].user, 'dm:{}'.format(i))
+        await self.wait(60)
+        elapsed = time.perf_counter() - start
+        self.record('dm', delivered=len(self.latencies), expected=self.expected,
+                    messages_per_second=round(len(self.latencies) / elapsed, 1), **percentiles(self.latencies))
+
+        loop = asyncio.get_event_loop()
+        pool = ThreadPoolExecutor(STORM_THREADS)
+        users = ['storm{}'.format(i) for i in range(self.args.s)]
+        first = await asyncio.gather(*[loop.run_in_executor(pool, self.reconnect, user) for user in users])
+
+        # The live messages are counted for as long as the storm lasts, rather than up to an expected number.
+        self.latencies = []
+        self.done = None
+        start = time.perf_counter()
+        storm = asyncio.gather(*[loop.run_in_executor(pool, self.reconnect, user + 'again', session)
+                                 for user, (_, session, _) in zip(users, first)])
+        sent = 0
+        while not storm.done():
+            clients[sent % len(clients)].say('ALL', 'storm:{}'.format(sent))
+            sent += 1
+            await asyncio.sleep(STORM_TICK)
+        elapsed = time.perf_counter() - start
+        again = await storm
+        await asyncio.sleep(1)
+        pool.shutdown()
+        self.record('storm', reconnects=len(again), resumed=sum(resumed for _, _, resumed in again),
+                    seconds=round(elapsed, 3), reconnect=percentiles([seconds for seconds, _, _ in again]),
+                    live_messages=sent, live=percentiles(self.latencies))
+
+        start = time.perf_counter()
+        await asyncio.gather(*[client.leave() for client in clients])
+        self.record('leave', seconds=round(time.perf_counter() - start, 3))
+
+        seeder = BenchClient(self, 'seeder')
+        await seeder.join()
+        stored = self.args.b + sent
+        history = []
+        for size in self.args.H:
+            while stored < size:
+                batch = min(SEED_BATCH, size - stored)
+                seeder.send({"MESSAGES": [[seeder.user, 'ALL', int(time.time()), 'seed']] * batch})
+                stored += batch
+                await seeder.writer.drain()
+            self.expect(1)
+            seeder.say('ALL', 'seeded:{}'.format(size))
+            stored += 1
+            await self.wait(60)
+
+            newcomers = [BenchClient(self, 'history{}x{}'.format(size, i)) for i in range(self.args.j)]
+            times = [await newcomer.join() for newcomer in newcomers]
+            history.append(dict(history_size=stored, **percentiles(times)))
+            for newcomer in newcomers:
+                await newcomer.leave()
+        self.record('history', sizes=history)
+        await seeder.leave()
+
+
+def percentiles(samples):
+    '''Used to summarise a list of timings, in milliseconds.
+
+    args:
+        samples (list): The timings, in seconds.
+
+    returns:
+        summary (dict): The p50, p90, p99 and max of the timings, in milliseconds.
+
+    '''
+    if not samples:
+        return {'p50_ms': None, 'p90_ms': None, 'p99_ms': None, 'max_ms': None}
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {'p50_ms': at(0.5), 'p90_ms': at(0.9), 'p99_ms': at(0.99), 'max_ms': round(ordered[-1] * 1000, 3)}
+
+
+def parse_command_line(message):
+    '''Called when we need to get args from the command line.
+
+    args:
+        message (str): The help message that is displayed when the user asks for help.
+
+    returns:
+        args (obj): The parsed arguments.
+
+    '''
+    parser = argparse.ArgumentParser(message)
+    parser.add_argument('-p', metavar='port', type=int, default=1061, help='Port # to run the server on')
+    parser.add_argument('-c', metavar='clients', type=int, default=500, help='Number of synthetic clients')
+    parser.add_argument('-b', metavar='broadcasts', type=int, default=10, help='Number of messages sent to ALL')
+    parser.add_argument('-s', metavar='storm', type=int, default=500, help='Number of clients that reconnect at once')
+    parser.add_argument('-H', metavar='history_sizes', type=lambda text: [int(size) for size in text.split(',')],
+                        default=[0, 10000, 100000], help='History sizes to measure join time at, e.g. 0,10000')
+    parser.add_argument('-j', metavar='joins', type=int, default=5, help='Number of joins to time at each size')
+    parser.add_argument('-n', metavar='history_page', type=int, default=50, help="The server's history page size")
+    parser.add_argument('-e', metavar='codec', type=str, default='json', help='Codec for the clients to ask for')
+    parser.add_argument('-w', metavar='workers', type=int, default=1, help="Number of server worker processes")
+    parser.add_argument('-o', metavar='output', type=str, default='bench_results.json', help='Where to save results')
+    parser.add_argument('-k', action='store_true', help="Don't verify the server's certificate")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    '''
+    Here we raise the open file limit (every client needs a socket), start the server, run every workload,
+    and save the results.
+    '''
+
+    args = parse_command_line('Benchmark')
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    bench = Benchmark(args)
+    bench.start_server()
+    try:
+        asyncio.run(bench.run())
+    finally:
+        bench.stop_server()
+
+    with open(args.o, 'w') as output:
+        json.dump({'config': vars(args), 'time': time.time(), 'results': bench.results}, output, indent=2)
+    print('Saved results to {}'.format(args.o))
@@ -0,0 +1,424 @@
+"""ChatClient.py
+
+Description:
+    The ChatClient is everything that a client of the chat server needs, without a terminal: it connects and logs in,
+    talks to the server with whichever codec it agreed on, batches outgoing chat messages, keeps track of who is
+    online, of sequence numbers and of history cursors, and when the connection is lost, it reconnects and is sent
+    whatever it missed. Everything that the server sends is handed on through an async iterator:
+
+        client = ChatClient('steven')
+        await client.connect('localhost', 1060, context)
+        await client.send('ALL', 'Hello everyone!')
+        async for response in client.messages():
+            print(response.get("MESSAGES"))
+
+    AsyncClient.py, the terminal client, is built on it, and so can bots, bridges and load tests, which can run as
+    many clients as they like in a single process.
+
+    Sending is pipelined: send() and the other requests return as soon as the request has been handed to the
+    connection, without waiting for an answer. There is flow control in both directions. If the server is not
+    keeping up with what we send (or we are reconnecting), send() waits until it can go on. If the program is not
+    keeping up with what the server sends, we stop reading from the connection once max_pending responses are
+    waiting to be picked up, and the server's outbox takes care of the rest.
+
+    Whatever we receive is acknowledged with an ACK holding the newest SEQ that we have seen, so that the server
+    knows which direct messages have reached us. Acknowledgements are held back for ACK_DELAY seconds, so a burst of
+    messages is acknowledged once.
+
+"""
+
+import time
+import random
+import asyncio
+
+from FrameDecoder import FrameDecoder, encode_frame
+from Codec import JSON, CODECS
+
+
+RECONNECT_MIN = 0.5
+RECONNECT_MAX = 30
+ACK_DELAY = 0.05
+
+
+class LoginRefused(Exception):
+    '''Raised by ChatClient.connect() when the server does not let us log in, with the server's reason.'''
+
+
+class ChatClient(asyncio.Protocol):
+    '''A connection to the chat server, as a single user.
+
+    Along with the server's own responses, messages() hands on a few of the client's own, which have keys that the
+    server never sends:
+        {"DISCONNECTED": info}      The connection was lost, because of info.
+        {"RECONNECTING": seconds}   We will try to reconnect in this many seconds.
+        {"RECONNECT_FAILED": info}  An attempt to reconnect did not work, because of info.
+    Once we have reconnected, the server's answer to our login (with USERNAME_ACCEPTED) is handed on as well.
+
+    Args:
+        username (str): The username to log in with.
+
+        codecs (list): The codecs that we can talk to the server with, most preferred first. The server picks
+                       one while we log in; until then, everything is sent as JSON.
+
+        batch_window (float): Chat messages are held back for this many seconds, so that any others sent in the
+                              meantime can be sent along with them in a single MESSAGES request.
+
+        max_pending (int): How many responses can be waiting to be picked up from messages() before we stop
+                           reading from the connection.
+
+        reconnect (bool): Whether to reconnect when the connection is lost.
+
+    '''
+
+    def __init__(self, username, codecs=('binary+zlib', 'json'), batch_window=0.01, max_pending=1000,
+                 reconnect=True):
+        self.username = username
+        self.codecs = list(codecs)
+        self.batch_window = batch_window
+        self.max_pending = max_pending
+        self.reconnect = reconnect
+
+        self.transport = None
+        self.address = None
+        self.decoder = FrameDecoder()
+        self.codec = JSON
+        self.connected = False
+        self.closing = False
+        self.server = None
+        self.backoff = RECONNECT_MIN
+        self.reconnecting = False
+        self.login = None
+
+        self.seq = None
+        self.acked = -1
+        self.ack_handle = None
+        self.room_seqs = {}
+        self.history_cursor = None
+        self.room_cursors = {}
+        self.last_search = None
+        self.users = set()
+        self.presence_version = 0
+
+        self.pending = []
+        self.writable = asyncio.Event()
+        self.responses = asyncio.Queue()
+        self.reading_paused = False
+
+    @property
+    def rooms(self):
+        '''The rooms that we have joined.'''
+        return list(self.room_seqs)
+
+    async def connect(self, host, port, context):
+        '''Used to connect to the server and log in. The same host, port and SSL context are used to reconnect.
+
+        args:
+            host (str): The server's hostname.
+            port (int): The server's port.
+            context (obj): The SSL context to connect with.
+
+        returns:
+            welcome (dict): The server's answer to our login, with the USER_LIST, and the latest MESSAGES.
+
+        raises:
+            LoginRefused: If the server would not let us log in, e.g. because the username is already in use.
+            OSError: If we could not connect to the server.
+
+        '''
+        self.server = (host, port, context)
+        self.closing = False
+        return await self._connect()
+
+    async def _connect(self):
+        loop = asyncio.get_event_loop()
+        self.login = loop.create_future()
+        await loop.create_connection(lambda: self, *self.server[:2], ssl=self.server[2])
+        return await self.login
+
+    async def _reconnect(self):
+        '''Used after losing the connection, to keep trying to connect again until it works.
+
+        The wait between attempts doubles after every attempt, up to RECONNECT_MAX seconds, and is shortened by
+        a random amount, so that many clients that lost their connection at once do not all come back at once.
+
+        '''
+        self.reconnecting = True
+        try:
+            while not self.closing:
+                delay = self.backoff * random.uniform(0.5, 1.0)
+                self.backoff = min(self.backoff * 2, RECONNECT_MAX)
+                self._deliver({"RECONNECTING": delay})
+                await asyncio.sleep(delay)
+                if self.closing:
+                    return
+                try:
+                    await self._connect()
+                    return
+                except (OSError, LoginRefused) as error:
+                    self._deliver({"RECONNECT_FAILED": str(error)})
+        finally:
+            self.reconnecting = False
+
+    async def close(self):
+        '''Used to log out. Anything that is still waiting in the batch is sent first, and messages() ends.'''
+        self.closing = True
+        self.flush_messages()
+        if self.transport is not None:
+            self.transport.close()
+        self.responses.put_nowait(None)
+
+    def connection_made(self, transport):
+        '''Used by asyncio once we have connected, to log in.'''
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        self.decoder = FrameDecoder()
+        self.codec = JSON
+        self.connected = False
+        self.reading_paused = False
+
+        message_data = {"USERNAME": self.username, "CODECS": self.codecs}
+        if self.seq is not None:
+            message_data["SEQ"] = self.seq
+        self.write(message_data)
+
+    def connection_lost(self, exc):
+        '''Used by asyncio when the connection is closed. Unless we are logging out, we start to reconnect.'''
+        was_connected = self.connected
+        self.connected = False
+        self.writable.clear()
+        if self.login is not None and not self.login.done():
+            self.login.set_exception(ConnectionError('The connection was closed while logging in.'))
+        if was_connected and not self.closing:
+            self._deliver({"DISCONNECTED": str(exc) if exc is not None else "The server closed the connection."})
+            if self.reconnect and not self.reconnecting:
+                asyncio.ensure_future(self._reconnect())
+            elif not self.reconnect:
+                self.responses.put_nowait(None)
+
+    def pause_writing(self):
+        '''Used by asyncio when the connection's write buffer is full, so that send() waits for it to drain.'''
+        self.writable.clear()
+
+    def resume_writing(self):
+        if self.connected:
+            self.writable.set()
+
+    def data_received(self, data):
+        for frame in self.decoder.feed(data):
+            response = self.codec.decode(frame)
+            if not self.connected:
+                self.login_received(response)
+            else:
+                self.response_received(response)
+
+    def login_received(self, response):
+        '''Called with the server's answer to our USERNAME message.
+
+        A client that logs in again after reconnecting is RESUMED, and is sent just the messages it missed; then
+        it rejoins its rooms, and sends whatever was sent while it was reconnecting.
+
+        args:
+            response (dict): The USERNAME_ACCEPTED response from the server.
+
+        '''
+        if response.get("USERNAME_ACCEPTED") != "true":
+            self.transport.close()
+            if not self.login.done():
+                self.login.set_exception(LoginRefused(response.get("INFO", "No info provided.")))
+            return
+
+        self.connected = True
+        self.backoff = RECONNECT_MIN
+        self.codec = CODECS.get(response.get("CODEC"), JSON)
+        self.users = set(response.get("USER_LIST", ()))
+        self.presence_version = response.get("PRESENCE_VERSION", 0)
+        if response.get("RESUMED") == "true":
+            self.seq = max(self.seq, response.get("SEQ", -1))
+        else:
+            self.history_cursor = response.get("HISTORY_CURSOR")
+            self.seq = response.get("SEQ", -1)
+        self.acked = -1
+        self.schedule_ack()
+
+        if self.reconnecting:
+            self._deliver(response)
+        if not self.login.done():
+            self.login.set_result(response)
+        self.writable.set()
+
+        for room, seq in self.room_seqs.items():
+            self.write({"JOIN": room, "SEQ": seq})
+        self.flush_messages()
+
+    def response_received(self, response):
+        '''Called with every message that the server sends us once we are logged in, to keep track of sequence
+        numbers, cursors and presence before it is handed on to messages().
+
+        A change in presence that is older than the one we have already seen is not handed on. If we have missed a
+        change, we ask the server for a snapshot of everyone who is online with a PRESENCE message.
+
+        args:
+            response (dict): The message from the server.
+
+        '''
+        room = response.get("ROOM")
+        if "SEQ" in response:
+            if room is None:
+                self.seq = max(self.seq, response["SEQ"])
+                self.schedule_ack()
+            else:
+                self.room_seqs[room] = max(self.room_seqs.get(room, -1), response["SEQ"])
+
+        if "JOINED" in response:
+            self.room_seqs.setdefault(response["JOINED"], -1)
+        if "LEFT" in response:
+            self.room_cursors.pop(response["LEFT"], None)
+            self.room_seqs.pop(response["LEFT"], None)
+
+        if "HISTORY" in response and response.get("RESUMED") != "true":
+            if room is None:
+                self.history_cursor = response.get("HISTORY_CURSOR")
+            else:
+                self.room_cursors[room] = response.get("HISTORY_CURSOR")
+
+        if "SEARCH_RESULTS" in response:
+            self.last_search = (response.get("QUERY"), room, response.get("SEARCH_CURSOR"))
+
+        if "PRESENCE_VERSION" in response:
+            version = response["PRESENCE_VERSION"]
+            if "USER_LIST" in response:
+                self.users = set(response["USER_LIST"])
+            elif version <= self.presence_version:
+                return
+            else:
+                self.users.update(response.get("USERS_JOINED", ()))
+                self.users.difference_update(response.get("USERS_LEFT", ()))
+                if version != self.presence_version + 1:
+                    self.write({"PRESENCE": self.presence_version})
+            self.presence_version = version
+
+        self._deliver(response)
+
+    def schedule_ack(self):
+        '''Used to acknowledge everything up to our newest SEQ in ACK_DELAY seconds, unless that is already set up.'''
+        if self.ack_handle is None and self.seq is not None and self.seq > self.acked:
+            self.ack_handle = asyncio.get_event_loop().call_later(ACK_DELAY, self.send_ack)
+
+    def send_ack(self):
+        self.ack_handle = None
+        if self.connected and self.seq > self.acked:
+            self.acked = self.seq
+            self.write({"ACK": self.seq})
+
+    def _deliver(self, response):
+        '''Used to hand a response on to messages(), and to stop reading if too many are waiting.'''
+        self.responses.put_nowait(response)
+        if self.responses.qsize() >= self.max_pending and not self.reading_paused and self.transport is not None:
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+    async def messages(self):
+        '''Used to get everything that the server sends us, in order, for as long as we are logged in.
+
+        returns:
+            responses (async generator): Each response from the server, as a dict.
+
+        '''
+        while True:
+            response = await self.responses.get()
+            if response is None:
+                return
+            if self.reading_paused and self.responses.qsize() <= self.max_pending // 2:
+                self.reading_paused = False
+                if not self.transport.is_closing():
+                    self.transport.resume_reading()
+            yield response
+
+    def write(self, message_data):
+        '''Used to encode a message with the codec agreed on with the server, frame it, and send it straight away.'''
+        self.transport.write(encode_frame(self.codec.encode(message_data)))
+
+    async def request(self, message_data):
+        '''Used to send any request to the server, once it can take it. Anything waiting in the batch is sent
+        first, so that nothing is reordered.
+
+        args:
+            message_data (dict): The request, e.g. {"JOIN": "#team"}.
+
+        '''
+        await self.writable.wait()
+        self.flush_messages()
+        self.write(message_data)
+
+    async def send(self, to, text):
+        '''Used to send a chat message, batched together with any others sent within the batch window.
+
+        args:
+            to (str): The username of the recipient, a room (starting with #), or ALL.
+            text (str): The message itself.
+
+        '''
+        await self.writable.wait()
+        self.pending.append([self.username, to, int(time.time()), text])
+        if len(self.pending) == 1:
+            asyncio.get_event_loop().call_later(self.batch_window, self.flush_messages)
+
+    def flush_messages(self):
+        '''Used to send every chat message that is waiting in the batch, as one MESSAGES request.
+
+        While the client is reconnecting, messages are kept until it has logged in again.
+
+        '''
+        if self.pending and self.connected:
+            message_data = {"MESSAGES": self.pending}
+            self.pending = []
+            self.write(message_data)
+
+    async def join(self, room):
+        await self.request({"JOIN": room})
+
+    async def leave(self, room):
+        await self.request({"LEAVE": room})
+
+    async def more(self, room=None):
+        '''Used to ask for the page of messages before the oldest one we have seen, for us or for a room.
+
+        returns:
+            sent (bool): False if there are no older messages to ask for.
+
+        '''
+        cursor = self.history_cursor if room is None else self.room_cursors.get(room)
+        if cursor is None:
+            return False
+        message_data = {"HISTORY": cursor}
+        if room is not None:
+            message_data["ROOM"] = room
+        await self.request(message_data)
+        return True
+
+    async def search(self, query, room=None):
+        '''Used to ask for the newest messages that hold every word of a search, in our messages or in a room.'''
+        message_data = {"SEARCH": query}
+        if room is not None:
+            message_data["ROOM"] = room
+        await self.request(message_data)
+
+    async def search_more(self):
+        '''Used to ask for older matches of the last search.
+
+        returns:
+            sent (bool): False if there are no more matches to ask for.
+
+        '''
+        if self.last_search is None or self.last_search[2] is None:
+            return False
+        query, room, cursor = self.last_search
+        message_data = {"SEARCH": query, "SEARCH_CURSOR": cursor}
+        if room is not None:
+            message_data["ROOM"] = room
+        await self.request(message_data)
+        return True
+
+    async def browser(self, query, share=False):
+        '''Used to ask the server for a search link, optionally telling everyone what we searched for.'''
+        await self.request({"BROWSER": (query, self.username, 1 if share else 0)})
@@ -0,0 +1,298 @@
+"""Codec.py
+
+Description:
+    A codec decides how a message (a dict such as {"MESSAGES": [...]}) is turned into the bytes inside a frame, and
+    back again. The client lists the codecs that it understands, in order of preference, in the CODECS part of its
+    USERNAME message; the server picks the first one that it also understands, and says which in the CODEC part of
+    its USERNAME_ACCEPTED answer. Everything before that point (and everything with a client that does not send
+    CODECS at all) uses plain JSON, so older clients keep working.
+
+    The codecs are:
+        json:   UTF-8 JSON, the original format, which can also carry non-ASCII chat text.
+        binary: A compact tagged binary format. Chat messages, the (sender, recipient, timestamp, text) records
+                that make up most of the traffic, are packed as a fixed header and three length prefixed strings.
+    Either of them can have +zlib added to the end of its name, in which case any frame bigger than
+    COMPRESS_THRESHOLD bytes (large history pages, mostly) is compressed with zlib. A frame is never decompressed
+    past the max_size that it is decoded with, so a small frame can not inflate into an enormous one.
+
+"""
+
+import json
+import zlib
+import struct
+
+
+COMPRESS_THRESHOLD = 512
+MAX_DEPTH = 32
+INT_RANGE = range(-2 ** 63, 2 ** 63)
+
+INT = struct.Struct('!q')
+FLOAT = struct.Struct('!d')
+LENGTH = struct.Struct('!I')
+RECORD = struct.Struct('!qIII')
+
+
+class JsonCodec(object):
+    '''Encodes messages as UTF-8 JSON.'''
+
+    name = 'json'
+
+    def encode(self, message):
+        '''Used to turn a message into bytes.
+
+        args:
+            message (dict): The message to encode.
+
+        returns:
+            payload (bytes): The encoded message.
+
+        '''
+        return json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, payload, max_size=None):
+        '''Used to turn bytes back into a message.
+
+        args:
+            payload (bytes): The encoded message.
+            max_size (int): Only used by CompressedCodec; an uncompressed payload is already as big as it gets.
+
+        returns:
+            message (dict): The decoded message.
+
+        raises:
+            ValueError: If the payload is not valid JSON, or is nested too deeply to decode.
+
+        '''
+        try:
+            return json.loads(payload)
+        except RecursionError:
+            raise ValueError('invalid JSON message: nested too deeply')
+
+
+class BinaryCodec(object):
+    '''Encodes messages in a compact tagged binary format.
+
+    Lists and dicts may be nested up to MAX_DEPTH deep. Every value starts with a one byte tag saying what it is:
+        N, T, F:  None, True and False.
+        i:        an 8 byte signed int.
+        f:        an 8 byte float.
+        s:        a 4 byte length, then that many bytes of UTF-8 text.
+        l, d:     a 4 byte count, then that many values (for a list) or key, value pairs (for a dict).
+        r:        a chat message; an 8 byte timestamp and the lengths of the sender, recipient and text,
+                  then the UTF-8 sender, recipient and text themselves.
+
+    '''
+
+    name = 'binary'
+
+    def encode(self, message):
+        '''Used to turn a message into bytes.
+
+        args:
+            message (dict): The message to encode.
+
+        returns:
+            payload (bytes): The encoded message.
+
+        raises:
+            TypeError: If the message holds a value that has no tag, such as a set.
+            ValueError: If the message holds an int that does not fit in 8 bytes.
+
+        '''
+        out = bytearray()
+        self._encode(message, out)
+        return bytes(out)
+
+    def _encode(self, value, out):
+        if value is None:
+            out += b'N'
+        elif value is True:
+            out += b'T'
+        elif value is False:
+            out += b'F'
+        elif type(value) == int:
+            if value not in INT_RANGE:
+                raise ValueError('cannot encode {}, ints must fit in 8 bytes'.format(value))
+            out += b'i'
+            out += INT.pack(value)
+        elif type(value) == float:
+            out += b'f'
+            out += FLOAT.pack(value)
+        elif type(value) == str:
+            text = value.encode('utf-8')
+            out += b's'
+            out += LENGTH.pack(len(text))
+            out += text
+        elif type(value) in (list, tuple):
+            if len(value) == 4 and type(value[0]) == str and type(value[1]) == str and type(value[2]) == int \
+                    and value[2] in INT_RANGE and type(value[3]) == str:
+                sender = value[0].encode('utf-8')
+                recipient = value[1].encode('utf-8')
+                text = value[3].encode('utf-8')
+                out += b'r'
+                out += RECORD.pack(value[2], len(sender), len(recipient), len(text))
+                out += sender
+                out += recipient
+                out += text
+            else:
+                out += b'l'
+                out += LENGTH.pack(len(value))
+                for item in value:
+                    self._encode(item, out)
+        elif type(value) == dict:
+            out += b'd'
+            out += LENGTH.pack(len(value))
+            for key, item in value.items():
+                self._encode(key, out)
+                self._encode(item, out)
+        else:
+            raise TypeError('cannot encode a {}'.format(type(value).__name__))
+
+    def decode(self, payload, max_size=None):
+        '''Used to turn bytes back into a message.
+
+        args:
+            payload (bytes): The encoded message.
+            max_size (int): Only used by CompressedCodec; an uncompressed payload is already as big as it gets.
+
+        returns:
+            message (dict): The decoded message.
+
+        raises:
+            ValueError: If the payload is not a valid encoded message.
+
+        '''
+        try:
+            value, offset = self._decode(memoryview(payload), 0, 0)
+        except (IndexError, TypeError, struct.error, ValueError) as error:
+            raise ValueError('invalid binary message: {}'.format(error))
+        if offset != len(payload):
+            raise ValueError('invalid binary message: trailing bytes')
+        return value
+
+    def _decode(self, view, offset, depth):
+        tag = view[offset:offset + 1].tobytes()
+        offset += 1
+        if tag == b'N':
+            return None, offset
+        if tag == b'T':
+            return True, offset
+        if tag == b'F':
+            return False, offset
+        if tag == b'i':
+            return INT.unpack_from(view, offset)[0], offset + INT.size
+        if tag == b'f':
+            return FLOAT.unpack_from(view, offset)[0], offset + FLOAT.size
+        if tag == b's':
+            length = LENGTH.unpack_from(view, offset)[0]
+            offset += LENGTH.size
+            if offset + length > len(view):
+                raise IndexError('string runs past the end of the message')
+            return str(view[offset:offset + length], 'utf-8'), offset + length
+        if tag == b'r':
+            timestamp, sender_length, recipient_length, text_length = RECORD.unpack_from(view, offset)
+            offset += RECORD.size
+            fields = []
+            for length in (sender_length, recipient_length, text_length):
+                if offset + length > len(view):
+                    raise IndexError('message runs past the end of the frame')
+                fields.append(str(view[offset:offset + length], 'utf-8'))
+                offset += length
+            return [fields[0], fields[1], timestamp, fields[2]], offset
+        if tag in (b'l', b'd') and depth == MAX_DEPTH:
+            raise ValueError('nested more than {} deep'.format(MAX_DEPTH))
+        if tag == b'l':
+            count = LENGTH.unpack_from(view, offset)[0]
+            offset += LENGTH.size
+            items = []
+            for i in range(count):
+                item, offset = self._decode(view, offset, depth + 1)
+                items.append(item)
+            return items, offset
+        if tag == b'd':
+            count = LENGTH.unpack_from(view, offset)[0]
+            offset += LENGTH.size
+            items = {}
+            for i in range(count):
+                key, offset = self._decode(view, offset, depth + 1)
+                items[key], offset = self._decode(view, offset, depth + 1)
+            return items, offset
+        raise IndexError('unknown tag {!r}'.format(tag))
+
+
+class CompressedCodec(object):
+    '''Wraps another codec, compressing any frame that is bigger than COMPRESS_THRESHOLD bytes with zlib.
+
+    Every payload starts with one byte saying whether the rest is compressed (1) or not (0). Each frame is
+    compressed on its own, so that a broadcast can still be encoded once and sent to every client.
+
+    Args:
+        codec (obj): The codec that messages are encoded with before they are compressed.
+
+        level (int): The zlib compression level, from 1 (fastest) to 9 (smallest).
+
+    '''
+
+    def __init__(self, codec, level=6):
+        self.codec = codec
+        self.level = level
+        self.name = codec.name + '+zlib'
+
+    def encode(self, message):
+        payload = self.codec.encode(message)
+        if len(payload) > COMPRESS_THRESHOLD:
+            return b'\x01' + zlib.compress(payload, self.level)
+        return b'\x00' + payload
+
+    def decode(self, payload, max_size=None):
+        '''Used to turn bytes back into a message, decompressing them first if they were compressed.
+
+        args:
+            payload (bytes): The encoded message.
+            max_size (int): The most bytes that the payload may decompress to, or None for no limit.
+
+        returns:
+            message (dict): The decoded message.
+
+        raises:
+            ValueError: If the payload is not a valid encoded message, or decompresses to more than max_size bytes.
+
+        '''
+        if payload[:1] == b'\x01':
+            decompressor = zlib.decompressobj()
+            try:
+                payload = decompressor.decompress(payload[1:], max_size or 0)
+            except zlib.error as error:
+                raise ValueError('invalid compressed message: {}'.format(error))
+            if decompressor.unconsumed_tail:
+                raise ValueError('compressed message is larger than {} bytes'.format(max_size))
+            return self.codec.decode(payload)
+        return self.codec.decode(payload[1:])
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+
+CODECS = {
+    'json': JSON,
+    'binary': BINARY,
+    'json+zlib': CompressedCodec(JSON),
+    'binary+zlib': CompressedCodec(BINARY),
+}
+
+
+def negotiate(offered):
+    '''Used by the server to pick a codec from the ones that a client has offered.
+
+    args:
+        offered (list): The names of the codecs that the client understands, most preferred first.
+
+    returns:
+        codec (obj): The first offered codec that the server understands, or JSON if there are none.
+
+    '''
+    if type(offered) == list:
+        for name in offered:
+            if type(name) == str and name in CODECS:
+                return CODECS[name]
+    return JSON
@@ -0,0 +1,74 @@
+"""Column.py
+
+Description:
+    A Column is a growable run of numbers of a single type, like an array, whose start can be a read-only view of
+    a memory-mapped file instead. The MessageStore and the SearchIndex keep their indexes in Columns, so that when
+    they are opened, everything up to their last snapshot is mapped from it rather than read in, and only what has
+    been added since then is kept in memory.
+
+"""
+
+import itertools
+from array import array
+
+
+class Column(object):
+    '''One column of an index, such as the offset of every message, or every message number sent to a recipient.
+
+    The start of the column can be mapped from a snapshot, and is read-only; anything appended after that is
+    kept in an array in memory. Either part may be empty.
+
+    Args:
+        typecode (str): The array typecode of the numbers in the column, e.g. 'Q'.
+
+        mapped (obj): The start of the column, as a memoryview of the snapshot cast to typecode.
+
+    '''
+
+    def __init__(self, typecode, mapped=None):
+        self.mapped = mapped if mapped is not None else memoryview(b'').cast(typecode)
+        self.tail = array(typecode)
+
+    def __len__(self):
+        return len(self.mapped) + len(self.tail)
+
+    def __iter__(self):
+        return itertools.chain(self.mapped, self.tail)
+
+    def __getitem__(self, index):
+        if type(index) == slice:
+            start, stop, step = index.indices(len(self))
+            split = len(self.mapped)
+            mapped = self.mapped[start:min(stop, split)].tolist()
+            return mapped + self.tail[max(0, start - split):max(0, stop - split)].tolist()
+        if index < 0:
+            index += len(self)
+        if index < len(self.mapped):
+            return self.mapped[index]
+        return self.tail[index - len(self.mapped)]
+
+    def append(self, value):
+        self.tail.append(value)
+
+    def write(self, output, length=None):
+        '''Used to write the column (or its first length numbers), in the machine's own byte order, to a file opened
+        for binary writing. Only reads the column, so it can be done on another thread while the column grows.'''
+        if length is None:
+            length = len(self)
+        output.write(self.mapped[:length])
+        output.write(self.tail[:max(0, length - len(self.mapped))])
+
+    def remapped(self, mapped):
+        '''Used once the start of the column has been snapshotted, to get a copy of the column that maps that start
+        from the snapshot, and keeps only what comes after it in memory.
+
+        args:
+            mapped (obj): The start of the column, as a memoryview of the snapshot cast to the column's typecode.
+
+        returns:
+            column (obj): The new Column.
+
+        '''
+        column = Column(self.tail.typecode, mapped)
+        column.tail = self.tail[len(mapped) - len(self.mapped):]
+        return column
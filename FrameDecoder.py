@@ -0,0 +1,90 @@
+"""FrameDecoder.py
+
+Description:
+    Both the server and the client send each message as a frame: a 4 byte unsigned int holding the length of the
+    message, followed by the message itself. TCP does not keep these frames apart, so a single read can hold half of
+    a frame, exactly one frame, or several frames at once. The FrameDecoder collects whatever has been read so far
+    and hands back every frame that is complete, keeping the rest until more data arrives.
+
+    The length of a frame comes from whoever is on the other end of the connection, so the FrameDecoder can be given
+    a largest frame size. A frame that says it is larger than that is refused as soon as its length has arrived,
+    before any of it is buffered.
+
+"""
+
+import struct
+
+
+HEADER = struct.Struct('!I')
+
+
+class FrameTooLarge(ValueError):
+    '''Raised by FrameDecoder.feed() when a frame says that it is larger than the decoder's max_size.'''
+
+
+class FrameDecoder(object):
+    '''Turns a stream of bytes into complete, length prefixed frames.
+
+    Data is collected in a single bytearray. Complete frames are sliced out of it with a memoryview, and the
+    bytes that have been used up are only removed once per call to feed(), so a large frame that arrives over
+    many reads is never copied more than a couple of times.
+
+    Args:
+        max_size (int): The largest frame, in bytes, that the decoder accepts, or None for no limit.
+
+    '''
+
+    def __init__(self, max_size=None):
+        self.buffer = bytearray()
+        self.max_size = max_size
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def feed(self, data):
+        '''Used to add newly received data, and get back every frame that has now been completed.
+
+        args:
+            data (bytes): The data that was just read from the connection.
+
+        returns:
+            frames (list): The body of every complete frame, in the order they were sent. This is empty
+                           if the data did not complete a frame.
+
+        raises:
+            FrameTooLarge: If a frame says that it is larger than max_size. The connection can not be trusted to
+                           be in step any more after that, and should be closed.
+
+        '''
+        self.buffer += data
+        frames = []
+        start = 0
+        end = len(self.buffer)
+
+        with memoryview(self.buffer) as view:
+            while end - start >= HEADER.size:
+                length = HEADER.unpack_from(view, start)[0]
+                if self.max_size is not None and length > self.max_size:
+                    raise FrameTooLarge('a frame of {} bytes is larger than {} bytes'.format(length, self.max_size))
+                if end - start - HEADER.size < length:
+                    break
+                start += HEADER.size
+                frames.append(bytes(view[start:start + length]))
+                start += length
+
+        if start:
+            del self.buffer[:start]
+        return frames
+
+
+def encode_frame(payload):
+    '''Used to put a length prefix in front of a message, turning it into a frame.
+
+    args:
+        payload (bytes): The encoded message.
+
+    returns:
+        frame (bytes): The 4 byte length of the message, followed by the message.
+
+    '''
+    return HEADER.pack(len(payload)) + payload
@@ -0,0 +1,121 @@
+"""Logger.py
+
+Description:
+    Printing straight to the console from the event loop means that every connection, message and search waits on
+    the terminal, which gets slow once there are many clients. The Logger takes over from print(): lines are handed
+    to a background thread that does the writing, lines below the chosen level are never even formatted, and once
+    more than rate lines have been logged in a second, the rest of that second's lines are dropped and counted
+    instead, so a flood of messages can not bury the server in console output.
+
+    The levels are, from most to least detailed: debug, info, warning and error.
+
+"""
+
+import os
+import sys
+import time
+import queue
+import threading
+
+
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+
+class Logger(object):
+    '''A leveled, rate limited logger that writes on a background thread.
+
+    Args:
+        level (str): The least important level that is logged; one of debug, info, warning or error.
+
+        rate (int): The most lines that are logged in any one second. Warnings and errors are never dropped.
+
+        stream (obj): The file that lines are written to.
+
+    '''
+
+    def __init__(self, level='info', rate=100, stream=sys.stdout):
+        if level not in LEVELS:
+            raise ValueError('log level must be one of {}'.format(', '.join(LEVELS)))
+
+        self.level = LEVELS[level]
+        self.rate = rate
+        self.stream = stream
+        self.lines = queue.SimpleQueue()
+        self.window = 0
+        self.logged = 0
+        self.dropped = 0
+        self.thread = None
+        self.pid = None
+
+    def log(self, level, message, *args):
+        '''Used to log a line.
+
+        args:
+            level (str): How important the line is.
+            message (str): The line, which is only formatted with args if it is actually going to be logged.
+
+        '''
+        if LEVELS[level] < self.level:
+            return
+
+        now = int(time.time())
+        if now != self.window:
+            if self.dropped:
+                self._write('{} lines were not logged, to keep up.'.format(self.dropped))
+            self.window = now
+            self.logged = 0
+            self.dropped = 0
+
+        if self.logged >= self.rate and LEVELS[level] < LEVELS['warning']:
+            self.dropped += 1
+            return
+
+        self.logged += 1
+        self._write(message.format(*args) if args else message)
+
+    def debug(self, message, *args):
+        self.log('debug', message, *args)
+
+    def info(self, message, *args):
+        self.log('info', message, *args)
+
+    def warning(self, message, *args):
+        self.log('warning', message, *args)
+
+    def error(self, message, *args):
+        self.log('error', message, *args)
+
+    def _write(self, line):
+        '''Used to hand a line to the writing thread, starting it first if this process does not have one yet.
+
+        Threads do not survive a fork, so a worker process starts its own the first time that it logs anything.
+
+        '''
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.lines = queue.SimpleQueue()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.lines.put(line)
+
+    def _run(self):
+        '''The thread that writes lines out, a whole backlog at a time.'''
+        while True:
+            lines = [self.lines.get()]
+            while not self.lines.empty():
+                lines.append(self.lines.get())
+            finished = None in lines
+            if finished:
+                lines = lines[:lines.index(None)]
+            self.stream.write(''.join(line + '\n' for line in lines))
+            self.stream.flush()
+            if finished:
+                return
+
+    def close(self):
+        '''Used when the server shuts down, to write out any lines that are still waiting.'''
+        if self.thread is not None and self.pid == os.getpid():
+            self.lines.put(None)
+            self.thread.join()
+            self.thread = None
+            self.pid = None
@@ -0,0 +1,434 @@
+"""MessageBus.py
+
+Description:
+    When the server is started with more than one worker process, each worker only knows about the clients that
+    connected to it. The MessageBus ties the workers together. It runs in the parent process, owns the message
+    store, and listens on a Unix socket that every worker connects to with a BusClient.
+
+    Workers ask the bus before letting anyone log in, so that a username is only ever used once across all of
+    them, and send every chat message to the bus instead of delivering it themselves. The bus is the only thing
+    that writes to the message store, so messages are stored once and in a single order, and it then hands each
+    message to the workers that have a recipient for it: every worker for a message to ALL, or just the worker
+    that the recipient is connected to for a direct message. A message to a room is handed to the workers that
+    have subscribed to it, because at least one of their users has joined it.
+
+    A direct message to someone who is not logged in anywhere is stored all the same, in their offline queue (see
+    OfflineQueues), which the bus also owns, unless they have never logged in at all, in which case it is turned
+    away. Workers pass on their users' acknowledgements (ACK) to it, and it tells
+    the worker that the sender of each acknowledged direct message is logged in to, if any.
+
+    The bus also keeps track of presence (who is online, on any worker). Every so often, flush_presence() sends
+    everyone who has joined or left since the last time to every worker, which passes it on to its users.
+
+    Everything on the bus is sent in the same length prefixed frames as everything else, encoded as JSON.
+
+"""
+
+import asyncio
+import itertools
+
+from FrameDecoder import FrameDecoder, encode_frame
+from Codec import JSON
+from Presence import Presence
+
+
+class BusConnection(asyncio.Protocol):
+    '''The bus's end of the connection with a single worker.
+
+    Args:
+        bus (obj): The MessageBus that this connection belongs to.
+
+    '''
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.decoder = FrameDecoder()
+        self.usernames = set()
+        self.rooms = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.bus.workers.add(self)
+
+    def connection_lost(self, exc):
+        '''Called when a worker goes away; everyone who was logged in through it is logged out.'''
+        self.bus.workers.discard(self)
+        for username in self.usernames:
+            if self.bus.owners.get(username) is self:
+                del self.bus.owners[username]
+                self.bus.presence.leave(username)
+        for room in list(self.rooms):
+            self.unsubscribe(room)
+
+    def data_received(self, data):
+        for frame in self.decoder.feed(data):
+            request = JSON.decode(frame)
+            for key, value in request.items():
+                self.handlers[key](self, value)
+
+    def send(self, message):
+        self.transport.write(encode_frame(JSON.encode(message)))
+
+    def claim(self, value):
+        '''Handles a CLAIM request, which a worker sends before it lets a user log in.
+
+        args:
+            value (list): The id of the request, the username, how many past messages to send them, and the number
+                          of the last message that they saw before reconnecting (or None).
+
+        '''
+        request_id, username, count, after = value
+        if username in self.bus.owners:
+            self.send({"CLAIMED": [request_id, False, None, None, None, False, None]})
+            return
+
+        self.bus.owners[username] = self
+        self.bus.presence.join(username)
+        self.usernames.add(username)
+        if self.bus.on_claim is not None:
+            self.bus.on_claim(username)
+
+        store = self.bus.message_store
+        numbers, cursor, latest, resumed = store.catch_up(('ALL', username), after, count)
+        offline = self.bus.offline_queues.queued(username, skip=numbers)
+        self.send({"CLAIMED": [request_id, True, list(store.read_many(numbers)), cursor, latest, resumed,
+                               list(store.read_many(offline))]})
+
+    def release(self, username):
+        '''Handles a RELEASE request, which a worker sends when a user logs out.'''
+        if self.bus.owners.get(username) is self:
+            del self.bus.owners[username]
+            self.bus.presence.leave(username)
+        self.usernames.discard(username)
+
+    def publish(self, message):
+        '''Handles a PUBLISH request, which holds a chat message that a user has sent.'''
+        self.bus.publish(message, self)
+
+    def ack(self, value):
+        '''Handles an ACK request, which a worker sends when one of its users acknowledges a direct message.
+
+        args:
+            value (list): The username, and the number of the newest message that they have received.
+
+        '''
+        username, number = value
+        for sender, numbers in self.bus.offline_queues.ack(username, number).items():
+            owner = self.bus.owners.get(sender)
+            if owner is not None:
+                owner.send({"DELIVERED": [sender, username, numbers]})
+
+    def notice(self, info):
+        '''Handles a NOTICE request, an INFO message that every other worker should pass on to its users.'''
+        frame = encode_frame(JSON.encode({"NOTICE": info}))
+        for worker in self.bus.workers:
+            if worker is not self:
+                worker.transport.write(frame)
+
+    def history(self, value):
+        '''Handles a HISTORY request, which asks for the page of a user's messages before a cursor.
+
+        Without a cursor, it asks for whatever a user should be sent on joining a room instead (see
+        MessageStore.catch_up).
+
+        args:
+            value (list): The id of the request, the username, the cursor, the most messages to send, the
+                          room (or None for the user's own messages), and the number of the last message that the
+                          user saw (or None).
+
+        '''
+        request_id, username, before, count, room, after = value
+        if room is None:
+            store = self.bus.message_store
+            recipients = ('ALL', username)
+        else:
+            store = self.bus.room_stores.get(room)
+            recipients = (room,)
+
+        if before is None:
+            numbers, cursor, latest, resumed = store.catch_up(recipients, after, count)
+        else:
+            numbers, cursor = store.page(recipients, before=before, count=count)
+            latest, resumed = None, False
+        messages = list(store.read_many(numbers))
+        if room is not None:
+            self.bus.release_unused(room)
+        self.send({"HISTORY": [request_id, messages, cursor, latest, resumed]})
+
+    def search(self, value):
+        '''Handles a SEARCH request, which asks for the newest of a user's messages (or a room's messages) that hold
+        every word of a search.
+
+        args:
+            value (list): The id of the request, the username, the words to search for, the cursor (or None for
+                          the newest matches), the most messages to send, and the room (or None for the user's own
+                          messages).
+
+        '''
+        request_id, username, query, before, count, room = value
+        if room is None:
+            store = self.bus.message_store
+            recipients = ('ALL', username)
+        else:
+            store = self.bus.room_stores.get(room)
+            recipients = (room,)
+
+        numbers, cursor = store.search(recipients, query, before=before, count=count)
+        messages = list(store.read_many(numbers))
+        if room is not None:
+            self.bus.release_unused(room)
+        self.send({"SEARCH": [request_id, messages, cursor]})
+
+    def subscribe(self, room):
+        '''Handles a SUBSCRIBE request, which a worker sends when the first of its users joins a room.'''
+        self.rooms.add(room)
+        self.bus.rooms.setdefault(room, set()).add(self)
+
+    def unsubscribe(self, room):
+        '''Handles an UNSUBSCRIBE request, which a worker sends when the last of its users leaves a room. Once no
+        worker is subscribed to the room, its store is closed.'''
+        self.rooms.discard(room)
+        workers = self.bus.rooms.get(room)
+        if workers is not None:
+            workers.discard(self)
+            if not workers:
+                del self.bus.rooms[room]
+                self.bus.room_stores.release(room)
+
+    handlers = {
+        "CLAIM": claim,
+        "RELEASE": release,
+        "PUBLISH": publish,
+        "ACK": ack,
+        "NOTICE": notice,
+        "HISTORY": history,
+        "SEARCH": search,
+        "SUBSCRIBE": subscribe,
+        "UNSUBSCRIBE": unsubscribe,
+    }
+
+
+class MessageBus(object):
+    '''The hub that every worker process connects to.
+
+    Args:
+        message_store (obj): The MessageStore that every message is written to. Only the bus writes to it.
+
+        room_stores (obj): The RoomStores that messages to rooms are written to.
+
+        offline_queues (obj): The OfflineQueues of direct messages that have not been acknowledged yet.
+
+        on_claim (function): Called with the username whenever someone logs in, on any worker.
+
+        on_publish (function): Called with every message that is stored, e.g. to print it out.
+
+    '''
+
+    def __init__(self, message_store, room_stores, offline_queues, on_claim=None, on_publish=None):
+        self.message_store = message_store
+        self.room_stores = room_stores
+        self.offline_queues = offline_queues
+        self.on_claim = on_claim
+        self.on_publish = on_publish
+        self.workers = set()
+        self.owners = {}
+        self.rooms = {}
+        self.presence = Presence()
+
+    def connection(self):
+        '''Used as the protocol factory for the bus's Unix socket server.'''
+        return BusConnection(self)
+
+    def publish(self, message, origin):
+        '''Used to store a message and hand it to the workers that have someone to deliver it to.
+
+        A direct message to someone who is not logged in anywhere is stored, but not handed to any worker; instead
+        the worker that it came from is told that it was queued. If they have never logged in, it is not even
+        stored, and the worker is told that it was turned away.
+
+        args:
+            message (list): The message, as (sender, recipient, timestamp, text).
+            origin (obj): The BusConnection of the worker that the message came from.
+
+        '''
+        if message[1] == "ALL":
+            workers = self.workers
+        elif message[1].startswith('#'):
+            workers = self.rooms.get(message[1], ())
+        elif message[1] in self.owners:
+            workers = (self.owners[message[1]],)
+        else:
+            workers = ()
+
+        direct = not message[1].startswith('#') and message[1] != "ALL"
+        if direct and not workers and not self.offline_queues.known(message[1]):
+            origin.send({"UNKNOWN": [message[0], message[1]]})
+            return
+
+        if message[1].startswith('#'):
+            number = self.room_stores.get(message[1]).append(message)
+            self.release_unused(message[1])
+        else:
+            number = self.message_store.append(message)
+        if self.on_publish is not None:
+            self.on_publish(message)
+        if direct and not workers:
+            origin.send({"QUEUED": [message[0], message[1], [number]]})
+            return
+
+        frame = encode_frame(JSON.encode({"DELIVER": [number, message]}))
+        for worker in workers:
+            worker.transport.write(frame)
+
+    def release_unused(self, room):
+        '''Used after a room's store has been used, to close it again if no worker is subscribed to the room.'''
+        if room not in self.rooms:
+            self.room_stores.release(room)
+
+    def flush_presence(self):
+        '''Used to send everyone who has joined or left since the last time to every worker, as one change.'''
+        delta = self.presence.flush()
+        if delta is not None:
+            frame = encode_frame(JSON.encode({"PRESENCE": delta}))
+            for worker in self.workers:
+                worker.transport.write(frame)
+
+
+class BusClient(asyncio.Protocol):
+    '''A worker's end of its connection with the bus.
+
+    Args:
+        on_deliver (function): Called with every message that the bus hands to this worker, as its number in the
+                               store and the message itself.
+
+        on_notice (function): Called with every INFO notice that another worker has sent.
+
+        on_queued (function): Called when direct messages that this worker published were queued, because their
+                              recipient is not logged in anywhere, as (sender, recipient, numbers).
+
+        on_unknown (function): Called when a direct message that this worker published was turned away, because its
+                               recipient has never logged in, as (sender, recipient).
+
+        on_delivered (function): Called when direct messages sent by one of this worker's users have been
+                                 acknowledged by their recipient, as (sender, recipient, numbers).
+
+        on_presence (function): Called with every change to who is online, as made by Presence.flush().
+
+    '''
+
+    def __init__(self, on_deliver, on_notice, on_queued, on_unknown, on_delivered, on_presence):
+        self.on_deliver = on_deliver
+        self.on_notice = on_notice
+        self.on_queued = on_queued
+        self.on_unknown = on_unknown
+        self.on_delivered = on_delivered
+        self.on_presence = on_presence
+        self.decoder = FrameDecoder()
+        self.waiting = {}
+        self.request_ids = itertools.count()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        for future in self.waiting.values():
+            if not future.done():
+                future.set_exception(ConnectionError('lost connection with the message bus'))
+        self.waiting = {}
+
+    def data_received(self, data):
+        for frame in self.decoder.feed(data):
+            response = JSON.decode(frame)
+            if "DELIVER" in response:
+                self.on_deliver(response["DELIVER"])
+            if "NOTICE" in response:
+                self.on_notice(response["NOTICE"])
+            if "QUEUED" in response:
+                self.on_queued(response["QUEUED"])
+            if "UNKNOWN" in response:
+                self.on_unknown(response["UNKNOWN"])
+            if "DELIVERED" in response:
+                self.on_delivered(response["DELIVERED"])
+            if "PRESENCE" in response:
+                self.on_presence(response["PRESENCE"])
+            for key in ("CLAIMED", "HISTORY", "SEARCH"):
+                if key in response:
+                    future = self.waiting.pop(response[key][0], None)
+                    if future is not None and not future.done():
+                        future.set_result(response[key][1:])
+
+    def send(self, message):
+        self.transport.write(encode_frame(JSON.encode(message)))
+
+    def _request(self, key, *args):
+        request_id = next(self.request_ids)
+        future = asyncio.get_event_loop().create_future()
+        self.waiting[request_id] = future
+        self.send({key: [request_id] + list(args)})
+        return future
+
+    async def claim(self, username, count, after=None):
+        '''Used to ask the bus whether a username is free, taking it if it is.
+
+        args:
+            username (str): The username that a client would like to log in with.
+            count (int): How many past messages to send back if the username is free.
+            after (int): The number of the last message that the client saw before reconnecting, or None.
+
+        returns:
+            claimed (bool): True if the username was free and is now taken by this worker.
+            messages (list): The messages that the user missed, or the newest messages for the user.
+            cursor (int): The HISTORY_CURSOR for the user's next page of history.
+            latest (int): The number of the newest message in the store.
+            resumed (bool): True if the messages are the ones that the user missed.
+            offline (list): The direct messages that the user has not acknowledged, other than those in messages.
+
+        '''
+        return await self._request("CLAIM", username, count, after)
+
+    def release(self, username):
+        '''Used to tell the bus that a user has logged out of this worker.'''
+        self.send({"RELEASE": username})
+
+    def publish(self, message):
+        '''Used to hand a chat message to the bus, which stores it and sends it on to its recipients.'''
+        self.send({"PUBLISH": message})
+
+    def ack(self, username, number):
+        '''Used to tell the bus that a user has received every message up to a number, including direct messages.'''
+        self.send({"ACK": [username, number]})
+
+    def notice(self, info):
+        '''Used to send an INFO notice to the users of every other worker.'''
+        self.send({"NOTICE": info})
+
+    def subscribe(self, room):
+        '''Used to ask the bus for every message sent to a room, once one of this worker's users has joined it.'''
+        self.send({"SUBSCRIBE": room})
+
+    def unsubscribe(self, room):
+        '''Used to tell the bus that none of this worker's users are in a room any more.'''
+        self.send({"UNSUBSCRIBE": room})
+
+    async def history(self, username, before, count, room=None, after=None):
+        '''Used to ask the bus for the page of a user's messages (or a room's messages) before a cursor.
+
+        returns:
+            messages (list): The messages on the page, oldest first.
+            cursor (int): The cursor for the next page, or None if there is nothing older.
+            latest (int): The number of the newest message in the store, if no cursor was given.
+            resumed (bool): True if the messages are the ones that the user missed since after.
+
+        '''
+        return await self._request("HISTORY", username, before, count, room, after)
+
+    async def search(self, username, query, before, count, room=None):
+        '''Used to ask the bus for the newest of a user's messages (or a room's messages) that hold every word of a
+        search, older than a cursor.
+
+        returns:
+            messages (list): The matching messages, newest first.
+            cursor (int): The cursor for the next (older) matches, or None if there are none.
+
+        '''
+        return await self._request("SEARCH", username, query, before, count, room)
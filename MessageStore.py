@@ -0,0 +1,1122 @@
+"""MessageStore.py
+
+Description:
+    The MessageStore is the persistent home of every chat message the server has accepted. Messages are kept in a
+    segmented, append-only log on disk (one JSON message per line), alongside a small fixed-width index file for each
+    segment. The index records where each message lives, its timestamp and who it was sent to, so that the server
+    can find "every message for this user" or "every message old enough to expire" without ever reading the log
+    itself.
+
+    Writes go through a single long-lived file handle and are batched; how often the log is fsync'd to disk is a
+    configurable policy. A store can also hand its writes to a StoreWriter, which does them on a background thread,
+    so that a slow disk never holds up the event loop. After a crash only the newest segment needs to be checked,
+    so recovery time is bounded by the segment size rather than by the size of the whole history.
+
+    Every time a segment is sealed, and when the store is closed, the in-memory index is written out as a snapshot:
+    a single binary file holding each column of the index (offsets, lengths, timestamps and each recipient's
+    message numbers) one after another. When the store is opened, the snapshot is memory-mapped rather than read,
+    and only the index records written since the snapshot are loaded, so opening a store takes about the same time
+    and memory however many years of chat it holds; the operating system only pages in the parts of the index that
+    are actually used, and the messages themselves are only read from the log when they are asked for.
+
+    Messages sent to a room are kept apart from everything else, in a MessageStore of their own for each room (see
+    RoomStores), so a room's history can be paged through without touching anyone else's messages.
+
+    The newest messages are also kept in memory, in a MessageTable, so that sending the latest page to everyone who
+    joins does not read and parse the same lines from the log over and over again. Rather than as a list per
+    message, they are kept in a handful of arrays: usernames are given ids and stored once, and every message's text
+    is packed into a single buffer, which takes several times less memory than the lists themselves would.
+
+    Each store can also keep a SearchIndex of the words in its messages, so that they can be searched.
+
+    Messages can be set to expire, once they are older than max_age seconds, once there are max_count newer
+    messages for the same recipient (or room), or once the store holds max_bytes of newer messages. Expired messages
+    are left out of everything that the store finds straight away, and are removed from the disk when their segment
+    is compacted: a sealed segment is rewritten as a compressed Archive, without its expired messages, once at
+    least half of it has expired or once it is older than archive_age seconds. Archives are memory-mapped and
+    read from on demand, so old history can still be paged through and searched without being held in memory.
+    Message numbers never change, so an expired message simply leaves a gap.
+
+"""
+
+import os
+import json
+import time
+import mmap
+import bisect
+import struct
+import threading
+from array import array
+
+from Column import Column
+from SearchIndex import SearchIndex
+from Archive import Archive, write_archive
+
+
+INDEX_RECORD = struct.Struct('!QIqI')
+SNAPSHOT_HEADER = struct.Struct('=8sQQQ')
+SNAPSHOT_MAGIC = b'CHATSNAP'
+SNAPSHOT_CHECK = 0x0102030405060708
+FSYNC_POLICIES = ('always', 'interval', 'never')
+SNAPSHOT_AFTER = 1000
+
+
+class MessageStore(object):
+    '''The persistent, indexed message log used by the server.
+
+    Every message is given a number when it is appended; the first message ever stored is number 0, the next is
+    number 1 and so on. Numbers never change, so they can be handed out to clients and used to fetch messages later.
+
+    Recipients are stored in the index as small ids rather than names. The names themselves are kept in a separate
+    recipients file, which only grows when a message is sent to someone for the first time.
+
+    Args:
+        directory (str): The folder that the log segments and their indexes are kept in. It is created if needed.
+
+        segment_size (int): Once the newest segment grows past this many bytes, a new segment is started.
+                            This also bounds how much of the log has to be scanned when recovering from a crash.
+
+        batch_size (int): How many appended messages are held in memory before they are written out.
+                          flush() can be called at any time to write out a smaller batch.
+
+        fsync (str): One of 'always' (fsync on every flush), 'interval' (fsync at most once every fsync_interval
+                     seconds) or 'never' (leave it to the operating system).
+
+        fsync_interval (float): The number of seconds between fsyncs when using the 'interval' policy.
+
+        on_write (function): If given, called with the number of seconds that each batch took to write
+                             (and fsync) to disk, e.g. to keep track of how slow the disk is.
+
+        cache_size (int): About how many of the newest messages are kept in memory, so they can be read without
+                          going to the log. 0 turns the cache off.
+
+        search (bool): Whether to keep a SearchIndex of the words in every message, so that search() can be used.
+
+        writer (obj): If given, a StoreWriter that every message is handed to as soon as it is appended, to be
+                      written (and fsync'd, according to fsync) on its thread. batch_size is then not used, since
+                      the writer does its own batching.
+
+        max_age (float): Messages expire once they are this many seconds old. 0 means never.
+
+        max_count (int): Messages expire once there are this many newer messages for the same recipient (for a
+                         room's store, in the same room). 0 means never.
+
+        max_bytes (int): Messages expire once the newer messages in the store take up this many bytes. 0 means never.
+
+        archive_age (float): Sealed segments are compacted into an archive once their newest message is this many
+                             seconds old, whether or not any of it has expired. 0 means only once half has expired.
+
+    '''
+
+    def __init__(self, directory='history', segment_size=64 * 1024 * 1024, batch_size=64, fsync='interval',
+                 fsync_interval=1.0, on_write=None, cache_size=10000, search=True, writer=None, max_age=0,
+                 max_count=0, max_bytes=0, archive_age=0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync policy must be one of {}'.format(', '.join(FSYNC_POLICIES)))
+
+        self.directory = directory
+        self.segment_size = segment_size
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.on_write = on_write
+        self._writer = writer
+        self.max_age = max_age
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.archive_age = archive_age
+
+        self._segment_starts = []
+        self._sealed = 0
+        self._offsets = Column('Q')
+        self._lengths = Column('I')
+        self._timestamps = Column('q')
+        self._latest = Column('q')
+        self._recipients = []
+        self._recipient_ids = {}
+        self._by_recipient = []
+
+        self._pending = []
+        self._pending_index = []
+        self._cache = MessageTable(cache_size)
+        self._readers = {}
+        self._archives = {}
+        self._last_fsync = time.time()
+        self._rewind_to = None
+        self._floor = 0
+        self._floors = {}
+        self._bytes_floor = None
+        self._retained_bytes = 0
+        self._snapshotted = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+        self._search = None
+        self._search_snapshot = None
+        self._search_thread = None
+        self._search_due = False
+        if search:
+            self._search = SearchIndex(directory)
+            self._search.load(len(self))
+            for number in range(self._search.indexed, len(self)):
+                message = self.read(number)
+                if message is not None:
+                    self._search.add(number, message[3])
+        self.expire()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _path(self, start, extension):
+        return os.path.join(self.directory, '{:012d}.{}'.format(start, extension))
+
+    def _load(self):
+        '''Used when the store is opened, to rebuild the in-memory index from the snapshot and the index files.
+
+        Everything up to the snapshot is mapped straight from it, and only the index records after it are read from
+        the index files. The newest segment is the only one that may have been left half written, so it is checked
+        against its log; any messages that made it to the log but not the index are re-indexed, and a torn final
+        line is cut off.
+
+        '''
+        self._recipient_file = open(os.path.join(self.directory, 'recipients.txt'), 'a+')
+        self._recipient_file.seek(0)
+        for line in self._recipient_file:
+            if line.endswith('\n'):
+                self._add_recipient(json.loads(line))
+
+        starts = set()
+        for name in os.listdir(self.directory):
+            if name.endswith('.log'):
+                starts.add(int(name[:-4]))
+            elif name.endswith('.arc.tmp'):
+                os.remove(os.path.join(self.directory, name))
+        for name in os.listdir(self.directory):
+            if name.endswith('.arc'):
+                start = int(name[:-4])
+                if start in starts:
+                    os.remove(self._path(start, 'log'))
+                starts.add(start)
+                self._archives[start] = Archive(self._path(start, 'arc'))
+        self._segment_starts = sorted(starts)
+
+        if not self._segment_starts:
+            self._segment_starts.append(0)
+
+        mapped = self._snapshotted = self._map_snapshot()
+        for start, end in zip(self._segment_starts, self._segment_starts[1:]):
+            if end > mapped:
+                with open(self._path(start, 'idx'), 'rb') as index_file:
+                    index_file.seek(max(0, mapped - start) * INDEX_RECORD.size)
+                    for record in INDEX_RECORD.iter_unpack(index_file.read()):
+                        self._index(*record)
+
+        self._recover(self._segment_starts[-1], max(0, mapped - self._segment_starts[-1]))
+        self._sealed = self._segment_starts[-1]
+
+    def _map_snapshot(self):
+        '''Used to map the snapshot of the index into memory, in place of the columns that it covers.
+
+        A snapshot that does not match the index files (e.g. one that is newer than them, or was cut short) is left
+        alone, and the whole index is read from the index files instead. Anything that the columns hold past the
+        end of the snapshot is kept as it is.
+
+        returns:
+            count (int): The number of messages that the snapshot covers, or 0 if there is no usable snapshot.
+
+        '''
+        try:
+            snapshot_file = open(os.path.join(self.directory, 'index.snapshot'), 'rb')
+        except IOError:
+            return 0
+        with snapshot_file:
+            size = os.fstat(snapshot_file.fileno()).st_size
+            if size < SNAPSHOT_HEADER.size:
+                return 0
+            mapped = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, check, count, recipients = SNAPSHOT_HEADER.unpack_from(mapped)
+        indexed = sum(os.path.getsize(self._path(start, 'idx')) // INDEX_RECORD.size
+                      for start in self._segment_starts if os.path.exists(self._path(start, 'idx')))
+        if magic != SNAPSHOT_MAGIC or check != SNAPSHOT_CHECK or count > indexed or \
+                count < len(self._offsets.mapped) or recipients > len(self._recipients) or size < SNAPSHOT_HEADER.size + 8 * recipients:
+            return 0
+
+        view = memoryview(mapped)
+        position = SNAPSHOT_HEADER.size + 8 * recipients
+        counts = view[SNAPSHOT_HEADER.size:position].cast('Q')
+        if size != position + (8 + 8 + 8 + 4) * count + 8 * sum(counts):
+            return 0
+
+        columns = []
+        layout = [('Q', count), ('q', count), ('q', count)] + [('Q', length) for length in counts] + [('I', count)]
+        old = [self._offsets, self._timestamps, self._latest] + self._by_recipient[:recipients] + [self._lengths]
+        for column, (typecode, length) in zip(old, layout):
+            end = position + array(typecode).itemsize * length
+            columns.append(column.remapped(view[position:end].cast(typecode)))
+            position = end
+
+        self._offsets, self._timestamps, self._latest = columns[:3]
+        self._by_recipient[:recipients] = columns[3:-1]
+        self._lengths = columns[-1]
+        return count
+
+    def _write_snapshot(self, count=None, recipients=None):
+        '''Used to write the columns of the in-memory index out to the snapshot, once the messages that it covers are
+        all on disk.
+
+        The snapshot is written to a temporary file first, and then moved into place, so a crash while it is being
+        written leaves the old snapshot as it was. The columns are only read, so with a writer this is done on its
+        thread, while the store goes on appending to them.
+
+        args:
+            count (int): How many messages the snapshot covers. The default is every message in the store.
+            recipients (int): How many recipients the snapshot covers. The default is all of them.
+
+        '''
+        if count is None:
+            count, recipients = len(self._offsets), len(self._by_recipient)
+        by_recipient = self._by_recipient[:recipients]
+        counts = array('Q', (len(numbers.mapped) + bisect.bisect_left(numbers.tail, count) for numbers in by_recipient))
+        path = os.path.join(self.directory, 'index.snapshot')
+        with open(path + '.tmp', 'wb') as snapshot_file:
+            snapshot_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_CHECK, count, recipients))
+            snapshot_file.write(counts)
+            columns = [self._offsets, self._timestamps, self._latest] + by_recipient + [self._lengths]
+            for column, length in zip(columns, [count] * 3 + counts.tolist() + [count]):
+                column.write(snapshot_file, length)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(path + '.tmp', path)
+        self._snapshotted = count
+
+    def _add_recipient(self, recipient):
+        self._recipient_ids[recipient] = len(self._recipients)
+        self._recipients.append(recipient)
+        self._by_recipient.append(Column('Q'))
+
+    def _recipient_id(self, recipient):
+        '''Used to find the id of a recipient, giving them a new one (and saving it) if they have never had one.
+
+        args:
+            recipient (str): The recipient of a message, either a username or 'ALL'.
+
+        returns:
+            recipient_id (int): The id that the recipient is stored under in the index.
+
+        '''
+        recipient_id = self._recipient_ids.get(recipient)
+        if recipient_id is None:
+            self._add_recipient(recipient)
+            self._recipient_file.write(json.dumps(recipient) + '\n')
+            self._recipient_file.flush()
+            recipient_id = self._recipient_ids[recipient]
+        return recipient_id
+
+    def _index(self, offset, length, timestamp, recipient_id):
+        number = len(self._offsets)
+        self._offsets.append(offset)
+        self._lengths.append(length)
+        self._timestamps.append(timestamp)
+        self._latest.append(max(timestamp, self._latest[-1]) if self._latest else timestamp)
+        self._by_recipient[recipient_id].append(number)
+        if self._bytes_floor is not None:
+            self._retained_bytes += length
+
+    def _recover(self, start, mapped=0):
+        '''Used to bring the newest segment back to a consistent state after the server stops.
+
+        args:
+            start (int): The number of the first message in the newest segment.
+            mapped (int): How many of the segment's messages are already indexed, from the snapshot. The snapshot is
+                          only written once they are all on disk, so they are not checked again.
+
+        '''
+        self._log = open(self._path(start, 'log'), 'ab+')
+        self._log_index = open(self._path(start, 'idx'), 'ab+')
+
+        valid = mapped * INDEX_RECORD.size
+        log_end = self._offsets[start + mapped - 1] + self._lengths[start + mapped - 1] if mapped else 0
+
+        log_size = self._log.seek(0, os.SEEK_END)
+        self._log_index.seek(valid)
+        index_data = self._log_index.read()
+        index_data = index_data[:len(index_data) - len(index_data) % INDEX_RECORD.size]
+
+        for offset, length, timestamp, recipient_id in INDEX_RECORD.iter_unpack(index_data):
+            if offset + length > log_size or recipient_id >= len(self._recipients):
+                break
+            self._index(offset, length, timestamp, recipient_id)
+            valid += INDEX_RECORD.size
+            log_end = offset + length
+
+        recovered = []
+        self._log.seek(log_end)
+        for line in self._log:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                message = json.loads(line)
+            except ValueError:
+                break
+            record = (log_end, len(line), message[2], self._recipient_id(message[1]))
+            recovered.append(INDEX_RECORD.pack(*record))
+            self._index(*record)
+            log_end += len(line)
+
+        if log_end < log_size:
+            self._log.truncate(log_end)
+        self._log_index.truncate(valid)
+        self._log_index.write(b''.join(recovered))
+        self._log_index.flush()
+        self._write_offset = log_end
+
+    def append(self, message):
+        '''Used to add a single message to the end of the log.
+
+        The message is indexed straight away, so it can be read back immediately, but is only written to disk once
+        a full batch has built up or flush() is called.
+
+        Its index record is packed before anything else is done, so a message that cannot be indexed (e.g. because
+        its timestamp is too large) leaves the store as it was.
+
+        args:
+            message (list): The message to store, as (sender, recipient, timestamp, text).
+
+        returns:
+            number (int): The number given to the stored message.
+
+        raises:
+            ValueError: If the message cannot be stored.
+
+        '''
+        line = json.dumps(message).encode('utf-8') + b'\n'
+        number = len(self._offsets)
+        recipient_id = self._recipient_ids.get(message[1], len(self._recipients))
+        record = (self._write_offset, len(line), message[2], recipient_id)
+        try:
+            packed = INDEX_RECORD.pack(*record)
+        except struct.error as error:
+            raise ValueError('Message cannot be stored: {}'.format(error))
+        self._recipient_id(message[1])
+
+        self._pending.append(line)
+        self._index(*record)
+        self._cache.append(number, message)
+        if self._search is not None:
+            self._search.add(number, message[3])
+            if self._search_thread is not None and not self._search_thread.is_alive():
+                self._finish_search_snapshot()
+                if self._search_due:
+                    self._snapshot_search()
+        self._write_offset += len(line)
+
+        if self._writer is not None:
+            self._writer.submit(self, number, line, packed)
+            if self._write_offset >= self.segment_size:
+                self._roll()
+        else:
+            self._pending_index.append(packed)
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+        return number
+
+    def flush(self):
+        '''Used to write every pending message to disk, fsyncing according to the store's policy.
+
+        With a writer, messages are already on their way to disk as soon as they are appended, so there is nothing
+        to do here; drain() waits for them to be written instead.
+
+        '''
+        if self._pending and self._writer is None:
+            seconds = self.write(self._pending, self._pending_index)
+            self._pending = []
+            self._pending_index = []
+            if self.on_write is not None:
+                self.on_write(seconds)
+
+        if self._write_offset >= self.segment_size:
+            self._roll()
+
+    def write(self, lines, records):
+        '''Used to write a batch of messages to the newest segment, by flush() or on the writer's thread.
+
+        The log is always written before its index, so an index entry can never point past the end of the log.
+
+        The index records already hold where each message will be in the log, so a batch must never be skipped or
+        written twice. If writing fails part way, the files are reopened (throwing away anything still buffered),
+        and the next write first cuts them back to where they were before, so that the same batch can simply be
+        written again.
+
+        args:
+            lines (list): The messages, as they are written to the log.
+            records (list): Their index records.
+
+        returns:
+            seconds (float): How long the batch took to write (and fsync).
+
+        raises:
+            OSError: If the batch could not be written. It should be written again, before anything after it.
+
+        '''
+        start = time.perf_counter()
+        if self._rewind_to is not None:
+            os.truncate(self._log.name, self._rewind_to[0])
+            os.truncate(self._log_index.name, self._rewind_to[1])
+            self._rewind_to = None
+        sizes = (os.fstat(self._log.fileno()).st_size, os.fstat(self._log_index.fileno()).st_size)
+
+        try:
+            self._log.write(b''.join(lines))
+            self._log.flush()
+            self._log_index.write(b''.join(records))
+            self._log_index.flush()
+
+            now = time.time()
+            if self.fsync == 'always' or (self.fsync == 'interval' and now - self._last_fsync >= self.fsync_interval):
+                self._sync()
+                self._last_fsync = now
+        except OSError:
+            self._rewind_to = sizes
+            self._reopen()
+            raise
+        return time.perf_counter() - start
+
+    def _reopen(self):
+        '''Used after a failed write, to close the log and index without writing what is left in their buffers, and
+        open them again.'''
+        for handle in (self._log, self._log_index):
+            try:
+                handle.close()
+            except OSError:
+                pass
+        self._log = open(self._log.name, 'ab+')
+        self._log_index = open(self._log_index.name, 'ab+')
+
+    def written(self, end, seconds):
+        '''Called by the writer, on the event loop, once every message before number end has been written.
+
+        args:
+            end (int): The number after the last message that was written.
+            seconds (float): How long the batch took to write (and fsync).
+
+        '''
+        flushed = len(self._offsets) - len(self._pending)
+        if end > flushed:
+            del self._pending[:end - flushed]
+        if self.on_write is not None:
+            self.on_write(seconds)
+
+    def drain(self):
+        '''Used to wait until the writer has written every message of the store (and of the writer's other stores).'''
+        if self._writer is not None:
+            self._writer.drain()
+            self._pending = []
+
+    def _sync(self):
+        os.fsync(self._log.fileno())
+        os.fsync(self._log_index.fileno())
+
+    def _roll(self):
+        '''Used to start a new segment once the newest one has grown past segment_size, and have the old one sealed.
+
+        Messages are numbered and placed in the new segment straight away. With a writer, the old segment is sealed
+        on the writer's thread (see seal()), once the last of its messages has been written, so the store never
+        waits on the disk for it. The SearchIndex is snapshotted too, but on a thread of its own (see
+        _snapshot_search()).
+
+        '''
+        start = len(self._offsets)
+        self._segment_starts.append(start)
+        self._write_offset = 0
+        if self._search is not None:
+            self._snapshot_search()
+        if self._writer is not None:
+            self._writer.seal(self, start, len(self._by_recipient))
+        else:
+            self.seal(start, len(self._by_recipient))
+            self.sealed(start)
+
+    def seal(self, start, recipients):
+        '''Used once every message of the newest segment has been written, to fsync and close it, start writing to the
+        next segment, and snapshot the index up to the end of the old one. With a writer, this is done on its thread.
+
+        If anything fails, it can simply be done again: a segment that has already been closed is not closed twice.
+
+        args:
+            start (int): The number of the first message of the next segment.
+            recipients (int): How many recipients the store had when the old segment was full.
+
+        returns:
+            seconds (float): How long it took.
+
+        raises:
+            OSError: If the segment could not be sealed. It should be sealed again, before anything after it is
+                     written.
+
+        '''
+        began = time.perf_counter()
+        if self._log.name != self._path(start, 'log'):
+            self._sync()
+            log, log_index = self._log, self._log_index
+            self._log = open(self._path(start, 'log'), 'ab+')
+            self._log_index = open(self._path(start, 'idx'), 'ab+')
+            log.close()
+            log_index.close()
+        self._write_snapshot(start, recipients)
+        return time.perf_counter() - began
+
+    def sealed(self, start):
+        '''Called on the event loop once the segment before message number start has been sealed, to map the new
+        snapshot in, so the part of the index that is held in memory, rather than mapped, never grows past about
+        one segment's worth. The segment can be compacted from then on.
+
+        args:
+            start (int): The number of the first message of the next segment.
+
+        '''
+        if not self._log.closed:
+            self._map_snapshot()
+            self._sealed = start
+
+    def _snapshot_search(self):
+        '''Used when a segment is sealed, to start writing a snapshot of the SearchIndex on a thread of its own.
+
+        Merging the new words into the snapshot takes longer the more words have ever been used, so it is not done
+        on the thread that uses the store. The first append() after it is written swaps the index over to it. If
+        the last snapshot is still being written, the new one is started once it is done instead.
+
+        '''
+        if self._search_thread is not None:
+            self._search_due = True
+            return
+        self._search_due = False
+        self._search_snapshot = self._search.snapshot()
+        self._search_thread = threading.Thread(target=self._search_snapshot.run, name='search-snapshot', daemon=True)
+        self._search_thread.start()
+
+    def _finish_search_snapshot(self):
+        '''Used to wait for the SearchIndex snapshot that is being written, if there is one, and map it in.'''
+        if self._search_thread is not None:
+            self._search_thread.join()
+            self._search_thread = None
+            self._search_snapshot.finish()
+            self._search_snapshot = None
+
+    def close(self):
+        '''Used when the server shuts down (or a room is no longer used), to write out and fsync anything still
+        pending, and snapshot the index.
+
+        The snapshots are only written again once SNAPSHOT_AFTER messages have been stored since they last were.
+        Rewriting them takes longer the larger the store is, while the few messages that they do not cover are
+        simply read back from the index files (and indexed for search again) when the store is next opened. So a
+        store that has stored little or nothing (e.g. a room that someone joined and left) is closed without
+        rewriting them, and without waiting for the writer if none of its messages are still waiting to be written.
+
+        '''
+        self.flush()
+        if self._pending or self._sealed != self._segment_starts[-1]:
+            self.drain()
+        if len(self._offsets) != self._snapshotted:
+            self._sync()
+        if len(self._offsets) - self._snapshotted >= SNAPSHOT_AFTER:
+            self._write_snapshot()
+        if self._search is not None:
+            self._finish_search_snapshot()
+            if self._search.indexed - self._search.saved >= SNAPSHOT_AFTER:
+                self._search.save()
+        self._log.close()
+        self._log_index.close()
+        self._recipient_file.close()
+        for reader in self._readers.values():
+            reader.close()
+        self._readers = {}
+        for archive in self._archives.values():
+            archive.close()
+        self._archives = {}
+
+    def read(self, number):
+        '''Used to read a single message back from the store.
+
+        args:
+            number (int): The number that the message was given when it was appended.
+
+        returns:
+            message (list): The stored message, as (sender, recipient, timestamp, text), or None if it has expired and
+                            been compacted away.
+
+        '''
+        message = self._cache.get(number)
+        if message is not None:
+            return message
+
+        flushed = len(self._offsets) - len(self._pending)
+        if number >= flushed:
+            return json.loads(self._pending[number - flushed])
+
+        start = self._segment_starts[bisect.bisect_right(self._segment_starts, number) - 1]
+        archive = self._archives.get(start)
+        if archive is not None:
+            line = archive.read(number)
+            return json.loads(line) if line is not None else None
+        reader = self._readers.get(start)
+        if reader is None:
+            reader = self._readers[start] = open(self._path(start, 'log'), 'rb')
+        reader.seek(self._offsets[number])
+        return json.loads(reader.read(self._lengths[number]))
+
+    def read_many(self, numbers):
+        '''Used to read a run of messages back from the store, in the order that their numbers are given.
+
+        args:
+            numbers (iterable): The numbers of the messages to read.
+
+        returns:
+            messages (generator): Each of the requested messages, as (sender, recipient, timestamp, text). Messages
+                                  that have been compacted away are skipped.
+
+        '''
+        for number in numbers:
+            message = self.read(number)
+            if message is not None:
+                yield message
+
+    def page(self, recipients, before=None, count=50):
+        '''Used to find the newest messages for the given recipients that are older than a cursor.
+
+        Each recipient's part of the index is already in order, so only the last count entries before the cursor
+        are taken from each of them, no matter how long the history is.
+
+        args:
+            recipients (iterable): The recipients to look for, e.g. ('ALL', 'steven').
+            before (int): Only messages with a number lower than this are returned. None means start from the newest.
+            count (int): The most messages to return.
+
+        returns:
+            numbers (list): The numbers of the matching messages, oldest first.
+            cursor (int): The cursor to pass as before to get the next (older) page, or None if there is nothing older.
+
+        '''
+        if before is None:
+            before = len(self._offsets)
+
+        numbers = []
+        remaining = 0
+        for recipient in set(recipients):
+            if recipient in self._recipient_ids:
+                recipient_id = self._recipient_ids[recipient]
+                entries = self._by_recipient[recipient_id]
+                start = bisect.bisect_left(entries, self._floor_of(recipient_id))
+                end = max(start, bisect.bisect_left(entries, before))
+                numbers.extend(entries[max(start, end - count):end])
+                remaining += end - start
+        numbers.sort()
+        numbers = numbers[-count:] if count > 0 else []
+
+        cursor = numbers[0] if numbers and remaining > len(numbers) else None
+        return numbers, cursor
+
+    def after(self, recipients, after, count=1000):
+        '''Used to find the messages for the given recipients that are newer than a message number, such as the
+        ones that a client missed while it was disconnected.
+
+        args:
+            recipients (iterable): The recipients to look for, e.g. ('ALL', 'steven').
+            after (int): Only messages with a number higher than this are returned.
+            count (int): The most messages to return.
+
+        returns:
+            numbers (list): The numbers of the matching messages, oldest first.
+            complete (bool): False if there were more than count matching messages, in which case only the oldest
+                             count of them are returned.
+
+        '''
+        numbers = []
+        total = 0
+        for recipient in set(recipients):
+            if recipient in self._recipient_ids:
+                recipient_id = self._recipient_ids[recipient]
+                entries = self._by_recipient[recipient_id]
+                start = bisect.bisect_right(entries, max(after, self._floor_of(recipient_id) - 1))
+                numbers.extend(entries[start:start + count])
+                total += len(entries) - start
+        numbers.sort()
+        return numbers[:count], total <= count
+
+    def catch_up(self, recipients, after=None, count=50, limit=1000):
+        '''Used to find what to send a client that has just (re)connected.
+
+        A client that says which message it saw last is sent every message that it missed since then, as long as
+        there are no more than limit of them. Anyone else is sent the newest page of messages.
+
+        args:
+            recipients (iterable): The recipients to look for, e.g. ('ALL', 'steven').
+            after (int): The number of the last message that the client saw, or None if it has not seen any.
+            count (int): The most messages to send on a page.
+            limit (int): The most missed messages to send.
+
+        returns:
+            numbers (list): The numbers of the messages to send, oldest first.
+            cursor (int): The cursor for the page before these, or None (which it always is for missed messages).
+            latest (int): The number of the newest message in the store, which the client has now seen, or -1.
+            resumed (bool): True if the numbers are the messages that the client missed.
+
+        '''
+        latest = len(self._offsets) - 1
+        if after is not None:
+            numbers, complete = self.after(recipients, after, limit)
+            if complete:
+                return numbers, None, latest, True
+        numbers, cursor = self.page(recipients, count=count)
+        return numbers, cursor, latest, False
+
+    def search(self, recipients, query, before=None, count=20):
+        '''Used to find the newest messages for the given recipients that hold every word of a search.
+
+        args:
+            recipients (iterable): The recipients whose messages may be returned, e.g. ('ALL', 'steven').
+            query (str): The words to search for.
+            before (int): Only messages with a number lower than this are returned. None means start from the newest.
+            count (int): The most messages to return.
+
+        returns:
+            numbers (list): The numbers of the matching messages, newest first.
+            cursor (int): The cursor to pass as before to get the next (older) matches, or None if there are none.
+
+        '''
+        if self._search is None:
+            return [], None
+        columns = [(self._by_recipient[self._recipient_ids[recipient]], self._floor_of(self._recipient_ids[recipient]))
+                   for recipient in set(recipients) if recipient in self._recipient_ids]
+        return self._search.search(query, columns, before, count)
+
+    def import_backup(self, path):
+        '''Used to move messages out of an old style backup file, where each line is a JSON list of messages.
+
+        args:
+            path (str): The location of the old backup file.
+
+        returns:
+            count (int): The number of messages that were imported.
+
+        '''
+        count = 0
+        with open(path, 'r') as backup_messages:
+            for line in backup_messages:
+                if line.strip():
+                    for message in json.loads(line):
+                        self.append(message)
+                        count += 1
+        self.flush()
+        return count
+
+    def expire(self, now=None):
+        '''Used to work out which messages have expired, according to max_age, max_count and max_bytes.
+
+        Expired messages are left out of everything that the store finds from then on. Messages never come back
+        once they have expired, even if the limits are raised.
+
+        args:
+            now (float): The unix time to measure max_age from. The default is the current time.
+
+        '''
+        if now is None:
+            now = time.time()
+        floor = self._floor
+        if self.max_age:
+            floor = max(floor, bisect.bisect_left(self._latest, now - self.max_age))
+        if self.max_bytes:
+            if self._bytes_floor is None:
+                self._bytes_floor = len(self._lengths)
+                while self._bytes_floor > 0 and \
+                        self._retained_bytes + self._lengths[self._bytes_floor - 1] <= self.max_bytes:
+                    self._bytes_floor -= 1
+                    self._retained_bytes += self._lengths[self._bytes_floor]
+            while self._retained_bytes > self.max_bytes:
+                self._retained_bytes -= self._lengths[self._bytes_floor]
+                self._bytes_floor += 1
+            floor = max(floor, self._bytes_floor)
+        self._floor = floor
+
+        if self.max_count:
+            for recipient_id, entries in enumerate(self._by_recipient):
+                if len(entries) > self.max_count:
+                    self._floors[recipient_id] = entries[len(entries) - self.max_count]
+
+    def _floor_of(self, recipient_id):
+        '''Used to get the number of a recipient's oldest message that has not expired (or a lower number).'''
+        return max(self._floor, self._floors.get(recipient_id, 0))
+
+    def _expired_in(self, start, end):
+        '''Used to count the expired messages between two message numbers.'''
+        floor = min(max(self._floor, start), end)
+        expired = floor - start
+        for recipient_id, recipient_floor in self._floors.items():
+            if recipient_floor > floor:
+                entries = self._by_recipient[recipient_id]
+                expired += bisect.bisect_left(entries, min(recipient_floor, end)) - bisect.bisect_left(entries, floor)
+        return expired
+
+    def compactable(self, now=None):
+        '''Used to find the sealed segments that are due to be compacted.
+
+        A segment is due once at least half of the messages that it still holds have expired, or, if it has not
+        been archived yet, once its newest message is older than archive_age seconds. A segment that is still being
+        sealed (see seal()) is never due.
+
+        args:
+            now (float): The unix time to measure archive_age from. The default is the current time.
+
+        returns:
+            starts (list): The number of the first message of each segment that is due.
+
+        '''
+        if now is None:
+            now = time.time()
+        starts = []
+        for start, end in zip(self._segment_starts, self._segment_starts[1:]):
+            if end > self._sealed:
+                break
+            archive = self._archives.get(start)
+            held = len(archive) if archive is not None else end - start
+            expired = held - (end - start - self._expired_in(start, end))
+            if expired > 0 and 2 * expired >= held:
+                starts.append(start)
+            elif archive is None and self.archive_age and end > start and \
+                    self._latest[end - 1] < now - self.archive_age:
+                starts.append(start)
+        return starts
+
+    def compaction(self, start):
+        '''Used to get ready to compact a sealed segment into an archive, leaving out its expired messages.
+
+        args:
+            start (int): The number of the first message of the segment, as returned by compactable().
+
+        returns:
+            compaction (obj): A Compaction, whose run() does the slow part, on any thread, and whose finish() then
+                              puts the archive in place of the segment.
+
+        '''
+        end = self._segment_starts[self._segment_starts.index(start) + 1]
+        floor = min(max(self._floor, start), end)
+        dropped = set()
+        for recipient_id, recipient_floor in self._floors.items():
+            if recipient_floor > floor:
+                entries = self._by_recipient[recipient_id]
+                dropped.update(entries[bisect.bisect_left(entries, floor):
+                                       bisect.bisect_left(entries, min(recipient_floor, end))])
+
+        archive = self._archives.get(start)
+        if archive is not None:
+            numbers = [number for number in archive.numbers if number >= floor and number not in dropped]
+            return Compaction(self, start, numbers)
+        numbers = [number for number in range(floor, end) if number not in dropped]
+        return Compaction(self, start, numbers, [(self._offsets[number], self._lengths[number]) for number in numbers])
+
+    def _archived(self, start):
+        '''Used by a Compaction once its archive has been written, to read the segment from it from now on.'''
+        archive = self._archives.pop(start, None)
+        if archive is not None:
+            archive.close()
+        self._archives[start] = Archive(self._path(start, 'arc'))
+        reader = self._readers.pop(start, None)
+        if reader is not None:
+            reader.close()
+        if os.path.exists(self._path(start, 'log')):
+            os.remove(self._path(start, 'log'))
+
+
+class Compaction(object):
+    '''The compaction of one sealed segment of a MessageStore into an archive.
+
+    Args:
+        store (obj): The MessageStore that the segment belongs to.
+
+        start (int): The number of the first message of the segment.
+
+        numbers (list): The numbers of the messages to keep.
+
+        locations (list): Where each of those messages is in the segment's log, as (offset, length), or None if the
+                          segment has already been archived, in which case they are read from the old archive.
+
+    '''
+
+    def __init__(self, store, start, numbers, locations=None):
+        self.store = store
+        self.start = start
+        self.numbers = numbers
+        self.locations = locations
+        self.path = store._path(start, 'arc')
+        self.source = store._path(start, 'log') if locations is not None else self.path
+        self.size = 0
+
+    def run(self):
+        '''Used to write the archive. This only reads the segment, so it can be done on a thread of its own.
+
+        returns:
+            size (int): The size of the new archive, in bytes.
+
+        '''
+        if self.locations is not None:
+            with open(self.source, 'rb') as log_file:
+                lines = (read_line(log_file, offset, length) for offset, length in self.locations)
+                self.size = write_archive(self.path, zip(self.numbers, lines))
+        else:
+            archive = Archive(self.source)
+            try:
+                self.size = write_archive(self.path, ((number, archive.read(number)) for number in self.numbers))
+            finally:
+                archive.close()
+        return self.size
+
+    def finish(self):
+        '''Used once run() is done, from the thread that uses the store, to start reading from the archive.'''
+        if not self.store._log.closed:
+            self.store._archived(self.start)
+
+
+def read_line(log_file, offset, length):
+    '''Used to read a single message out of a log file, as it was stored but without its newline.'''
+    log_file.seek(offset)
+    return log_file.read(length)[:-1]
+
+
+class RoomStores(object):
+    '''A MessageStore for every room, each in its own folder, opened the first time that the room is used, and
+    closed again once it is released (when no one is in the room any more).
+
+    Args:
+        directory (str): The folder that holds a folder for each room.
+
+        options: Anything else is passed on to every MessageStore, e.g. fsync='always'.
+
+    '''
+
+    def __init__(self, directory, **options):
+        self.directory = directory
+        self.options = options
+        self.stores = {}
+
+    def __iter__(self):
+        return iter(self.stores.values())
+
+    def get(self, room):
+        '''Used to get the MessageStore of a room, opening it if needed.
+
+        args:
+            room (str): The name of the room, starting with #. Room names may only hold letters, digits, - and _.
+
+        returns:
+            message_store (obj): The room's MessageStore.
+
+        '''
+        store = self.stores.get(room)
+        if store is None:
+            store = self.stores[room] = MessageStore(os.path.join(self.directory, room[1:]), **self.options)
+        return store
+
+    def release(self, room):
+        '''Used once a room is no longer in use, to close its store. It is opened again the next time it is used.'''
+        store = self.stores.pop(room, None)
+        if store is not None:
+            store.close()
+
+    def flush(self):
+        for store in self.stores.values():
+            store.flush()
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+        self.stores = {}
+
+
+class MessageTable(object):
+    '''A compact, in-memory copy of a run of consecutive messages, such as the newest ones in a MessageStore.
+
+    Senders and recipients are given ids, and each name is only kept once. Their ids and each message's timestamp
+    are kept in arrays, and the text of every message is packed, as UTF-8, into a single buffer. Once the table
+    holds more than capacity messages, the oldest quarter of them are dropped.
+
+    Args:
+        capacity (int): The most messages to hold. 0 means that nothing is held.
+
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.first = 0
+        self.names = []
+        self.name_ids = {}
+        self.senders = array('I')
+        self.recipients = array('I')
+        self.timestamps = array('q')
+        self.ends = array('Q')
+        self.text = bytearray()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.ends)
+
+    def _name_id(self, name):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def append(self, number, message):
+        '''Used to add a message to the end of the table.
+
+        args:
+            number (int): The number of the message, which must come straight after the last one in the table.
+                          Otherwise, the table is emptied and starts again from this message.
+            message (list): The message, as (sender, recipient, timestamp, text).
+
+        '''
+        if self.capacity <= 0:
+            return
+        if number != self.first + len(self):
+            self._drop(len(self))
+            self.first = number
+
+        self.senders.append(self._name_id(message[0]))
+        self.recipients.append(self._name_id(message[1]))
+        self.timestamps.append(message[2])
+        self.text += message[3].encode('utf-8')
+        self.ends.append(len(self.text) + self.dropped)
+
+        if len(self) > self.capacity:
+            self._drop(len(self) - self.capacity * 3 // 4)
+
+    def _drop(self, count):
+        '''Used to drop the oldest count messages from the table.'''
+        if count <= 0:
+            return
+        end = self.ends[count - 1] - self.dropped
+        del self.senders[:count]
+        del self.recipients[:count]
+        del self.timestamps[:count]
+        del self.ends[:count]
+        del self.text[:end]
+        self.dropped += end
+        self.first += count
+
+    def get(self, number):
+        '''Used to read a message back out of the table.
+
+        args:
+            number (int): The number of the message.
+
+        returns:
+            message (list): The message, as (sender, recipient, timestamp, text), or None if it is not in the table.
+
+        '''
+        index = number - self.first
+        if index < 0 or index >= len(self.ends):
+            return None
+        start = self.ends[index - 1] - self.dropped if index > 0 else 0
+        text = self.text[start:self.ends[index] - self.dropped].decode('utf-8')
+        return [self.names[self.senders[index]], self.names[self.recipients[index]], self.timestamps[index], text]
@@ -0,0 +1,202 @@
+"""Metrics.py
+
+Description:
+    The server keeps a handful of counters, gauges and histograms about what it is doing (how many clients are
+    connected, how many messages go in and out, how long encoding and writing to disk take, and so on), all in one
+    Registry. The MetricsServer serves them in the Prometheus text format on a small HTTP endpoint that only listens
+    on the local machine, along with a switch for the sampling profiler:
+
+        GET /metrics          Every metric, in the Prometheus text format.
+        GET /profile/start    Starts the sampling profiler.
+        GET /profile/stop     Stops the sampling profiler, and answers with what it found, as collapsed stacks.
+
+    Metrics are cheap to update (an addition, or a bisect for a histogram), and gauges that describe the state of
+    the server, such as the number of sessions, are only worked out when someone asks for them.
+
+"""
+
+import bisect
+import asyncio
+
+
+TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Metric(object):
+    '''The parts that every kind of metric has in common.
+
+    Args:
+        name (str): The name of the metric, such as chat_sessions.
+
+        help (str): A sentence describing what the metric measures.
+
+        function (function): If given, called to get the metric's value whenever the metrics are collected, instead
+                             of the metric keeping a value of its own. It may return a dict, which is turned into one
+                             sample per key, using label as the name of the label.
+
+        label (str): The name of the label that the keys of a dict returned by function are given.
+
+    '''
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, function=None, label=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.label = label
+        self.value = 0
+
+    def render(self):
+        '''Used to turn the metric into lines of the Prometheus text format.
+
+        returns:
+            lines (list): The metric's HELP and TYPE lines, followed by its samples.
+
+        '''
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        value = self.value if self.function is None else self.function()
+        if type(value) == dict:
+            for key, item in value.items():
+                lines.append('{}{{{}="{}"}} {}'.format(self.name, self.label, escape(key), item))
+        else:
+            lines.append('{} {}'.format(self.name, value))
+        return lines
+
+
+class Counter(Metric):
+    '''A number that only ever goes up, such as the number of messages received.'''
+
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge(Metric):
+    '''A number that can go up and down, such as the number of connected clients.'''
+
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(Metric):
+    '''Counts how many observations, such as the time taken to encode a message, fall into each of a set of buckets.
+
+    Args:
+        name (str): The name of the metric.
+
+        help (str): A sentence describing what the metric measures.
+
+        buckets (tuple): The upper bound of every bucket, smallest first.
+
+    '''
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        Metric.__init__(self, name, help)
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, total))
+        lines.append('{}_sum {}'.format(self.name, self.sum))
+        lines.append('{}_count {}'.format(self.name, self.count))
+        return lines
+
+
+class Registry(object):
+    '''Holds every metric that a process keeps, in the order that they were made.'''
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, function=None, label=None):
+        return self.add(Counter(name, help, function, label))
+
+    def gauge(self, name, help, function=None, label=None):
+        return self.add(Gauge(name, help, function, label))
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        '''Used to collect every metric.
+
+        returns:
+            text (str): Every metric, in the Prometheus text format.
+
+        '''
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(asyncio.Protocol):
+    '''A tiny HTTP server for the metrics and the profiler switch. One is made for every connection.
+
+    Args:
+        registry (obj): The Registry whose metrics are served.
+
+        profiler (obj): The SamplingProfiler that /profile/start and /profile/stop control.
+
+    '''
+
+    def __init__(self, registry, profiler):
+        self.registry = registry
+        self.profiler = profiler
+        self.buffer = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        if b'\r\n\r\n' not in self.buffer and b'\n\n' not in self.buffer:
+            if len(self.buffer) > 8192:
+                self.transport.close()
+            return
+
+        request = self.buffer.split(b'\n', 1)[0].decode('latin-1').split()
+        path = request[1] if len(request) >= 2 else ''
+        if path == '/metrics':
+            self.respond('200 OK', self.registry.render(), 'text/plain; version=0.0.4')
+        elif path == '/profile/start':
+            self.profiler.start()
+            self.respond('200 OK', 'Profiler started.\n')
+        elif path == '/profile/stop':
+            self.respond('200 OK', self.profiler.stop())
+        else:
+            self.respond('404 Not Found', 'Try /metrics, /profile/start or /profile/stop.\n')
+
+    def respond(self, status, body, content_type='text/plain'):
+        body = body.encode('utf-8')
+        head = 'HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+            status, content_type, len(body))
+        self.transport.write(head.encode('latin-1') + body)
+        self.transport.close()
+
+
+def escape(value):
+    '''Used to make a label value safe to put between double quotes in the Prometheus text format.'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
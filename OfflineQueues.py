@@ -0,0 +1,132 @@
+"""OfflineQueues.py
+
+Description:
+    Clients acknowledge the messages that they are sent, with an ACK holding the sequence number of the newest
+    message that they have received. OfflineQueues keeps track of how far each user has acknowledged, so that the
+    direct messages that they have not received yet (because they were not logged in, or lost their connection
+    before they got them) can be sent to them in one batch the next time that they log in, and so that whoever
+    sent a direct message can be told once it has been received.
+
+    Direct messages are stored in the MessageStore like every other message, and its index already holds the
+    numbers of every message sent to each user, oldest first. A user's queue is simply the end of that list, after
+    the last message that they acknowledged, so the only thing kept for each user is a single number. These are
+    saved to acked.txt in the store's folder, one JSON line ([username, number]) each time that a user
+    acknowledges a direct message, and the file is rewritten with just the newest line for each user when it is
+    opened.
+
+    Only users who have logged in have a queue. The first time that a user's queue is looked at (when they log in),
+    a line is saved for them too, so that the server can turn away direct messages to anyone who has never logged
+    in (see known()), rather than store them for a queue that no one will ever read.
+
+"""
+
+import os
+import json
+
+
+class OfflineQueues(object):
+    '''The queues of direct messages that each user has not acknowledged yet.
+
+    When acked.txt is first made, everything already in the store counts as received, so that turning
+    acknowledgements on does not send everyone every direct message that they have ever been sent.
+
+    When a user's queue is longer than the count that queued() is asked for, only the oldest messages are sent
+    to them, so until their queue is next looked at (when they next log in), their acknowledgements only count
+    up to the last of those. The rest stay queued, and are sent the next time.
+
+    Args:
+        message_store (obj): The MessageStore that direct messages are stored in.
+
+    '''
+
+    def __init__(self, message_store):
+        self.message_store = message_store
+        self.path = os.path.join(message_store.directory, 'acked.txt')
+        self.acked = {}
+        self.limits = {}
+        self.base = len(message_store) - 1
+
+        try:
+            with open(self.path, 'r') as acked_file:
+                for line in acked_file:
+                    if line.endswith('\n'):
+                        username, number = json.loads(line)
+                        if username is None:
+                            self.base = number
+                        else:
+                            self.acked[username] = max(number, self.acked.get(username, number))
+        except IOError:
+            pass
+
+        with open(self.path + '.tmp', 'w') as acked_file:
+            acked_file.write(json.dumps([None, self.base]) + '\n')
+            for username, number in self.acked.items():
+                acked_file.write(json.dumps([username, number]) + '\n')
+        os.replace(self.path + '.tmp', self.path)
+        self.acked_file = open(self.path, 'a')
+
+    def queued(self, username, count=1000, skip=()):
+        '''Used to find the direct messages that a user has not acknowledged yet.
+
+        args:
+            username (str): The user to look for.
+            count (int): The most messages to return.
+            skip (iterable): The numbers of messages to leave out, e.g. because they are being sent anyway.
+
+        returns:
+            numbers (list): The numbers of the messages, oldest first (the oldest count of them, if there are more).
+
+        '''
+        if username not in self.acked:
+            self.acked[username] = self.base
+            self.acked_file.write(json.dumps([username, self.base]) + '\n')
+            self.acked_file.flush()
+        numbers, complete = self.message_store.after((username,), self.acked.get(username, self.base), count)
+        if complete:
+            self.limits.pop(username, None)
+        else:
+            self.limits[username] = numbers[-1]
+        skip = set(skip)
+        return [number for number in numbers if number not in skip]
+
+    def known(self, username):
+        '''Used to check whether a user has ever logged in, and so can be sent direct messages while they are away.'''
+        return username in self.acked
+
+    def ack(self, username, number):
+        '''Used when a user acknowledges every message up to a number.
+
+        args:
+            username (str): The user who sent the acknowledgement.
+            number (int): The number of the newest message that they have received.
+
+        returns:
+            senders (dict): The numbers of the direct messages that this acknowledged, by who sent them.
+
+        '''
+        acked = self.acked.get(username, self.base)
+        number = min(number, self.limits.get(username, number))
+        if number <= acked:
+            return {}
+        numbers = []
+        while True:
+            found, complete = self.message_store.after((username,), max([acked] + numbers), 1000)
+            numbers.extend(found_number for found_number in found if found_number <= number)
+            if complete or found[-1] > number:
+                break
+        if not numbers:
+            return {}
+
+        self.acked[username] = numbers[-1]
+        self.acked_file.write(json.dumps([username, numbers[-1]]) + '\n')
+        self.acked_file.flush()
+
+        senders = {}
+        for found_number in numbers:
+            message = self.message_store.read(found_number)
+            if message is not None and message[0] != username:
+                senders.setdefault(message[0], []).append(found_number)
+        return senders
+
+    def close(self):
+        self.acked_file.close()
@@ -0,0 +1,156 @@
+"""Outbox.py
+
+Description:
+    Every logged in client has an Outbox, a bounded queue of frames that are waiting to be written to them. Each
+    outbox is emptied by its own task. When the transport's buffer goes over its high water mark, the server's
+    protocol pauses the outbox, and the task waits until the buffer drains below its low water mark before it
+    writes any more. One slow client therefore only ever fills up its own outbox, rather than making the server
+    buffer their share of every broadcast without limit.
+
+    Everything that is queued for a client during one pass of the event loop is joined together and handed to the
+    transport in a single write, so a burst of messages costs one system call (and, over TLS, as few records as
+    possible) rather than one per frame.
+
+    A frame can also be queued before it has been encoded, as a future that an encoding thread will finish later.
+    Frames are always written in the order that they were queued, so the task waits for such a frame to be
+    ready before writing anything that was queued after it. If the frame can not be encoded after all, it is dropped
+    (and the error reported), and the frames after it are written as usual.
+
+    When an outbox is full, its policy decides what happens to the next frame:
+        drop_oldest: the oldest queued frame is thrown away to make room.
+        coalesce:    queued notices (presence changes and search INFO frames) are thrown away first, since they only
+                     describe what happened and are not chat messages; if that is not enough, the oldest frame goes.
+                     A client that misses a presence change notices the gap in its version, and asks for a snapshot.
+        disconnect:  the client is disconnected, and has to reconnect and catch up from history.
+
+"""
+
+import time
+import asyncio
+from collections import deque
+
+
+POLICIES = ('drop_oldest', 'coalesce', 'disconnect')
+
+
+class Outbox(object):
+    '''A bounded queue of frames for one client, and the task that writes them out.
+
+    Args:
+        transport (obj): The transport of the client that the frames are sent to.
+
+        limit (int): The most frames that can wait in the outbox at once.
+
+        policy (str): What to do when the outbox is full; one of drop_oldest, coalesce or disconnect.
+
+        high_water (int): The transport buffer size (in bytes) at which writing pauses.
+
+        low_water (int): The transport buffer size (in bytes) at which writing carries on again.
+
+        on_error (function): If given, called with the error each time that a frame could not be encoded, and was
+                             dropped.
+
+    '''
+
+    def __init__(self, transport, limit=1000, policy='drop_oldest', high_water=256 * 1024, low_water=64 * 1024,
+                 on_error=None):
+        if policy not in POLICIES:
+            raise ValueError('slow consumer policy must be one of {}'.format(', '.join(POLICIES)))
+
+        self.transport = transport
+        self.limit = limit
+        self.policy = policy
+        self.on_error = on_error
+        self.frames = deque()
+        self.dropped = 0
+        self.sent = 0
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+        transport.set_write_buffer_limits(high=high_water, low=low_water)
+        self._task = asyncio.ensure_future(self._run())
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame, notice=False):
+        '''Used to queue a frame to be written to the client.
+
+        args:
+            frame (bytes): The encoded frame to send, or a future that will give the encoded frame.
+            notice (bool): True if the frame is only a notice, which the coalesce policy may throw away.
+
+        '''
+        if self.closed:
+            return
+
+        if len(self.frames) >= self.limit:
+            if self.policy == 'disconnect':
+                self.close()
+                self.transport.close()
+                return
+            if self.policy == 'coalesce':
+                kept = deque(entry for entry in self.frames if not entry[2])
+                self.dropped += len(self.frames) - len(kept)
+                self.frames = kept
+            if len(self.frames) >= self.limit:
+                self.frames.popleft()
+                self.dropped += 1
+
+        self.frames.append((frame, time.time(), notice))
+        self._ready.set()
+
+    def lag(self):
+        '''Used to find out how far behind the client is.
+
+        returns:
+            lag (float): How many seconds the oldest queued frame has been waiting, or 0 if the outbox is empty.
+
+        '''
+        if not self.frames:
+            return 0.0
+        return time.time() - self.frames[0][1]
+
+    def pause(self):
+        '''Used when the transport's buffer is over its high water mark, to stop writing until it drains.'''
+        self._writable.clear()
+
+    def resume(self):
+        '''Used when the transport's buffer is back under its low water mark, to carry on writing.'''
+        self._writable.set()
+
+    def close(self):
+        '''Used to stop the outbox when the client leaves. Anything still queued is thrown away.'''
+        self.closed = True
+        self.frames.clear()
+        self._task.cancel()
+
+    async def _run(self):
+        '''The task that writes queued frames to the client, pausing whenever the transport is backed up.'''
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                while self.frames:
+                    await self._writable.wait()
+                    if self.transport.is_closing():
+                        raise ConnectionError('transport is closed')
+                    frames = []
+                    while self.frames and not isinstance(self.frames[0][0], asyncio.Future):
+                        frames.append(self.frames.popleft()[0])
+                    if not frames:
+                        try:
+                            frames.append(await self.frames.popleft()[0])
+                        except (ConnectionError, asyncio.CancelledError):
+                            raise
+                        except Exception as error:
+                            self.dropped += 1
+                            if self.on_error is not None:
+                                self.on_error(error)
+                            continue
+                    self.transport.write(b''.join(frames))
+                    self.sent += len(frames)
+        except (ConnectionError, asyncio.CancelledError):
+            self.closed = True
@@ -0,0 +1,78 @@
+"""Presence.py
+
+Description:
+    Presence is the list of users who are online. Rather than telling everyone about every single join and leave as
+    it happens, the server collects them for a short while and then sends out a single change, holding everyone who
+    joined (USERS_JOINED) and everyone who left (USERS_LEFT) since the last one. When hundreds of users reconnect at
+    once, each user gets one message about all of them, rather than one message for each of them.
+
+    Every change has a version number, which goes up by one each time. A client that sees a version number that is
+    more than one ahead of the last one it saw has missed a change (e.g. because it was too slow, and its outbox
+    dropped it), and asks the server for a full snapshot of the list with a PRESENCE message.
+
+"""
+
+
+class Presence(object):
+    '''The set of users who are online, and the joins and leaves that have not been sent out yet.'''
+
+    def __init__(self):
+        self.version = 0
+        self.users = {}
+        self.joined = {}
+        self.left = {}
+
+    def __len__(self):
+        return len(self.users)
+
+    def join(self, username):
+        '''Used when a user logs in. Someone who left and came back before the change was sent out is not mentioned.'''
+        if username in self.left:
+            del self.left[username]
+        else:
+            self.joined[username] = None
+
+    def leave(self, username):
+        '''Used when a user logs out. Someone who joined and left before the change was sent out is not mentioned.'''
+        if username in self.joined:
+            del self.joined[username]
+        else:
+            self.left[username] = None
+
+    def flush(self):
+        '''Used to turn the joins and leaves since the last change into the next change.
+
+        returns:
+            delta (dict): The change, as USERS_JOINED, USERS_LEFT and PRESENCE_VERSION, or None if nothing changed.
+
+        '''
+        if not self.joined and not self.left:
+            return None
+        delta = {"USERS_JOINED": list(self.joined), "USERS_LEFT": list(self.left), "PRESENCE_VERSION": self.version + 1}
+        self.joined = {}
+        self.left = {}
+        self.apply(delta)
+        return delta
+
+    def apply(self, delta):
+        '''Used to bring the set of users up to date with a change, e.g. one that was made by the message bus.
+
+        args:
+            delta (dict): The change, as made by flush().
+
+        '''
+        for username in delta["USERS_LEFT"]:
+            self.users.pop(username, None)
+        for username in delta["USERS_JOINED"]:
+            self.users[username] = None
+        self.version = delta["PRESENCE_VERSION"]
+
+    def snapshot(self):
+        '''Used to get the whole set of users, as of the latest change.
+
+        returns:
+            snapshot (dict): The users, as USER_LIST, and the version of the change that they are up to date with,
+                             as PRESENCE_VERSION.
+
+        '''
+        return {"USER_LIST": list(self.users), "PRESENCE_VERSION": self.version}
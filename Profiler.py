@@ -0,0 +1,75 @@
+"""Profiler.py
+
+Description:
+    A sampling profiler that can be switched on and off while the server is running. While it is on, a background
+    thread looks at what the event loop's thread is doing every few milliseconds, and counts how often each call
+    stack is seen. Since it only takes a peek now and then, rather than tracing every call, it is cheap enough to
+    run against a busy server.
+
+    The results are given as collapsed stacks, one line per stack, outermost call first, followed by how many times
+    it was seen:
+        AsyncServer.py:run_server;base_events.py:run_forever;...;AsyncServer.py:broadcast 42
+    which can be read as is, or fed straight into a flame graph tool.
+
+"""
+
+import sys
+import time
+import threading
+from collections import Counter
+
+
+class SamplingProfiler(object):
+    '''Samples the call stack of one thread at a regular interval.
+
+    Args:
+        interval (float): The number of seconds between samples.
+
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.thread = None
+        self.running = False
+        self.started = None
+
+    def start(self):
+        '''Used to start sampling the thread that calls it, if the profiler is not already running.'''
+        if self.running:
+            return
+        self.samples = Counter()
+        self.running = True
+        self.started = time.time()
+        self.thread = threading.Thread(target=self._run, args=(threading.get_ident(),), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''Used to stop sampling.
+
+        returns:
+            report (str): Every stack that was seen, as collapsed stacks, most common first.
+
+        '''
+        if not self.running:
+            return 'Profiler is not running.\n'
+        self.running = False
+        self.thread.join()
+
+        lines = ['# {} samples over {:.1f} seconds'.format(sum(self.samples.values()), time.time() - self.started)]
+        for stack, count in self.samples.most_common():
+            lines.append('{} {}'.format(stack, count))
+        return '\n'.join(lines) + '\n'
+
+    def _run(self, thread_id):
+        '''The thread that takes the samples.'''
+        while self.running:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(code.co_filename.rsplit('/', 1)[-1], code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
@@ -0,0 +1,135 @@
+"""RateLimiter.py
+
+Description:
+    Every chat message that a client sends is written to disk and sent on to everyone it is for, so a single client
+    that sends messages as fast as it can could keep the server busy on its own. Rate limits stop that from
+    happening, using token buckets: a bucket holds up to burst tokens, and is topped up with rate tokens every
+    second. Each request takes tokens from the bucket, and a request that finds the bucket empty is refused.
+
+    A client can send a burst of requests at once (e.g. when pasting several lines), but can not keep sending more
+    than rate of them per second.
+
+"""
+
+import time
+
+
+class TokenBucket(object):
+    '''A single token bucket.
+
+    A request is let through as long as there is at least one token left, even if it costs more than that; the
+    bucket then goes into debt, and stays empty until the debt has been paid off. That way a request that costs
+    more than burst tokens (such as a large batch of messages) is slowed down rather than refused forever.
+
+    Args:
+        rate (float): How many tokens are added to the bucket every second. 0 means that there is no limit.
+
+        burst (float): The most tokens that the bucket can hold.
+
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now=None):
+        '''Used to add the tokens that have built up since the bucket was last used.'''
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost=1, now=None):
+        '''Used to take tokens for a request.
+
+        args:
+            cost (float): How many tokens the request costs.
+
+        returns:
+            allowed (bool): True if the request may go ahead. If it is False, no tokens were taken.
+
+        '''
+        if self.rate <= 0:
+            return True
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= cost
+        return True
+
+    def wait(self):
+        '''Used to find out how many seconds it will be until the next request can be let through.'''
+        if self.rate <= 0:
+            return 0.0
+        self.refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def full(self, now=None):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+class RateLimiter(object):
+    '''A token bucket for each of many keys, such as one for each IP address that clients connect from.
+
+    A bucket is made the first time that a key is seen, and is thrown away again once it has filled back up,
+    since a full bucket is no different from a new one.
+
+    Args:
+        rate (float): How many tokens are added to each bucket every second. 0 means that there is no limit.
+
+        burst (float): The most tokens that each bucket can hold.
+
+        prune_interval (float): How many seconds to wait between looking for full buckets to throw away.
+
+    '''
+
+    def __init__(self, rate, burst, prune_interval=60):
+        self.rate = rate
+        self.burst = burst
+        self.prune_interval = prune_interval
+        self.buckets = {}
+        self.pruned = time.monotonic()
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def bucket(self, key):
+        '''Used to get the bucket of a key, making it if needed.'''
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def take(self, key, cost=1):
+        '''Used to take tokens for a request from the bucket of a key.
+
+        args:
+            key (obj): Whatever the requests are limited by, e.g. the IP address of the client.
+            cost (float): How many tokens the request costs.
+
+        returns:
+            allowed (bool): True if the request may go ahead.
+
+        '''
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        if now - self.pruned >= self.prune_interval:
+            self.prune(now)
+        return self.bucket(key).take(cost, now)
+
+    def wait(self, key):
+        '''Used to find out how many seconds it will be until the next request from a key can be let through.'''
+        if self.rate <= 0 or key not in self.buckets:
+            return 0.0
+        return self.buckets[key].wait()
+
+    def prune(self, now=None):
+        '''Used to throw away every bucket that has filled back up.'''
+        if now is None:
+            now = time.monotonic()
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if not bucket.full(now)}
+        self.pruned = now
@@ -0,0 +1,92 @@
+"""Renderer.py
+
+Description:
+    The Renderer turns chat messages into the lines that the terminal shows. Whether the time and the username
+    are shown, and whether there is an extra space after each message, are settled once, when the Renderer is
+    made, by picking a format string; each message is then a single str.format call. Messages that were sent in
+    the same second share a timestamp, so timestamps are formatted once per second rather than once per message.
+
+    A batch of messages (such as the history that the server sends when we join) is rendered into a single string
+    and written out in large chunks, instead of with a print call (and a flush of the terminal) for every line.
+
+"""
+
+import sys
+import datetime
+
+
+FORMATS = {
+    ('n', 'y'): "{0} said: {3}\n",
+    ('y', 'n'): "{2}: {3}\n",
+    ('n', 'n'): "{3}\n",
+}
+DEFAULT_FORMAT = "At {2}, {0} said: {3}\n"
+CHUNK_SIZE = 65536
+MAX_TIMESTAMPS = 4096
+UNKNOWN_TIME = '(unknown time)'
+
+
+class Renderer(object):
+    '''Used to format messages according to the user's options, and to write them to the terminal.
+
+    Args:
+        time_on (str): 'y' to show the time before each message.
+
+        user_on (str): 'y' to show the username before each message.
+
+        space_on (str): 'y' to put an extra empty line after each message.
+
+        output (obj): The file to write to. The default is sys.stdout.
+
+    '''
+
+    def __init__(self, time_on, user_on, space_on, output=None):
+        self.format = FORMATS.get((time_on, user_on), DEFAULT_FORMAT)
+        if space_on == 'y':
+            self.format += "\n"
+        self.time_on = '{2}' in self.format
+        self.output = output
+        self.timestamps = {}
+
+    def timestamp(self, seconds):
+        '''Used to get the time of a message as it is shown, formatting it only if it has not been seen before.
+
+        A time that cannot be shown (e.g. one in the year 31690708, from a client that made it up) is shown as
+        UNKNOWN_TIME, rather than stopping the rest of the batch from being shown.
+
+        '''
+        text = self.timestamps.get(seconds)
+        if text is None:
+            if len(self.timestamps) >= MAX_TIMESTAMPS:
+                self.timestamps.clear()
+            try:
+                text = str(datetime.datetime.fromtimestamp(seconds))
+            except (ValueError, OverflowError, OSError):
+                text = UNKNOWN_TIME
+            self.timestamps[seconds] = text
+        return text
+
+    def render(self, messages):
+        '''Used to format a batch of messages.
+
+        args:
+            messages (list): The messages, each as (sender, recipient, timestamp, text).
+
+        returns:
+            text (str): The lines to show for them, one after another.
+
+        '''
+        line = self.format.format
+        if self.time_on:
+            timestamp = self.timestamp
+            return ''.join([line(sender, recipient, timestamp(sent), text) for sender, recipient, sent, text
+                            in messages])
+        return ''.join([line(sender, recipient, None, text) for sender, recipient, sent, text in messages])
+
+    def write(self, messages):
+        '''Used to show a batch of messages, writing them out CHUNK_SIZE characters at a time.'''
+        output = self.output or sys.stdout
+        text = self.render(messages)
+        for start in range(0, len(text), CHUNK_SIZE):
+            output.write(text[start:start + CHUNK_SIZE])
+        output.flush()
@@ -0,0 +1,371 @@
+"""SearchIndex.py
+
+Description:
+    The SearchIndex lets users search the text of the chat history. It is an inverted index: for every word that
+    has ever been sent, it keeps the numbers of the messages that hold it, oldest first. It is updated as each
+    message is stored, so a search never has to read through the messages themselves. It walks whichever is
+    shorter, the list of the rarest word in the search or the messages that the user is allowed to see, newest
+    first, and checks each number against the other lists with a binary search. However long both of them are,
+    no more than SCAN_LIMIT numbers are checked for one page of results; if that many are checked first, the
+    page ends early, with a cursor to carry on from.
+
+    Words are runs of letters, digits and underscores, compared without regard to case. Words of a single
+    character, and words longer than MAX_WORD characters, are not indexed.
+
+    The index is saved to a snapshot in the same folder as the messages it indexes, in the same way as the
+    MessageStore's own index, and memory-mapped when it is opened again. The snapshot holds every word in sorted
+    order, followed by the message numbers of each word, so a word is found in it with a binary search rather
+    than by reading the snapshot in. Messages that were stored after the last snapshot are indexed again when the
+    index is opened.
+
+    Writing a snapshot means merging every word ever used with the new ones, so it takes longer as the history
+    grows. A SearchSnapshot only reads the index as it was when the snapshot was started, so it can be written on
+    a thread of its own while messages keep being added, and the index then swaps over to it in one step. The
+    words that were used in the meantime are carried over to the new snapshot one at a time, the next time that
+    each of them is used.
+
+"""
+
+import os
+import re
+import mmap
+import bisect
+import heapq
+import struct
+import itertools
+from array import array
+
+from Column import Column
+
+
+WORD = re.compile(r'\w+')
+MAX_WORD = 40
+SNAPSHOT_HEADER = struct.Struct('=8sQQQQQ')
+SNAPSHOT_MAGIC = b'CHATFIND'
+SNAPSHOT_CHECK = 0x0102030405060708
+SCAN_LIMIT = 2000
+
+
+def words(text):
+    '''Used to split a message, or a search, into the words that are indexed.
+
+    args:
+        text (str): The text to split.
+
+    returns:
+        words (set): Every indexed word in the text, in lower case.
+
+    '''
+    return {word for word in WORD.findall(text.lower()) if 1 < len(word) <= MAX_WORD}
+
+
+class SearchIndex(object):
+    '''An inverted index over the text of the messages in a MessageStore.
+
+    The words in the snapshot are kept in it in sorted order, and are found with a binary search, so opening the
+    index does not depend on how many different words have ever been sent. Only words that have been used since the
+    snapshot was taken are kept in the terms dict. Right after the index swaps over to a new snapshot, the terms
+    that it held before are kept as the previous dict, for the messages that the snapshot does not cover yet.
+
+    Args:
+        directory (str): The folder that the snapshot is kept in, which is the folder of the MessageStore.
+
+    '''
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, 'search.snapshot')
+        self.terms = {}
+        self.indexed = 0
+        self.word_ends = self.posting_ends = array('Q')
+        self.words = self.postings = b''
+        self.previous = {}
+        self.previous_from = 0
+        self.saved = 0
+
+    def add(self, number, text):
+        '''Used to index a message, which must be newer than every message indexed so far.
+
+        args:
+            number (int): The number of the message in its store.
+            text (str): The text of the message.
+
+        '''
+        for word in words(text):
+            postings = self.terms.get(word)
+            if postings is None:
+                postings = self.terms[word] = self._carried(word)
+            postings.append(number)
+        self.indexed = number + 1
+
+    def _carried(self, word):
+        '''Used to start the postings of a word that has not been used since the last snapshot: what the snapshot
+        holds for it, followed by anything that the previous terms hold for it that the snapshot does not.'''
+        postings = Column('Q', self._mapped(word.encode('utf-8')))
+        previous = self.previous.get(word)
+        if previous is not None:
+            for number in previous.tail[bisect.bisect_left(previous.tail, self.previous_from):]:
+                postings.append(number)
+        return postings
+
+    def _mapped(self, word):
+        '''Used to find a word in the snapshot.
+
+        args:
+            word (bytes): The word, encoded as UTF-8.
+
+        returns:
+            postings (obj): The numbers of the messages that hold the word, as a memoryview, or None.
+
+        '''
+        low, high = 0, len(self.word_ends)
+        while low < high:
+            middle = (low + high) // 2
+            if self._word(middle) < word:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.word_ends) and self._word(low) == word:
+            return self.postings[self.posting_ends[low - 1] if low else 0:self.posting_ends[low]]
+        return None
+
+    def _word(self, position):
+        return bytes(self.words[self.word_ends[position - 1] if position else 0:self.word_ends[position]])
+
+    def _postings(self, word):
+        postings = self.terms.get(word)
+        if postings is None:
+            postings = self._carried(word)
+        return postings if len(postings) else None
+
+    def search(self, query, visible, before=None, count=20):
+        '''Used to find the newest messages that hold every word of a search.
+
+        args:
+            query (str): The words to search for.
+            visible (list): The messages that may be returned, e.g. the ones that were sent to the user who is
+                            searching, as (column, floor) pairs: a sorted Column of message numbers, and the lowest
+                            of them that may be returned.
+            before (int): Only messages with a number lower than this are returned. None means start from the newest.
+            count (int): The most messages to return.
+
+        returns:
+            numbers (list): The numbers of the matching messages, newest first.
+            cursor (int): The cursor to pass as before to get the next (older) matches, or None if there are none.
+                          There may be fewer than count matches along with a cursor, if SCAN_LIMIT was reached.
+
+        '''
+        postings = []
+        for word in words(query):
+            column = self._postings(word)
+            if column is None:
+                return [], None
+            postings.append(column)
+        if not postings:
+            return [], None
+
+        ranges = []
+        for column, floor in visible:
+            low = bisect.bisect_left(column, floor)
+            high = len(column) if before is None else bisect.bisect_left(column, before)
+            if high > low:
+                ranges.append((column, floor, low, high))
+
+        postings.sort(key=len)
+        rarest = postings[0]
+        position = len(rarest) if before is None else bisect.bisect_left(rarest, before)
+        walk_visible = sum(high - low for column, floor, low, high in ranges) < position
+        if walk_visible:
+            candidates = heapq.merge(*[newest_first(column, low, high) for column, floor, low, high in ranges],
+                                     reverse=True)
+            others = postings
+        else:
+            candidates = newest_first(rarest, 0, position)
+            others = postings[1:]
+
+        numbers = []
+        for scanned, number in enumerate(candidates, 1):
+            if all(contains(other, number) for other in others) and \
+                    (walk_visible or any(number >= floor and contains(column, number) for column, floor in visible)):
+                numbers.append(number)
+                if len(numbers) > count:
+                    return numbers[:count], numbers[count - 1]
+            if scanned >= SCAN_LIMIT:
+                return numbers, number
+        return numbers, None
+
+    def load(self, limit):
+        '''Used to map the snapshot into memory, if there is one that matches the store.
+
+        args:
+            limit (int): The number of messages in the store. A snapshot that has indexed more messages than that
+                         (because the store lost messages it had not yet written to disk) is not used.
+
+        returns:
+            indexed (int): The number of messages that the snapshot covers, or 0 if there is no usable snapshot.
+
+        '''
+        try:
+            snapshot_file = open(self.path, 'rb')
+        except IOError:
+            return 0
+        with snapshot_file:
+            size = os.fstat(snapshot_file.fileno()).st_size
+            if size < SNAPSHOT_HEADER.size:
+                return 0
+            mapped = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, check, indexed, term_count, words_size, postings_count = SNAPSHOT_HEADER.unpack_from(mapped)
+        words_end = SNAPSHOT_HEADER.size + 16 * term_count + words_size
+        if magic != SNAPSHOT_MAGIC or check != SNAPSHOT_CHECK or indexed > limit or \
+                size != words_end + -words_end % 8 + 8 * postings_count:
+            return 0
+
+        view = memoryview(mapped)
+        position = SNAPSHOT_HEADER.size
+        self.word_ends = view[position:position + 8 * term_count].cast('Q')
+        position += 8 * term_count
+        self.posting_ends = view[position:position + 8 * term_count].cast('Q')
+        position += 8 * term_count
+        self.words = view[position:position + words_size]
+        position = words_end + -words_end % 8
+        self.postings = view[position:].cast('Q')
+        self.terms = {}
+        self.previous = {}
+        self.indexed = self.saved = indexed
+        return indexed
+
+    def snapshot(self):
+        '''Used to start a new snapshot of the index as it is now.
+
+        returns:
+            snapshot (obj): A SearchSnapshot, whose run() writes it, on any thread, and whose finish() then maps it in.
+
+        '''
+        return SearchSnapshot(self)
+
+    def save(self):
+        '''Used to write the whole index out to the snapshot straight away, e.g. when the store is closed.'''
+        snapshot = SearchSnapshot(self)
+        snapshot.run()
+        snapshot.finish()
+
+
+class SearchSnapshot(object):
+    '''A snapshot of a SearchIndex, which merges the words used since the last snapshot into the ones that were
+    already in it.
+
+    Only the postings that the index held when the snapshot was started are written, and neither the mapped part
+    of the index nor its previous terms ever change, so adding messages to the index while run() is going on is
+    safe.
+
+    Args:
+        index (obj): The SearchIndex to snapshot.
+
+    '''
+
+    def __init__(self, index):
+        self.index = index
+        self.path = index.path
+        self.indexed = index.indexed
+        self.terms = dict(index.terms)
+        self.previous = index.previous
+        self.previous_from = index.previous_from
+        self.word_ends = index.word_ends
+        self.posting_ends = index.posting_ends
+        self.words = index.words
+        self.postings = index.postings
+        self.fresh = None
+
+    def run(self):
+        '''Used to write the snapshot, and map it in to a fresh SearchIndex for finish() to swap over to. This only
+        reads the index, so it can be done on a thread of its own.
+
+        The snapshot is written to a temporary file first, and then moved into place, so a crash while it is being
+        written leaves the old snapshot as it was.
+
+        '''
+        added = {}
+        for word, postings in self.previous.items():
+            if word not in self.terms:
+                start = bisect.bisect_left(postings.tail, self.previous_from)
+                added[word.encode('utf-8')] = (False, [postings.tail[start:]])
+        for word, postings in self.terms.items():
+            end = bisect.bisect_left(postings.tail, self.indexed)
+            added[word.encode('utf-8')] = (True, [postings.mapped, postings.tail[:end]])
+        added = sorted(added.items())
+
+        entries = []
+        position = 0
+        for i in range(len(self.word_ends)):
+            word = bytes(self.words[self.word_ends[i - 1] if i else 0:self.word_ends[i]])
+            while position < len(added) and added[position][0] < word:
+                entries.append((added[position][0], added[position][1][1]))
+                position += 1
+            parts = [self.postings[self.posting_ends[i - 1] if i else 0:self.posting_ends[i]]]
+            if position < len(added) and added[position][0] == word:
+                whole, more = added[position][1]
+                parts = more if whole else parts + more
+                position += 1
+            entries.append((word, parts))
+        entries.extend((word, parts) for word, (whole, parts) in added[position:])
+
+        word_ends = array('Q', itertools.accumulate(len(word) for word, parts in entries))
+        posting_ends = array('Q', itertools.accumulate(sum(len(part) for part in parts) for word, parts in entries))
+        words_size = word_ends[-1] if entries else 0
+        postings_count = posting_ends[-1] if entries else 0
+        words_end = SNAPSHOT_HEADER.size + 16 * len(entries) + words_size
+
+        with open(self.path + '.tmp', 'wb') as snapshot_file:
+            snapshot_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_CHECK, self.indexed, len(entries),
+                                                     words_size, postings_count))
+            snapshot_file.write(word_ends)
+            snapshot_file.write(posting_ends)
+            snapshot_file.write(b''.join(word for word, parts in entries))
+            snapshot_file.write(b'\0' * (-words_end % 8))
+            for word, parts in entries:
+                for part in parts:
+                    snapshot_file.write(part)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(self.path + '.tmp', self.path)
+
+        fresh = SearchIndex(os.path.dirname(self.path))
+        if fresh.load(self.indexed) == self.indexed:
+            self.fresh = fresh
+
+    def finish(self):
+        '''Used once run() is done, from the thread that adds to the index, to swap the index over to the new
+        snapshot. If it could not be written, the index is left as it was, and its words go into the next one.
+
+        The terms that the index holds become its previous terms, since the snapshot does not cover the messages
+        that were added to them while it was being written.
+
+        '''
+        index = self.index
+        fresh = self.fresh
+        if fresh is not None:
+            index.word_ends, index.posting_ends = fresh.word_ends, fresh.posting_ends
+            index.words, index.postings = fresh.words, fresh.postings
+            index.previous = index.terms
+            index.previous_from = index.saved = self.indexed
+            index.terms = {}
+
+
+def contains(column, number):
+    '''Used to check whether a sorted Column holds a number, searching its mapped part and its tail separately.'''
+    for part in (column.mapped, column.tail):
+        position = bisect.bisect_left(part, number)
+        if position < len(part) and part[position] == number:
+            return True
+    return False
+
+
+def newest_first(column, low, high):
+    '''Used to walk the numbers in a range of positions of a sorted Column, from the highest to the lowest.'''
+    split = len(column.mapped)
+    tail = column.tail
+    for position in range(high - split - 1, max(low - split, 0) - 1, -1):
+        yield tail[position]
+    mapped = column.mapped
+    for position in range(min(high, split) - 1, low - 1, -1):
+        yield mapped[position]
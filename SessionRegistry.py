@@ -0,0 +1,189 @@
+"""SessionRegistry.py
+
+Description:
+    The SessionRegistry keeps track of every user that is logged in to the server. Each logged in user has a Session,
+    which can be looked up by their username (e.g. to deliver a direct message), and logged out by the address that
+    they connected from (when their connection is lost), in constant time.
+
+    It also keeps the subscriber set of every room: the sessions that have joined it, and so should get every
+    message sent to it. A message to a room is only sent to those sessions, so its cost depends on the size of the
+    room rather than on how many people are on the server.
+
+"""
+
+import time
+from collections import deque
+
+from Codec import JSON
+
+
+UNACKED_LIMIT = 1000
+
+
+class Session(object):
+    '''A single logged in user, and what the server knows about them.
+
+    Args:
+        username (str): The username that the client logged in with.
+
+        writer (obj): The writer object that is used to send messages to the client. Once the user is logged in,
+                      messages should be sent with write(), so that they are queued in the session's outbox.
+
+        address (list): The host and port that the client connected from.
+
+    The session also remembers the SEQ of each frame that the client has been sent but not acknowledged yet,
+    with when it was sent (only the last UNACKED_LIMIT of them, for a client that never acknowledges anything),
+    the newest SEQ that the client has acknowledged, and the SEQ of the newest direct message that it was sent.
+
+    '''
+
+    def __init__(self, username, writer, address):
+        self.username = username
+        self.writer = writer
+        self.address = address
+        self.joined = time.time()
+        self.last_active = self.joined
+        self.messages_sent = 0
+        self.messages_received = 0
+        self.outbox = None
+        self.codec = JSON
+        self.rooms = set()
+        self.unacked = deque(maxlen=UNACKED_LIMIT)
+        self.acked = -1
+        self.dm_seq = -1
+
+    def write(self, frame, notice=False):
+        '''Used to send an encoded frame to the client, through their outbox once they have one.
+
+        args:
+            frame (bytes): The encoded frame to send.
+            notice (bool): True if the frame is only a notice, which a slow client's outbox may throw away.
+
+        '''
+        if self.outbox is None:
+            self.writer.write(frame)
+        else:
+            self.outbox.put(frame, notice)
+
+
+class SessionRegistry(object):
+    '''The set of logged in sessions, indexed by username and by address.
+
+    asyncio runs every callback on a single thread, so as long as joining and leaving are each done with a
+    single call to add() or remove(), both indexes always agree with each other.
+
+    '''
+
+    def __init__(self):
+        self.by_username = {}
+        self.by_address = {}
+        self.rooms = {}
+
+    def __len__(self):
+        return len(self.by_username)
+
+    def __iter__(self):
+        return iter(list(self.by_username.values()))
+
+    def __contains__(self, username):
+        return username in self.by_username
+
+    def add(self, session):
+        '''Used to log in a new session, as long as no one else is already using its username.
+
+        args:
+            session (obj): The Session to add.
+
+        returns:
+            added (bool): True if the session was added, or False if the username is already in use.
+
+        '''
+        if session.username in self.by_username or session.address in self.by_address:
+            return False
+        self.by_username[session.username] = session
+        self.by_address[session.address] = session
+        return True
+
+    def remove(self, address):
+        '''Used to log out the session that is connected from an address.
+
+        The session is taken out of every room's subscribers, but still remembers which rooms it was in.
+
+        args:
+            address (list): The host and port that the session connected from.
+
+        returns:
+            session (obj): The Session that was removed, or None if no one was logged in from that address.
+
+        '''
+        session = self.by_address.pop(address, None)
+        if session is not None and self.by_username.get(session.username) is session:
+            del self.by_username[session.username]
+        if session is not None:
+            for room in session.rooms:
+                self._unsubscribe(session, room)
+        return session
+
+    def find(self, username):
+        '''Used to find the session of a logged in user, e.g. to deliver a direct message to them.
+
+        args:
+            username (str): The username to look for.
+
+        returns:
+            session (obj): The user's Session, or None if they are not logged in.
+
+        '''
+        return self.by_username.get(username)
+
+    def join(self, session, room):
+        '''Used to add a session to a room's subscribers.
+
+        args:
+            session (obj): The Session that is joining.
+            room (str): The name of the room, starting with #.
+
+        returns:
+            joined (bool): True if the session joined, or False if it was already in the room.
+
+        '''
+        if room in session.rooms:
+            return False
+        self.rooms.setdefault(room, set()).add(session)
+        session.rooms.add(room)
+        return True
+
+    def leave(self, session, room):
+        '''Used to remove a session from a room's subscribers. A room is forgotten once its last subscriber leaves.
+
+        args:
+            session (obj): The Session that is leaving.
+            room (str): The name of the room, starting with #.
+
+        returns:
+            left (bool): True if the session left, or False if it was not in the room.
+
+        '''
+        if room not in session.rooms:
+            return False
+        session.rooms.discard(room)
+        self._unsubscribe(session, room)
+        return True
+
+    def _unsubscribe(self, session, room):
+        members = self.rooms[room]
+        members.discard(session)
+        if not members:
+            del self.rooms[room]
+
+    def members(self, room):
+        '''Used to get the sessions that have joined a room.
+
+        args:
+            room (str): The name of the room, starting with #.
+
+        returns:
+            members (set): The sessions in the room, which is empty if no one is in it.
+
+        '''
+        return self.rooms.get(room, ())
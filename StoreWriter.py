@@ -0,0 +1,211 @@
+"""StoreWriter.py
+
+Description:
+    Writing messages to disk (and above all fsyncing them) can take anything from microseconds to seconds, depending
+    on how busy the disk is. The StoreWriter takes that work off the event loop: every message that a MessageStore
+    stores is handed to a background thread through a queue, and the thread writes messages out in groups, one
+    write (and at most one fsync) per store for each group. A group is committed once it holds commit_size messages,
+    or once its oldest message has waited commit_interval seconds, whichever comes first; so a small interval (or
+    size) keeps what could be lost in a crash small, and a larger one writes (and fsyncs) less often.
+
+    Until a message has been written, its store keeps it in memory, so it can be read back straight away. Sealing
+    a segment (syncing it, starting the next one and snapshotting the index) is handed to the thread too, in line
+    with the messages, so it happens once the last of the segment's messages has been written. Only closing a store
+    waits for the writer to catch up.
+
+    If a group can not be written (e.g. the disk is full), the error is reported, and the same group is written
+    again every RETRY_INTERVAL seconds until it works. Nothing after it is written in the meantime, since the
+    index already says where every message will be in the log.
+
+"""
+
+import os
+import time
+import queue
+import threading
+
+
+COMMIT_INTERVAL = 0.01
+COMMIT_SIZE = 1000
+RETRY_INTERVAL = 1.0
+
+
+class StoreWriter(object):
+    '''A background thread that writes the messages of one or more MessageStores to disk, in groups.
+
+    Args:
+        loop (obj): The event loop that the stores are used from. The writer tells the stores, on this loop, which
+                    of their messages have been written.
+
+        commit_interval (float): The most seconds that a message waits for others to be written along with it.
+
+        commit_size (int): The most messages that are written in one group.
+
+        on_commit (function): If given, called on the loop after every group with the number of messages in it and
+                              how many seconds the oldest of them waited to be written (the writer's lag).
+
+        on_error (function): If given, called on the loop with the error each time that a group could not be
+                             written.
+
+    '''
+
+    def __init__(self, loop, commit_interval=COMMIT_INTERVAL, commit_size=COMMIT_SIZE, on_commit=None,
+                 on_error=None):
+        self.loop = loop
+        self.commit_interval = commit_interval
+        self.commit_size = commit_size
+        self.on_commit = on_commit
+        self.on_error = on_error
+        self.messages = queue.SimpleQueue()
+        self.submitted = 0
+        self.committed = 0
+        self.lag = 0.0
+        self.condition = threading.Condition()
+        self.closing = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def __len__(self):
+        '''The number of messages (and segments to seal) that are waiting to be written.'''
+        return self.submitted - self.committed
+
+    def _put(self, entry):
+        '''Used to hand an entry to the thread. Threads do not survive a fork, so the thread is started the first
+        time that a process submits anything.'''
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.messages = queue.SimpleQueue()
+            self.submitted = self.committed = 0
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.submitted += 1
+        self.messages.put(entry)
+
+    def submit(self, store, number, line, record):
+        '''Used by a MessageStore to hand over a message to be written.
+
+        args:
+            store (obj): The MessageStore that the message belongs to.
+            number (int): The number of the message in its store.
+            line (bytes): The message, as it is written to the log.
+            record (bytes): The message's index record.
+
+        '''
+        self._put((store, number, line, record, time.monotonic()))
+
+    def seal(self, store, start, recipients):
+        '''Used by a MessageStore to have its newest segment sealed, once every message submitted before it has been
+        written. The store's seal() is then called on the thread, and its sealed() on the loop.
+
+        args:
+            store (obj): The MessageStore whose segment is full.
+            start (int): The number of the first message of the next segment.
+            recipients (int): How many recipients the store had when the segment was full.
+
+        '''
+        self._put((store, start, None, recipients, time.monotonic()))
+
+    def drain(self):
+        '''Used to wait until every message that has been submitted has been written.'''
+        with self.condition:
+            self.condition.wait_for(lambda: self.committed >= self.submitted)
+
+    def _run(self):
+        '''The thread that gathers messages into groups and writes them out. A group ends at a segment to seal, which
+        is sealed once the rest of the group has been written.'''
+        while True:
+            group = [self.messages.get()]
+            finished = group[0] is None
+            deadline = time.monotonic() + self.commit_interval if finished else group[0][4] + self.commit_interval
+            while not finished and len(group) < self.commit_size and group[-1][2] is not None:
+                try:
+                    timeout = deadline - time.monotonic()
+                    entry = self.messages.get(timeout=timeout) if timeout > 0 else self.messages.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    finished = True
+                else:
+                    group.append(entry)
+                    if entry[2] is None:
+                        break
+            if finished:
+                group = [entry for entry in group if entry is not None]
+            if group:
+                self._commit(group)
+            if finished:
+                return
+
+    def _commit(self, group):
+        '''Used to write a group of messages, a single write for each store, then seal the segment that ends the group
+        (if it does), and to report back to the loop.'''
+        seal = group.pop() if group[-1][2] is None else None
+        stores = {}
+        for store, number, line, record, queued in group:
+            written = stores.get(store)
+            if written is None:
+                written = stores[store] = [[], [], 0]
+            written[0].append(line)
+            written[1].append(record)
+            written[2] = number + 1
+
+        ends = []
+        for store, (lines, records, end) in stores.items():
+            seconds = self._write(store.write, lines, records)
+            if seconds is not None:
+                ends.append((store, end, seconds))
+
+        sealed = None
+        if seal is not None:
+            store, start, _, recipients, queued = seal
+            if self._write(store.seal, start, recipients) is not None:
+                sealed = (store, start)
+
+        self.lag = time.monotonic() - (group[0][4] if group else seal[4])
+        self._call(self._report, ends, sealed, len(group), self.lag)
+        with self.condition:
+            self.committed += len(group) + (seal is not None)
+            self.condition.notify_all()
+
+    def _write(self, write, *args):
+        '''Used to write one store's part of a group (or seal its segment), trying again every RETRY_INTERVAL
+        seconds until it works.
+
+        returns:
+            seconds (float): How long the write took, or None if the writer was closed before it could be written.
+
+        '''
+        while True:
+            try:
+                return write(*args)
+            except OSError as error:
+                self._call(self.on_error, error)
+                if self.closing.wait(RETRY_INTERVAL):
+                    return None
+
+    def _report(self, ends, sealed, count, lag):
+        for store, end, seconds in ends:
+            store.written(end, seconds)
+        if sealed is not None:
+            sealed[0].sealed(sealed[1])
+        if self.on_commit is not None and count:
+            self.on_commit(count, lag)
+
+    def _call(self, function, *args):
+        '''Used to run a function on the loop, from the thread. Nothing is run once the loop has been closed.'''
+        if function is None:
+            return
+        try:
+            self.loop.call_soon_threadsafe(function, *args)
+        except RuntimeError:
+            pass
+
+    def close(self):
+        '''Used when the server shuts down, to write out anything still waiting and stop the thread. A group that is
+        still failing to be written is given up on.'''
+        if self.thread is not None and self.pid == os.getpid():
+            self.closing.set()
+            self.messages.put(None)
+            self.thread.join()
+            self.thread = None
+            self.pid = None